@@ -0,0 +1,184 @@
+# SPDX-License-Identifier: WTFPL
+
+"""Playback of animated images, decoding frames in a thread with bounded memory
+
+Frames are decoded ahead of time into a ring buffer of at most
+ANIMATION_BUFFER_FRAMES frames and ANIMATION_BUDGET bytes. The decoder
+waits for frames to be shown before decoding more, so memory does not
+grow with the length of the animation. Animations which fit entirely
+in the budget are decoded once, then replayed from memory.
+"""
+
+from collections import deque
+from logging import getLogger
+import threading
+
+from PyQt6.QtCore import QObject, QThread, QTimer, pyqtSignal as Signal, pyqtSlot as Slot
+from PyQt6.QtGui import QImage, QImageReader
+
+
+LOGGER = getLogger(__name__)
+
+# bytes of decoded frames kept in memory per animation
+ANIMATION_BUDGET = 64 * 1024 * 1024
+
+# frames decoded in advance
+ANIMATION_BUFFER_FRAMES = 16
+
+# like browsers, frames with a delay of 10ms or less are shown for 100ms
+FAST_FRAME_DELAY = 10
+DEFAULT_FRAME_DELAY = 100
+
+
+def is_animated(reader):
+	# single images in formats supporting animation are not animated
+	return reader.supportsAnimation() and reader.imageCount() != 1
+
+
+class FrameDecoder(QThread):
+	"""Decode frames of an animation in a loop, into a bounded buffer
+
+	`take()` returns frames in order, as (index, image, delay in ms), which
+	makes room for decoding more. `frameDecoded` is emitted for each new
+	frame. If the whole animation fits in `budget`, the decoder stops after
+	the first loop and `allFrames` holds the frames.
+	"""
+
+	frameDecoded = Signal()
+
+	def __init__(self, path, budget=ANIMATION_BUDGET, maxFrames=ANIMATION_BUFFER_FRAMES, parent=None):
+		super().__init__(parent)
+		self.path = path
+		self.budget = budget
+		self.maxFrames = maxFrames
+
+		self.condition = threading.Condition()
+		self.frames = deque()
+		# bytes of images in frames
+		self.size = 0
+		self.allFrames = None
+		self.stopped = False
+
+	def run(self):
+		# frames of the first loop, while they fit in the budget
+		kept = []
+		keptSize = 0
+
+		while True:
+			reader = QImageReader(self.path)
+			index = 0
+			while not self.stopped:
+				image = reader.read()
+				if image.isNull():
+					break
+
+				delay = reader.nextImageDelay()
+				if delay <= FAST_FRAME_DELAY:
+					delay = DEFAULT_FRAME_DELAY
+
+				frame = (index, image, delay)
+				index += 1
+				if kept is not None:
+					kept.append(frame)
+					keptSize += image.sizeInBytes()
+					if keptSize > self.budget:
+						kept = None
+
+				if not self._push(frame):
+					return
+
+			if self.stopped:
+				return
+			if not index:
+				LOGGER.warning("cannot decode %r: %s", self.path, reader.errorString())
+				return
+
+			if kept is not None:
+				# no need to decode it again
+				with self.condition:
+					self.allFrames = [(image, delay) for _, image, delay in kept]
+				self.frameDecoded.emit()
+				return
+
+	def _push(self, frame):
+		# wait for room in the buffer, at least one frame fits whatever its size
+		size = frame[1].sizeInBytes()
+		with self.condition:
+			self.condition.wait_for(lambda: (
+				self.stopped or not self.frames
+				or (len(self.frames) < self.maxFrames and self.size + size <= self.budget)
+			))
+			if self.stopped:
+				return False
+
+			self.frames.append(frame)
+			self.size += size
+		self.frameDecoded.emit()
+		return True
+
+	def take(self, index):
+		"""Return frame at index (modulo the number of frames), or None if not decoded yet"""
+		with self.condition:
+			if self.frames:
+				frame = self.frames.popleft()
+				self.size -= frame[1].sizeInBytes()
+				self.condition.notify()
+				return frame
+			elif self.allFrames:
+				index %= len(self.allFrames)
+				return (index, *self.allFrames[index])
+		return None
+
+	def stop(self):
+		with self.condition:
+			self.stopped = True
+			self.condition.notify()
+		self.wait()
+
+
+class AnimationPlayer(QObject):
+	"""Play an animated image in a loop, emitting `frameChanged` for each frame
+
+	Frames are decoded by a FrameDecoder. When a frame is late, it is shown
+	as soon as it is decoded.
+	"""
+
+	frameChanged = Signal(QImage)
+
+	def __init__(self, path, parent=None, **kwargs):
+		super().__init__(parent)
+		self.decoder = FrameDecoder(path, **kwargs)
+		self.decoder.frameDecoded.connect(self._frameDecoded)
+		self.timer = QTimer(self)
+		self.timer.setSingleShot(True)
+		self.timer.timeout.connect(self._next)
+		# index of the frame shown
+		self.index = -1
+		# whether next frame is due but was not decoded yet
+		self.waiting = True
+
+	def start(self):
+		self.decoder.start()
+
+	def stop(self):
+		self.timer.stop()
+		# ignore frameDecoded signals still queued
+		self.waiting = False
+		self.decoder.stop()
+
+	@Slot()
+	def _next(self):
+		frame = self.decoder.take(self.index + 1)
+		if frame is None:
+			self.waiting = True
+			return
+
+		self.waiting = False
+		self.index, image, delay = frame
+		self.frameChanged.emit(image)
+		self.timer.start(delay)
+
+	@Slot()
+	def _frameDecoded(self):
+		if self.waiting:
+			self._next()
@@ -10,14 +10,14 @@ from urllib.parse import urlparse
 from urllib.request import url2pathname
 import os
 
-from PyQt6.QtCore import pyqtSlot as Slot, QUrl, Qt
+from PyQt6.QtCore import pyqtSlot as Slot, QUrl, Qt, QTimer
 from PyQt6.QtGui import QIcon, QPixmap, QDesktopServices
 from PyQt6.QtWidgets import (
 	QMainWindow, QApplication, QAbstractItemView, QWhatsThis,
 )
 from PyQt6.uic import loadUiType
 
-from . import dbtag
+from . import dbtag, fsops
 from .fullscreenviewer import ImageViewer
 
 
@@ -36,6 +36,10 @@ def load_ui_class(package, module_name, class_name):
 
 Ui_MainWindow = load_ui_class('sittagger', 'mainwindow', 'Ui_MainWindow')
 
+# delay before refreshing tags/caption panes after selection changes,
+# so fast keyboard navigation or shift-click are coalesced in one refresh
+SELECTION_DELAY_MS = 80
+
 
 class Win(Ui_MainWindow, QMainWindow):
 	def __init__(self, options):
@@ -52,6 +56,8 @@ class Win(Ui_MainWindow, QMainWindow):
 		self.db = dbtag.Db(multithread=True)
 		self.db.open(options.db)
 		self.db.do_migrations()
+		fsops.replay_journals(self.db)
+		fsops.sync_trash(self.db)
 		self.rootPath = options.filespath
 
 		self._init_dirchooser(options.target)
@@ -72,7 +78,12 @@ class Win(Ui_MainWindow, QMainWindow):
 		self.dirChooser.openTo(folder)
 
 	def _init_imagelist(self):
-		self.imageList.itemSelectionChanged.connect(self._editTagsItems)
+		self.selectionTimer = QTimer(self)
+		self.selectionTimer.setSingleShot(True)
+		self.selectionTimer.setInterval(SELECTION_DELAY_MS)
+		self.selectionTimer.timeout.connect(self._editTagsItems)
+
+		self.imageList.itemSelectionChanged.connect(self.selectionTimer.start)
 		self.imageList.activated.connect(self._openFile)
 		self.imageList.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
 		self.imageList.pasteRequested.connect(self._onListPaste)
@@ -81,6 +92,7 @@ class Win(Ui_MainWindow, QMainWindow):
 		self.tabWidget.currentChanged.connect(self._tabSelected)
 
 	def _init_tagchooser(self):
+		self.tagChooser.setFaceted(True)
 		self.tagChooser.setDb(self.db)
 		self.tagChooser.changed.connect(self.browseSelectedTags)
 		self.tagChooserFilter.setWidget(self.tagChooser)
@@ -21,14 +21,23 @@ def hash_tag(tag):
 	return f"#[{escaped}]"
 
 
-def extract_tags_from_caption(caption):
-	return [unhash_tag(htag) for htag, _, _ in extract_tags_with_positions(caption)]
+def canonical_tag(tag, aliases=None):
+	if aliases:
+		return aliases.get(tag, tag)
+	return tag
+
+
+def extract_tags_from_caption(caption, aliases=None):
+	return [
+		canonical_tag(unhash_tag(htag), aliases)
+		for htag, _, _ in extract_tags_with_positions(caption)
+	]
 	# return [unhash_tag(htag) for htag in CAPTION_TAG.findall(caption)]
 
 
-def extract_tags_with_positions(caption):
+def extract_tags_with_positions(caption, aliases=None):
 	for match in CAPTION_TAG.finditer(caption):
-		yield (unhash_tag(match[0]), match.start(), match.end())
+		yield (canonical_tag(unhash_tag(match[0]), aliases), match.start(), match.end())
 
 
 def rename_tag_in_caption(caption, old, new):
@@ -44,8 +53,9 @@ def clean_spaces(s):
 	return UNWANTED_SPACES.sub("", s)
 
 
-def tags_to_caption(tags, caption):
-	tags_positions = list(extract_tags_with_positions(caption))
+def tags_to_caption(tags, caption, aliases=None):
+	# with aliases, a "#kitty" in caption is considered to be tag "cat"
+	tags_positions = list(extract_tags_with_positions(caption, aliases))
 	old_tags = {htag for htag, _, _ in tags_positions}
 	new_tags = set(tags)
 	to_delete = old_tags - new_tags
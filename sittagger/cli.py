@@ -2,11 +2,15 @@
 # SPDX-License-Identifier: WTFPL
 
 from argparse import ArgumentParser, RawTextHelpFormatter
+from itertools import groupby, islice
 from pathlib import Path
 from textwrap import dedent
+import json
 import os
+import sqlite3
 import sys
 
+from . import daemon, fsops, fswalk
 from .dbtag import Db
 
 
@@ -39,65 +43,277 @@ def choose_db_path(opts):
 	opts.db = str(dest_path)
 
 
+def parse_time(text):
+	# "90", "1:30" or "0:01:30" (with optional decimals) to milliseconds
+	seconds = 0
+	for part in text.split(':'):
+		seconds = seconds * 60 + float(part)
+	return int(seconds * 1000)
+
+
+def format_time(ms):
+	minutes, seconds = divmod(ms / 1000, 60)
+	hours, minutes = divmod(int(minutes), 60)
+	return '%02d:%02d:%06.3f' % (hours, minutes, seconds)
+
+
+def add_output_arguments(parser):
+	group = parser.add_mutually_exclusive_group()
+	group.add_argument(
+		'-0', '--null', action='store_true',
+		help='Terminate results with NUL characters instead of newlines',
+	)
+	group.add_argument(
+		'--json-lines', action='store_true', help='Print each result as JSON, one per line',
+	)
+	group.add_argument('--count', action='store_true', help='Only print the number of results')
+
+
+def print_results(args, results, to_text=str):
+	# results are printed as they come, in the format chosen by add_output_arguments
+	if args.count:
+		print(sum(1 for _ in results))
+		return
+
+	end = '\0' if args.null else '\n'
+	try:
+		for result in results:
+			if args.json_lines:
+				print(json.dumps(result), end=end)
+			else:
+				print(to_text(result), end=end)
+		sys.stdout.flush()
+	except BrokenPipeError:
+		# reader went away, like "| head", don't complain again when exiting
+		if sys.stdout is sys.__stdout__:
+			os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+
+def split_set_items(items):
+	# "+TAG", "-TAG" and files
+	to_add = set()
+	to_del = set()
+	files = []
+	for item in items:
+		if item.startswith('-'):
+			to_del.add(item[1:])
+		elif item.startswith('+'):
+			to_add.add(item[1:])
+		else:
+			files.append(item)
+	return to_add, to_del, files
+
+
+def split_set_options(items):
+	# extract -r/--recursive, --glob PATTERN and --mime TYPE, until "--"
+	recursive = False
+	globs = []
+	mimes = []
+	rest = []
+	items = iter(items)
+	for item in items:
+		option, _, value = item.partition('=')
+		if item == '--':
+			rest.extend(items)
+		elif item in ('-r', '--recursive'):
+			recursive = True
+		elif option in ('--glob', '--mime'):
+			if not value:
+				value = next(items, None)
+				if value is None:
+					raise ValueError('%s requires a value' % option)
+			(globs if option == '--glob' else mimes).append(value)
+		else:
+			rest.append(item)
+	return recursive, globs, mimes, rest
+
+
+# records per transaction in batch mode
+BATCH_CHUNK_SIZE = 20000
+
+
+def read_records(stream, separator):
+	# split a binary stream on separator, decoding records like file names
+	if separator == b'\n':
+		for line in stream:
+			yield os.fsdecode(line.rstrip(b'\n'))
+		return
+
+	rest = b''
+	while True:
+		block = stream.read(1 << 16)
+		if not block:
+			break
+		*records, rest = (rest + block).split(separator)
+		for record in records:
+			yield os.fsdecode(record)
+	if rest:
+		yield os.fsdecode(rest)
+
+
+def parse_batch_record(record):
+	# tab-separated fields, returns (command, *arguments) or raises ValueError
+	command, *fields = record.split('\t')
+
+	if command == 'set':
+		to_add, to_del, files = split_set_items(fields)
+		if not files:
+			raise ValueError('at least one file should be provided')
+		if not to_add and not to_del:
+			raise ValueError('at least one tag should be added or removed')
+
+		files = [os.path.abspath(file) for file in files]
+		for file in files:
+			if not os.path.exists(file):
+				raise ValueError('will not tag non-existing file %r' % file)
+		return command, to_add, to_del, files
+
+	elif command == 'set-caption':
+		if len(fields) != 2:
+			raise ValueError('expected a file and a caption')
+		return command, os.path.abspath(fields[0]), fields[1]
+
+	elif command == 'rename-file':
+		if len(fields) != 2:
+			raise ValueError('expected a source and a destination file')
+		src, dst = fields
+		if not os.path.exists(dst):
+			raise ValueError('will not rename non-existing dest file %r' % dst)
+		return command, os.path.abspath(src), os.path.abspath(dst)
+
+	elif command == 'untrack':
+		if not fields:
+			raise ValueError('at least one file should be provided')
+		return command, [os.path.abspath(file) for file in fields]
+
+	raise ValueError('unknown command %r' % command)
+
+
+def apply_batch(db, commands):
+	# consecutive commands of the same kind are applied with a single bulk call
+	for name, group in groupby(commands, key=lambda command: command[0]):
+		if name == 'set':
+			# the last change of a (file, tag) wins
+			changes = {}
+			for _, to_add, to_del, files in group:
+				for file in files:
+					for tag in to_del:
+						changes[file, tag] = False
+					for tag in to_add:
+						changes[file, tag] = True
+			db.untag_files(item for item, added in changes.items() if not added)
+			db.tag_files(item for item, added in changes.items() if added)
+
+		elif name == 'set-caption':
+			for _, file, caption in group:
+				db.set_caption(file, caption)
+
+		elif name == 'rename-file':
+			db.rename_files((src, dst) for _, src, dst in group)
+
+		elif name == 'untrack':
+			db.untrack_files(file for _, files in group for file in files)
+
+
+def run_batch(db, records, chunk_size=BATCH_CHUNK_SIZE):
+	# apply commands of records, chunk_size records per transaction
+	# a bad record is reported and skipped, it does not abort the others
+	def report(lineno, message):
+		nonlocal err
+		print('line %d: %s' % (lineno, message), file=sys.stderr)
+		err = 1
+
+	err = 0
+	numbered = enumerate(records, 1)
+	while True:
+		chunk = list(islice(numbered, chunk_size))
+		if not chunk:
+			break
+
+		commands = []
+		for lineno, record in chunk:
+			if not record.strip():
+				continue
+			try:
+				commands.append((lineno, parse_batch_record(record)))
+			except ValueError as exc:
+				report(lineno, exc)
+
+		try:
+			with db:
+				apply_batch(db, [command for _, command in commands])
+		except sqlite3.Error:
+			# rolled back, find the culprits by applying one by one
+			for lineno, command in commands:
+				try:
+					with db:
+						apply_batch(db, [command])
+				except sqlite3.Error as exc:
+					report(lineno, exc)
+
+	return err
+
+
 def build_parser():
 	parser = ArgumentParser(description="Manipulate a SIT-tagger database")
 	parser.add_argument('-d', '--database', metavar='FILE', dest='db')
+	parser.add_argument(
+		'--no-daemon', action='store_true',
+		help='Access the database directly even if a daemon is serving it',
+	)
 	return parser
 
 
 def main():
 	def do_query():
-		if not args.items or args.items in (['-h'], ['--help']):
-			sub_query.print_help()
-			sub_query.error('at least one tag should be given')
-
-		for file in db.find_files_by_tags(args.items):
-			print(file)
+		print_results(args, db.find_files_by_tags(args.items))
 
 	def do_show():
-		if not args.items:
-			parser.error('at least one file should be given')
-
-		for file in args.items:
-			file = os.path.abspath(file)
-			print(file, '=', '[%s]' % ', '.join(db.find_tags_by_file(file)))
+		files = [os.path.abspath(file) for file in args.items]
+		print_results(
+			args,
+			({'file': file, 'tags': tags} for file, tags in db.find_tags_by_files(files)),
+			lambda result: '%s = [%s]' % (result['file'], ', '.join(result['tags'])),
+		)
 
 	def do_set():
 		if not args.items or args.items in (['-h'], ['--help']):
 			sub_set.print_help()
 			sub_set.error("at least one file should be provided")
 
-		to_add = set()
-		to_del = set()
-		files = []
-		for item in args.items:
-			if item.startswith('-'):
-				to_del.add(item[1:])
-			elif item.startswith('+'):
-				to_add.add(item[1:])
-			else:
-				files.append(item)
+		try:
+			recursive, globs, mimes, items = split_set_options(args.items)
+		except ValueError as exc:
+			sub_set.error(str(exc))
 
+		to_add, to_del, files = split_set_items(items)
 		if not files:
 			sub_set.print_help()
 			sub_set.error('at least one file should be provided')
 		elif not to_add and not to_del:
 			sub_set.print_help()
 			sub_set.error('at least one tag should be added or removed')
+		elif (globs or mimes) and not recursive:
+			sub_set.error('--glob and --mime can only be used with -r')
 
 		err = 0
+		found = []
+		dirs = []
 		for file in files:
 			file = os.path.abspath(file)
-			if not os.path.exists(file):
+			if recursive and os.path.isdir(file):
+				dirs.append(file)
+			elif os.path.exists(file):
+				found.append(file)
+			else:
 				print('will not tag non-existing file %r' % file, file=sys.stderr)
 				err = 1
-				continue
 
-			for tag in to_add:
-				db.tag_file(file, tag)
-			for tag in to_del:
-				db.untag_file(file, tag)
+		if dirs:
+			found.extend(fswalk.walk_files(dirs, globs, mimes))
 
+		db.tag_files((file, tag) for file in found for tag in to_add)
+		db.untag_files((file, tag) for file in found for tag in to_del)
 		return err
 
 	def do_set_caption():
@@ -127,19 +343,97 @@ def main():
 		else:
 			db.rename_file(args.src, args.dst)
 
+	def do_transfer(op):
+		dest = Path(args.dest).absolute()
+		sources = [Path(src).absolute() for src in args.sources]
+		if not dest.is_dir() and len(sources) > 1:
+			parser.error('target %r is not a directory' % args.dest)
+
+		for src in sources:
+			if not src.exists():
+				parser.error('%r does not exist' % str(src))
+
+		fsops.Transfer(dest, sources, op, db).run()
+
+	def do_mv():
+		do_transfer('cut')
+
+	def do_cp():
+		do_transfer('copy')
+
+	def do_trash():
+		for item in args.items:
+			if not os.path.lexists(item):
+				parser.error('%r does not exist' % item)
+
+		fsops.trash_items([os.path.abspath(item) for item in args.items], db)
+
+	def do_restore():
+		trashed = []
+		for item in args.items:
+			found = db.find_trashed(os.path.abspath(item))
+			if found is None:
+				parser.error('%r was not sent to trash by sit-tagger' % item)
+			trashed.append(found)
+
+		fsops.restore_items(trashed, db)
+
+	def do_imply():
+		if args.remove:
+			db.remove_tag_implication(args.tag, args.implied)
+		else:
+			db.add_tag_implication(args.tag, args.implied)
+
+	def do_alias():
+		if args.remove:
+			aliases = dict(db.list_tag_aliases())
+			db.remove_tag_aliases([alias for alias in args.aliases if aliases.get(alias) == args.tag])
+		else:
+			db.add_tag_aliases(args.tag, args.aliases)
+
+	def do_list_aliases():
+		for alias, tag in db.list_tag_aliases():
+			print(alias, '=>', tag)
+
+	def do_list_implications():
+		for tag, implied in db.list_tag_implications():
+			print(tag, '=>', implied)
+
+	def do_segments():
+		for file, tag, start, end in db.find_segments(
+			args.tag, at=args.at, overlapping=args.overlapping, min_duration=args.min_duration,
+		):
+			print('%s\t%s\t%s-%s' % (file, tag, format_time(start), format_time(end)))
+
 	def do_list_tags():
-		for tag in db.list_tags():
-			print(tag)
+		print_results(args, db.list_tags())
 
 	def do_list_files():
-		for file in db.list_files():
-			print(file)
+		print_results(args, db.list_files())
 
 	def do_untrack_files():
 		for item in args.items:
 			item = os.path.abspath(item)
 			db.untrack_file(item)
 
+	def do_batch():
+		separator = b'\0' if args.null else b'\n'
+		return run_batch(db, read_records(sys.stdin.buffer, separator), args.chunk_size)
+
+	def do_serve():
+		def run(argv):
+			nonlocal args
+			args = parser.parse_args(argv)
+			if args.func in LOCAL_COMMANDS:
+				parser.error('%s cannot be run by the daemon' % args.subcommand)
+			with db:
+				return 1 if args.func() else 0
+
+		try:
+			daemon.serve(db, run)
+		except RuntimeError as exc:
+			parser.error(str(exc))
+
 	parser = build_parser()
 	subs = parser.add_subparsers(dest='subcommand', required=True)
 
@@ -152,6 +446,11 @@ def main():
 				%(prog)s set +foo -bar some_file.jpg
 
 			will add "foo" tag to "some_file.jpg" and delete "bar" tag from "some_file.jpg"
+
+				%(prog)s -r +photo --mime 'image/*' some_dir
+
+			will add "photo" tag to all images in "some_dir" and its subdirectories
+			(except those matching patterns of .sittaggerignore files)
 		'''),
 		formatter_class=RawTextHelpFormatter,
 	)
@@ -162,6 +461,10 @@ def main():
 			- a filename to manipulate it
 			- or "+TAG" to add TAG
 			- or "-TAG" to remove a TAG
+			- or "-r"/"--recursive" to tag files in directories, recursively
+			- or "--glob PATTERN" to only tag files matching PATTERN with -r
+			- or "--mime TYPE" to only tag files of TYPE with -r (like "image/*")
+			- or "--" to consider next ITEMs as files or tags
 		'''),
 	)
 	sub.set_defaults(func=do_set)
@@ -180,27 +483,35 @@ def main():
 	sub.add_argument("caption", help="New text caption (can contain #tags)")
 	sub.set_defaults(func=do_set_caption)
 
-	sub_query = sub = subs.add_parser(
-		'query', add_help=False, prefix_chars='^',
+	sub = subs.add_parser(
+		'query',
 		description='Search files matching TAGs',
 		epilog=dedent('''
 			Example:
 
-				%(prog)s query foo bar
+				%(prog)s foo bar
 
 			will list files having both "foo" AND "bar" tags
+
+				%(prog)s -0 foo | xargs -0 ls -l
+
+			will list details of files having "foo" tag
+
+			Tags starting with "-" can be given after "--".
 		'''),
 		formatter_class=RawTextHelpFormatter,
 	)
 	sub.add_argument(
-		'items', nargs='*',
+		'items', nargs='+',
 		metavar='TAG',
 		help='tags that should be searched',
 	)
+	add_output_arguments(sub)
 	sub.set_defaults(func=do_query)
 
 	sub = subs.add_parser('show', description='Show tags associated to files')
 	sub.add_argument('items', nargs='+', metavar='file')
+	add_output_arguments(sub)
 	sub.set_defaults(func=do_show)
 
 	sub = subs.add_parser('rename-tag', description='Rename a tag (and keep linked files to it)')
@@ -214,24 +525,154 @@ def main():
 	sub.add_argument('dst', help='New name/path of file')
 	sub.set_defaults(func=do_rename_file)
 
+	sub = subs.add_parser(
+		'mv', description='Move files or directories, keeping their tags and thumbnails',
+	)
+	sub.add_argument('sources', nargs='+', metavar='SRC', help='Files or directories to move')
+	sub.add_argument('dest', metavar='DEST', help='Destination directory, or new path if only one SRC')
+	sub.set_defaults(func=do_mv)
+
+	sub = subs.add_parser(
+		'cp', description='Copy files or directories, and their thumbnails',
+	)
+	sub.add_argument('sources', nargs='+', metavar='SRC', help='Files or directories to copy')
+	sub.add_argument('dest', metavar='DEST', help='Destination directory, or new path if only one SRC')
+	sub.set_defaults(func=do_cp)
+
+	sub = subs.add_parser(
+		'trash', description='Send files or directories to the trash, keeping their tags for restore',
+	)
+	sub.add_argument('items', nargs='+', metavar='FILE')
+	sub.set_defaults(func=do_trash)
+
+	sub = subs.add_parser(
+		'restore', description='Restore files or directories sent to the trash by "trash", with their tags',
+	)
+	sub.add_argument('items', nargs='+', metavar='FILE', help='Original path of the item')
+	sub.set_defaults(func=do_restore)
+
+	sub = subs.add_parser(
+		'imply', description='Make a tag imply another one: querying IMPLIED will also find files tagged TAG',
+	)
+	sub.add_argument('--remove', action='store_true', help='Remove the implication instead')
+	sub.add_argument('tag', help='Tag implying the other one, like "cat"')
+	sub.add_argument('implied', help='Implied tag, like "animal"')
+	sub.set_defaults(func=do_imply)
+
+	sub = subs.add_parser('list-implications', description='List tags implications')
+	sub.set_defaults(func=do_list_implications)
+
+	sub = subs.add_parser(
+		'alias',
+		description='Make ALIASes resolve to TAG, and replace them with TAG on already tagged files',
+	)
+	sub.add_argument('--remove', action='store_true', help='Remove the aliases instead')
+	sub.add_argument('tag', help='Canonical tag, like "cat"')
+	sub.add_argument('aliases', nargs='+', metavar='alias', help='Variants of the tag, like "kitty"')
+	sub.set_defaults(func=do_alias)
+
+	sub = subs.add_parser('list-aliases', description='List tags aliases')
+	sub.set_defaults(func=do_list_aliases)
+
+	sub = subs.add_parser(
+		'segments', description='Search time ranges of videos tagged with TAG',
+		epilog=dedent('''
+			TIMEs are in seconds, or in MIN:SEC or HOUR:MIN:SEC format.
+
+			Example:
+
+				%(prog)s segments goal --at 12:00
+
+			will list videos with a "goal" time range containing minute 12
+		'''),
+		formatter_class=RawTextHelpFormatter,
+	)
+	sub.add_argument('tag', nargs='?', help='Tag of the time ranges (default: any tag)')
+	sub.add_argument('--at', type=parse_time, metavar='TIME', help='Time ranges containing TIME')
+	sub.add_argument(
+		'--overlapping', type=parse_time, nargs=2, metavar=('START', 'END'),
+		help='Time ranges overlapping START-END',
+	)
+	sub.add_argument(
+		'--min-duration', type=parse_time, metavar='TIME',
+		help='Time ranges lasting at least TIME',
+	)
+	sub.set_defaults(func=do_segments)
+
 	sub = subs.add_parser('list-tags', description='List all tags')
+	add_output_arguments(sub)
 	sub.set_defaults(func=do_list_tags)
 
 	sub = subs.add_parser('list-files', description='List tagged files')
+	add_output_arguments(sub)
 	sub.set_defaults(func=do_list_files)
 
 	sub = subs.add_parser('untrack-files', description='Unlink all tags from a file (does not remove files on-disk)')
 	sub.add_argument('items', nargs='+')
 	sub.set_defaults(func=do_untrack_files)
 
+	sub = subs.add_parser(
+		'batch', description='Run commands read from stdin, one per line',
+		epilog=dedent('''
+			Each line is a command and its arguments, separated by tabs:
+
+				set	+TAG	-TAG	FILE...
+				set-caption	FILE	CAPTION
+				rename-file	SRC	DST
+				untrack	FILE...
+
+			Erroneous lines are reported and skipped.
+
+			Example:
+
+				find -name '*.jpg' -printf 'set\\t+photo\\t%%p\\n' | %(prog)s
+
+			will add "photo" tag to all .jpg files
+		'''),
+		formatter_class=RawTextHelpFormatter,
+	)
+	sub.add_argument(
+		'-0', '--null', action='store_true',
+		help='Commands are separated by NUL characters instead of newlines',
+	)
+	sub.add_argument(
+		'--chunk-size', type=int, default=BATCH_CHUNK_SIZE, metavar='N',
+		help='Commit every N commands (default: %(default)s)',
+	)
+	sub.set_defaults(func=do_batch)
+
+	sub = subs.add_parser(
+		'serve',
+		description=(
+			'Keep the database open and serve commands of other sit-tagger-cli'
+			+ ' invocations, through a UNIX socket, for faster calls'
+		),
+	)
+	sub.set_defaults(func=do_serve)
+
+	# commands reading stdin or serving are never sent to a daemon
+	LOCAL_COMMANDS = (do_batch, do_serve)
+
 	args = parser.parse_args()
 	choose_db_path(args)
 
+	if not args.no_daemon and args.func not in LOCAL_COMMANDS:
+		try:
+			status = daemon.call(
+				daemon.socket_path(args.db), sys.argv[1:], os.getcwd(), sys.stdout, sys.stderr,
+			)
+		except BrokenPipeError:
+			os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+			return 0
+		if status is not None:
+			return status
+
 	db = Db()
 	db.open(args.db)
 	try:
 		with db:
 			db.do_migrations()
+			fsops.replay_journals(db)
 			err = args.func()
 	finally:
 		db.close()
@@ -0,0 +1,185 @@
+# SPDX-License-Identifier: WTFPL
+
+"""Tag co-occurrence matrix, used for suggesting tags
+"""
+
+from array import array
+from bisect import bisect_left
+import heapq
+from itertools import combinations
+from logging import getLogger
+import math
+
+
+LOGGER = getLogger(__name__)
+
+
+class Cooccurrence:
+	"""Sparse symmetric matrix of how many files have each pair of tags
+
+	Each tag gets an integer id, and each row of the matrix is stored as 2
+	arrays: sorted ids of co-occurring tags and the matching counts.
+	The matrix is built from the database once, then it is updated
+	incrementally by Db when tags are set or unset, and rebuilt only if
+	another connection modified the database.
+	"""
+
+	def __init__(self, db):
+		self.db = db
+		self._clear()
+
+	def _clear(self):
+		self.data_version = None
+
+		self.names = []
+		self.ids = {}
+		self.total = 0
+		self.tag_counts = array('l')
+		self.neighbors = []
+		self.pair_counts = []
+
+	def _data_version(self):
+		return self.db.db.execute('PRAGMA data_version').fetchone()[0]
+
+	def _id(self, tag):
+		try:
+			return self.ids[tag]
+		except KeyError:
+			pass
+
+		id = self.ids[tag] = len(self.names)
+		self.names.append(tag)
+		self.tag_counts.append(0)
+		self.neighbors.append(array('l'))
+		self.pair_counts.append(array('l'))
+		return id
+
+	def invalidate(self):
+		self.data_version = None
+
+	def _ensure(self):
+		if self.data_version is not None and self.data_version == self._data_version():
+			return
+		self.rebuild()
+
+	def rebuild(self):
+		LOGGER.debug("building tags co-occurrence matrix")
+
+		self._clear()
+		sql = self.db.db
+
+		self.total = sql.execute('SELECT COUNT(DISTINCT file) FROM tags_files').fetchone()[0]
+		for tag, count in sql.execute('SELECT tag, COUNT(DISTINCT file) FROM tags_files GROUP BY tag'):
+			self.tag_counts[self._id(tag)] = count
+
+		rows = [[] for _ in self.names]
+		for tag_a, tag_b, count in sql.execute(
+			'''
+			SELECT a.tag, b.tag, COUNT(DISTINCT a.file)
+			FROM tags_files a JOIN tags_files b ON a.file = b.file AND a.tag < b.tag
+			GROUP BY a.tag, b.tag
+			'''
+		):
+			id_a = self.ids[tag_a]
+			id_b = self.ids[tag_b]
+			rows[id_a].append((id_b, count))
+			rows[id_b].append((id_a, count))
+
+		for id, row in enumerate(rows):
+			row.sort()
+			self.neighbors[id] = array('l', (other for other, _ in row))
+			self.pair_counts[id] = array('l', (count for _, count in row))
+
+		self.data_version = self._data_version()
+
+	def _add_pair(self, id_a, id_b, delta):
+		for row, other in ((id_a, id_b), (id_b, id_a)):
+			neighbors = self.neighbors[row]
+			counts = self.pair_counts[row]
+
+			pos = bisect_left(neighbors, other)
+			if pos < len(neighbors) and neighbors[pos] == other:
+				counts[pos] += delta
+				if counts[pos] <= 0:
+					del neighbors[pos]
+					del counts[pos]
+			elif delta > 0:
+				neighbors.insert(pos, other)
+				counts.insert(pos, delta)
+
+	def file_tags_changed(self, path, old_tags, new_tags):
+		# called by Db when a file's set of tags changes from old_tags to new_tags
+		if self.data_version is None:
+			# not built yet, or invalidated, nothing to maintain
+			return
+
+		old_tags = set(old_tags)
+		new_tags = set(new_tags)
+		added = new_tags - old_tags
+		removed = old_tags - new_tags
+		if not added and not removed:
+			return
+
+		if not old_tags:
+			self.total += 1
+		elif not new_tags:
+			self.total -= 1
+
+		for tags, changed, delta in ((new_tags, added, 1), (old_tags, removed, -1)):
+			for tag in changed:
+				self.tag_counts[self._id(tag)] += delta
+
+			for tag_a, tag_b in combinations(sorted(tags), 2):
+				if tag_a in changed or tag_b in changed:
+					self._add_pair(self._id(tag_a), self._id(tag_b), delta)
+
+	def count(self, tag_a, tag_b):
+		self._ensure()
+		try:
+			id_a = self.ids[tag_a]
+			id_b = self.ids[tag_b]
+		except KeyError:
+			return 0
+
+		neighbors = self.neighbors[id_a]
+		pos = bisect_left(neighbors, id_b)
+		if pos < len(neighbors) and neighbors[pos] == id_b:
+			return self.pair_counts[id_a][pos]
+		return 0
+
+	def suggest(self, tags, exclude=(), limit=10):
+		"""Rank tags likely to be set on a file having `tags`
+
+		Each candidate is scored by summing, over the given tags it co-occurs
+		with, the number of co-occurrences weighted by the pointwise mutual
+		information (log of lift). Without context, most used tags are returned.
+		"""
+		self._ensure()
+
+		exclude = set(exclude) | set(tags)
+		scores = {}
+		for tag in tags:
+			try:
+				id = self.ids[tag]
+			except KeyError:
+				continue
+
+			count = self.tag_counts[id]
+			if not count:
+				continue
+
+			for other, pair_count in zip(self.neighbors[id], self.pair_counts[id]):
+				lift = pair_count * self.total / (count * self.tag_counts[other])
+				if lift <= 1:
+					continue
+				scores[other] = scores.get(other, 0) + pair_count * math.log(lift)
+
+		if not scores:
+			scores = dict(enumerate(self.tag_counts))
+
+		candidates = (
+			id for id in scores
+			if self.tag_counts[id] and self.names[id] not in exclude
+		)
+		ranked = heapq.nsmallest(limit, candidates, key=lambda id: (-scores[id], self.names[id]))
+		return [self.names[id] for id in ranked]
@@ -0,0 +1,181 @@
+# SPDX-License-Identifier: WTFPL
+
+"""Daemon keeping a database open, serving CLI commands on a UNIX socket
+
+Protocol: the client sends a JSON line {"argv": [...], "cwd": "..."}, the
+daemon answers with JSON lines {"stdout": "..."} and {"stderr": "..."} as
+the command prints, then a final {"status": N} line.
+"""
+
+from contextlib import redirect_stderr, redirect_stdout
+from hashlib import sha1
+import io
+import json
+from logging import getLogger
+import os
+import signal
+import socket
+import sys
+import tempfile
+import traceback
+
+
+LOGGER = getLogger(__name__)
+
+# characters buffered before sending output to the client
+OUTPUT_BUFFER_SIZE = 8192
+
+
+def socket_path(db_path):
+	# one daemon per database
+	runtime_dir = os.getenv('XDG_RUNTIME_DIR')
+	if not runtime_dir:
+		runtime_dir = os.path.join(tempfile.gettempdir(), 'sit-tagger-%d' % os.getuid())
+	os.makedirs(runtime_dir, mode=0o700, exist_ok=True)
+
+	key = sha1(os.fsencode(os.path.realpath(db_path))).hexdigest()[:16]
+	return os.path.join(runtime_dir, 'sit-tagger-%s.sock' % key)
+
+
+def _send(wfile, message):
+	wfile.write(json.dumps(message).encode() + b'\n')
+	wfile.flush()
+
+
+class _Output(io.TextIOBase):
+	# text stream sending what is written as {name: text} messages
+
+	def __init__(self, wfile, name):
+		super().__init__()
+		self.wfile = wfile
+		self.name = name
+		self.parts = []
+		self.size = 0
+
+	def writable(self):
+		return True
+
+	def write(self, text):
+		self.parts.append(text)
+		self.size += len(text)
+		if self.size >= OUTPUT_BUFFER_SIZE:
+			self.flush()
+		return len(text)
+
+	def flush(self):
+		if self.parts:
+			text = ''.join(self.parts)
+			self.parts = []
+			self.size = 0
+			_send(self.wfile, {self.name: text})
+
+
+def _run_request(run, request, wfile):
+	stdout = _Output(wfile, 'stdout')
+	stderr = _Output(wfile, 'stderr')
+	try:
+		with redirect_stdout(stdout), redirect_stderr(stderr):
+			try:
+				os.chdir(request['cwd'])
+				status = run(request['argv'])
+			except SystemExit as exc:
+				# argparse errors and help
+				if exc.code is None or isinstance(exc.code, int):
+					status = exc.code or 0
+				else:
+					print(exc.code, file=sys.stderr)
+					status = 1
+			except Exception:
+				traceback.print_exc()
+				status = 1
+			stdout.flush()
+			stderr.flush()
+		_send(wfile, {'status': status})
+	except OSError:
+		LOGGER.info("client went away")
+
+
+def serve(db, run):
+	"""Serve requests until interrupted, calling `run(argv)` for each
+
+	`run` should return the exit status of the command. Requests are
+	handled one at a time since they share the sqlite connection.
+	"""
+	path = socket_path(db.db_path)
+	if call_status(path):
+		raise RuntimeError('a daemon is already serving %r on %r' % (db.db_path, path))
+	if os.path.exists(path):
+		# left by a daemon which did not exit cleanly
+		os.unlink(path)
+
+	server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	old_umask = os.umask(0o077)
+	try:
+		server.bind(path)
+	finally:
+		os.umask(old_umask)
+	server.listen()
+	LOGGER.info("serving %r on %r", db.db_path, path)
+
+	signal.signal(signal.SIGTERM, signal.default_int_handler)
+	data_version = None
+	try:
+		while True:
+			conn, _ = server.accept()
+			try:
+				with conn, conn.makefile('rwb') as wfile:
+					line = wfile.readline()
+					if not line:
+						continue
+					request = json.loads(line)
+					if not request.get('argv'):
+						# ping
+						_send(wfile, {'status': 0})
+						continue
+
+					# other connections may have modified the db meanwhile
+					new_version = db.db.execute('PRAGMA data_version').fetchone()[0]
+					if new_version != data_version:
+						db.invalidate_caches()
+						data_version = new_version
+
+					_run_request(run, request, wfile)
+			except (OSError, ValueError) as exc:
+				LOGGER.warning("bad request: %s", exc)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.close()
+		os.unlink(path)
+
+
+def call_status(path):
+	# is a daemon listening on path?
+	return call(path, [], os.getcwd(), None, None) is not None
+
+
+def call(path, argv, cwd, stdout, stderr):
+	"""Run a command in the daemon listening on `path`
+
+	Returns the exit status of the command, or None if no daemon is running.
+	"""
+	conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		conn.connect(path)
+	except OSError:
+		conn.close()
+		return None
+
+	with conn, conn.makefile('rwb') as rfile:
+		_send(rfile, {'argv': argv, 'cwd': cwd})
+		for line in rfile:
+			message = json.loads(line)
+			if 'status' in message:
+				return message['status']
+			elif 'stdout' in message:
+				stdout.write(message['stdout'])
+			elif 'stderr' in message:
+				stderr.write(message['stderr'])
+
+	print('sit-tagger daemon closed the connection', file=stderr)
+	return 1
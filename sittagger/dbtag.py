@@ -1,14 +1,42 @@
 # SPDX-License-Identifier: WTFPL
 
+from collections import OrderedDict
 from logging import getLogger
 from pathlib import Path
 import sqlite3
 
 from . import captiontools
+from .cooccurrence import Cooccurrence
 
 
 LOGGER = getLogger(__name__)
 
+FACETS_CACHE_SIZE = 32
+
+# "animal/cat" implies "animal"
+HIERARCHY_SEP = '/'
+
+# new (tag, ancestor) pairs when adding a (tag, implied) edge: tag and all tags
+# implying it now imply "implied" and all tags implied by it
+SQL_CLOSURE_ADD_EDGE = '''
+	INSERT OR IGNORE INTO tag_closure (tag, ancestor)
+	SELECT low.tag, high.ancestor FROM
+		(SELECT ? AS tag UNION SELECT tag FROM tag_closure WHERE ancestor = ?) AS low,
+		(SELECT ? AS ancestor UNION SELECT ancestor FROM tag_closure WHERE tag = ?) AS high
+	WHERE low.tag != high.ancestor
+'''
+
+SQL_CLOSURE_REBUILD = '''
+	INSERT OR IGNORE INTO tag_closure (tag, ancestor)
+	WITH RECURSIVE closure(tag, ancestor) AS (
+		SELECT tag, implied FROM tag_relations
+		UNION
+		SELECT closure.tag, tag_relations.implied
+		FROM closure JOIN tag_relations ON closure.ancestor = tag_relations.tag
+	)
+	SELECT tag, ancestor FROM closure WHERE tag != ancestor
+'''
+
 
 def iter2list(func):
 	def wrapper(*args, **kwargs):
@@ -22,17 +50,54 @@ def from_path(path):
 	return path
 
 
+# rows fetched at once when streaming results
+FETCH_SIZE = 1000
+
+
+def fetch_rows(cursor, size=FETCH_SIZE):
+	# stream rows of cursor, without materializing the whole result
+	while True:
+		rows = cursor.fetchmany(size)
+		if not rows:
+			return
+		yield from rows
+
+
+# stay well below SQLITE_MAX_VARIABLE_NUMBER, which is 999 on old sqlite versions
+CHUNK_SIZE = 500
+
+
+def chunked(items, size=CHUNK_SIZE):
+	items = list(items)
+	for start in range(0, len(items), size):
+		yield items[start:start + size]
+
+
+def _under(path):
+	# params for "file = ? OR (file >= ? AND file < ?)", matching path and
+	# files below it with an index range, since "0" follows "/"
+	return (path, path + '/', path + '0')
+
+
 class Db:
 	def __init__(self, multithread=False):
 		self.db = None
 		self.db_path = None
 		self.multithread = multithread
+		self._facets_cache = OrderedDict()
+		self._cooccurrence = None
+		# alias -> canonical tag, loaded on first use
+		self._aliases = None
+		# objects notified of tags changes, see _notify_file_tags
+		self.listeners = []
 
 	def open(self, path):
 		self.db_path = path
 		self.db = sqlite3.connect(path, check_same_thread=not self.multithread)
 
 	def close(self):
+		self._facets_cache.clear()
+		self._aliases = None
 		self.db_path = None
 		self.db.close()
 		self.db = None
@@ -43,15 +108,39 @@ class Db:
 	def __exit__(self, *args):
 		return self.db.__exit__(*args)
 
+	def invalidate_caches(self):
+		# after the db was modified by another connection
+		self._facets_cache.clear()
+		self._aliases = None
+		self._notify_invalidate()
+
+	def _notify_file_tags(self, path, old_tags, new_tags):
+		for listener in self.listeners:
+			listener.file_tags_changed(path, old_tags, new_tags)
+
+	def _notify_invalidate(self):
+		for listener in self.listeners:
+			listener.invalidate()
+
+	def get_cooccurrence(self):
+		if self._cooccurrence is None:
+			self._cooccurrence = Cooccurrence(self)
+			self.listeners.append(self._cooccurrence)
+		return self._cooccurrence
+
 	def remove_file(self, path):
 		LOGGER.info("untracking file %r", path)
 		path = from_path(path)
+		old_tags = self.find_tags_by_file(path) if self.listeners else None
 		self.db.execute('DELETE FROM tags_files WHERE file = ?', (path,))
 		self.db.execute('DELETE FROM caption WHERE file = ?', (path,))
+		if self.listeners:
+			self._notify_file_tags(path, old_tags, [])
 
 	def remove_tag(self, name):
 		LOGGER.info("untracking tag %r", name)
 		self.db.execute('DELETE FROM tags_files WHERE tag = ?', (name,))
+		self._notify_invalidate()
 
 	def rename_tag(self, old, new):
 		LOGGER.info("renaming tag %r to %r", old, new)
@@ -65,6 +154,135 @@ class Db:
 			self._set_caption_base(file, caption)
 
 		self.db.execute('UPDATE tags_files SET tag = ? WHERE tag = ?', (new, old))
+		self.db.execute('UPDATE tag_aliases SET tag = ? WHERE tag = ?', (new, old))
+		self._aliases = None
+
+		# the hierarchy of the old name doesn't apply, other implications are kept
+		parent = self._parent_tag(old)
+		if parent:
+			self.db.execute('DELETE FROM tag_relations WHERE tag = ? AND implied = ?', (old, parent))
+		self.db.execute('UPDATE OR IGNORE tag_relations SET tag = ? WHERE tag = ?', (new, old))
+		self.db.execute('UPDATE OR IGNORE tag_relations SET implied = ? WHERE implied = ?', (new, old))
+		self.db.execute('DELETE FROM tag_relations WHERE tag = ? OR implied = ? OR tag = implied', (old, old))
+		self.db.execute('DELETE FROM tag_closure')
+		self.db.execute(SQL_CLOSURE_REBUILD)
+		self._add_hierarchy(new)
+		self._notify_invalidate()
+
+	def _parent_tag(self, tag):
+		return tag.rpartition(HIERARCHY_SEP)[0].rstrip(HIERARCHY_SEP)
+
+	def _add_hierarchy(self, tag):
+		parent = self._parent_tag(tag)
+		while parent and self.add_tag_implication(tag, parent):
+			tag, parent = parent, self._parent_tag(parent)
+
+	def add_tag_implication(self, tag, implied):
+		# files tagged with tag will also be found when searching implied
+		cursor = self.db.execute(
+			'INSERT OR IGNORE INTO tag_relations (tag, implied) VALUES (?, ?)',
+			(tag, implied)
+		)
+		if not cursor.rowcount:
+			return False
+
+		LOGGER.info("tag %r now implies %r", tag, implied)
+		self.db.execute(SQL_CLOSURE_ADD_EDGE, (tag, tag, implied, implied))
+		return True
+
+	def remove_tag_implication(self, tag, implied):
+		LOGGER.info("tag %r does not imply %r anymore", tag, implied)
+		self.db.execute('DELETE FROM tag_relations WHERE tag = ? AND implied = ?', (tag, implied))
+		# removing paths from the closure is not trivial, rebuild it all
+		self.db.execute('DELETE FROM tag_closure')
+		self.db.execute(SQL_CLOSURE_REBUILD)
+
+	def list_tag_implications(self):
+		for row in self.db.execute('SELECT tag, implied FROM tag_relations'):
+			yield row[0], row[1]
+
+	@iter2list
+	def find_implied_tags(self, tag):
+		for row in self.db.execute('SELECT ancestor FROM tag_closure WHERE tag = ?', (tag,)):
+			yield row[0]
+
+	@property
+	def aliases(self):
+		if self._aliases is None:
+			self._aliases = dict(self.db.execute('SELECT alias, tag FROM tag_aliases'))
+		return self._aliases
+
+	def canonical_tag(self, tag):
+		return captiontools.canonical_tag(tag, self.aliases)
+
+	def _canonical_tags(self, tags):
+		if isinstance(tags, str):
+			tags = [tags]
+		aliases = self.aliases
+		if not aliases:
+			return list(tags)
+		return [aliases.get(tag, tag) for tag in tags]
+
+	def add_tag_aliases(self, tag, aliases):
+		"""Make aliases resolve to tag, and fold existing aliases usages into tag
+
+		Hashtags of aliases in captions are left as they were written on
+		purpose: captions are always parsed through the aliases, so they
+		keep matching tag, like aliases typed in captions afterwards.
+		"""
+		tag = self.canonical_tag(tag)
+		aliases = sorted(set(aliases) - {tag})
+		if not aliases:
+			return
+
+		LOGGER.info("tag %r now has aliases %r", tag, aliases)
+		for chunk in chunked(aliases):
+			items = ','.join('?' * len(chunk))
+			# aliases of aliases become aliases of the canonical tag
+			self.db.execute('UPDATE tag_aliases SET tag = ? WHERE tag IN (%s)' % items, [tag, *chunk])
+			self.db.executemany(
+				'INSERT OR REPLACE INTO tag_aliases (alias, tag) VALUES (?, ?)',
+				[(alias, tag) for alias in chunk]
+			)
+
+			# rows already existing for tag are left for the alias, then deleted
+			self.db.execute('UPDATE OR IGNORE tags_files SET tag = ? WHERE tag IN (%s)' % items, [tag, *chunk])
+			self.db.execute('DELETE FROM tags_files WHERE tag IN (%s)' % items, chunk)
+			self.db.execute(
+				'UPDATE OR IGNORE tag_relations SET tag = ? WHERE tag IN (%s)' % items, [tag, *chunk]
+			)
+			self.db.execute(
+				'UPDATE OR IGNORE tag_relations SET implied = ? WHERE implied IN (%s)' % items, [tag, *chunk]
+			)
+			self.db.execute(
+				'DELETE FROM tag_relations WHERE tag IN (%s) OR implied IN (%s)' % (items, items),
+				chunk * 2
+			)
+
+		# untimed rows are never conflicting, as NULLs are distinct in pk_tf
+		self.db.execute(
+			'''
+			DELETE FROM tags_files WHERE tag = ? AND id NOT IN (
+				SELECT MIN(id) FROM tags_files WHERE tag = ? GROUP BY file, start, end
+			)
+			''',
+			(tag, tag)
+		)
+		self.db.execute('DELETE FROM tag_relations WHERE tag = implied')
+		self.db.execute('DELETE FROM tag_closure')
+		self.db.execute(SQL_CLOSURE_REBUILD)
+
+		self._aliases = None
+		self._notify_invalidate()
+
+	def remove_tag_aliases(self, aliases):
+		LOGGER.info("removing aliases %r", aliases)
+		self.db.executemany('DELETE FROM tag_aliases WHERE alias = ?', [(alias,) for alias in aliases])
+		self._aliases = None
+
+	def list_tag_aliases(self):
+		for row in self.db.execute('SELECT alias, tag FROM tag_aliases ORDER BY tag, alias'):
+			yield row[0], row[1]
 
 	def rename_file(self, old, new):
 		LOGGER.info("renaming file %r to %r", old, new)
@@ -107,13 +325,19 @@ class Db:
 	def _tag_file_base(self, path, tags, start=None, end=None):
 		LOGGER.info("tagging file: %r + %r", path, tags)
 
-		if isinstance(tags, str):
-			tags = [tags]
+		tags = self._canonical_tags(tags)
 		path = from_path(path)
+		old_tags = self.find_tags_by_file(path) if self.listeners else None
 
 		for tag in tags:
-			self.db.execute('INSERT OR REPLACE INTO tags_files (file, tag, start, end) VALUES (?, ?, ?, ?)',
+			# replacing would delete the row without firing segments_delete, and change its id
+			self.db.execute('INSERT OR IGNORE INTO tags_files (file, tag, start, end) VALUES (?, ?, ?, ?)',
 					(path, tag, start, end))
+			if HIERARCHY_SEP in tag:
+				self._add_hierarchy(tag)
+
+		if self.listeners:
+			self._notify_file_tags(path, old_tags, set(old_tags) | set(tags))
 
 		self._update_caption(path)
 
@@ -124,22 +348,168 @@ class Db:
 	def _untag_file_base(self, path, tags):
 		LOGGER.info("untagging file: %r - %r", path, tags)
 
-		if isinstance(tags, str):
-			tags = [tags]
+		tags = self._canonical_tags(tags)
 		path = from_path(path)
+		old_tags = self.find_tags_by_file(path) if self.listeners else None
 
 		for tag in tags:
 			self.db.execute('DELETE FROM tags_files WHERE file = ? AND tag = ?',
 					(path, tag))
 
+		if self.listeners:
+			self._notify_file_tags(path, old_tags, set(old_tags) - set(tags))
+
 	untrack_file = remove_file
 
+	# bulk variants of the above, for many files at once
+	# listeners are not told which files changed, they are invalidated instead
+
+	def tag_files(self, items):
+		# items are (path, tag) pairs, tags are set without time range
+		aliases = self.aliases
+		items = [(from_path(path), aliases.get(tag, tag)) for path, tag in items]
+		if not items:
+			return
+		LOGGER.info("tagging %d files", len(items))
+
+		self.db.executemany(
+			'''
+			INSERT INTO tags_files (file, tag) SELECT ?1, ?2
+			WHERE NOT EXISTS (
+				SELECT 1 FROM tags_files WHERE tag = ?2 AND file = ?1 AND start IS NULL AND end IS NULL
+			)
+			''',
+			items
+		)
+		for tag in {tag for _, tag in items if HIERARCHY_SEP in tag}:
+			self._add_hierarchy(tag)
+
+		self._update_captions({path for path, _ in items})
+		self._notify_invalidate()
+
+	def untag_files(self, items):
+		# items are (path, tag) pairs
+		aliases = self.aliases
+		items = [(from_path(path), aliases.get(tag, tag)) for path, tag in items]
+		if not items:
+			return
+		LOGGER.info("untagging %d files", len(items))
+
+		self.db.executemany('DELETE FROM tags_files WHERE file = ? AND tag = ?', items)
+		self._update_captions({path for path, _ in items})
+		self._notify_invalidate()
+
+	def untrack_files(self, paths):
+		paths = [(from_path(path),) for path in paths]
+		if not paths:
+			return
+		LOGGER.info("untracking %d files", len(paths))
+
+		self.db.executemany('DELETE FROM tags_files WHERE file = ?', paths)
+		self.db.executemany('DELETE FROM caption WHERE file = ?', paths)
+		self._notify_invalidate()
+
+	def rename_files(self, pairs):
+		# pairs are (old, new) paths, renamed in order
+		pairs = [(from_path(new), from_path(old)) for old, new in pairs]
+		if not pairs:
+			return
+		LOGGER.info("renaming %d files", len(pairs))
+
+		self.db.executemany('UPDATE caption SET file = ? WHERE file = ?', pairs)
+		self.db.executemany('UPDATE tags_files SET file = ? WHERE file = ?', pairs)
+
+	def trash_files(self, pairs):
+		# pairs are (path, trashed) paths of files or folders sent to trash,
+		# their tags and captions are set aside until restore_trashed
+		pairs = [(from_path(path), from_path(trashed)) for path, trashed in pairs]
+		if not pairs:
+			return
+		LOGGER.info("trashing %d items", len(pairs))
+
+		# names of trashed items are reused once the trash is emptied
+		self.forget_trashed(trashed for _, trashed in pairs)
+		self.db.executemany(
+			'INSERT INTO trash (trashed, original) VALUES (?, ?)',
+			[(trashed, path) for path, trashed in pairs]
+		)
+		self.db.executemany(
+			'''
+			INSERT INTO trash_tags (trashed, subpath, tag, start, end)
+			SELECT ?, SUBSTRING(file, ?), tag, start, end FROM tags_files
+			WHERE file = ? OR (file >= ? AND file < ?)
+			''',
+			[(trashed, len(path) + 1, *_under(path)) for path, trashed in pairs]
+		)
+		self.db.executemany(
+			'''
+			INSERT INTO trash_captions (trashed, subpath, caption)
+			SELECT ?, SUBSTRING(file, ?), caption FROM caption
+			WHERE file = ? OR (file >= ? AND file < ?)
+			''',
+			[(trashed, len(path) + 1, *_under(path)) for path, trashed in pairs]
+		)
+		self.db.executemany(
+			'DELETE FROM tags_files WHERE file = ? OR (file >= ? AND file < ?)',
+			[_under(path) for path, _ in pairs]
+		)
+		self.db.executemany(
+			'DELETE FROM caption WHERE file = ? OR (file >= ? AND file < ?)',
+			[_under(path) for path, _ in pairs]
+		)
+		self._notify_invalidate()
+
+	def restore_trashed(self, pairs):
+		# pairs are (trashed, path), path being where the item was restored
+		pairs = [(from_path(trashed), from_path(path)) for trashed, path in pairs]
+		if not pairs:
+			return
+		LOGGER.info("restoring %d items", len(pairs))
+
+		self.db.executemany(
+			'''
+			INSERT OR IGNORE INTO tags_files (file, tag, start, end)
+			SELECT ?2 || subpath, tag, start, end FROM trash_tags WHERE trashed = ?1
+			''',
+			pairs
+		)
+		self.db.executemany(
+			'''
+			INSERT OR REPLACE INTO caption (file, caption)
+			SELECT ?2 || subpath, caption FROM trash_captions WHERE trashed = ?1
+			''',
+			pairs
+		)
+		self.forget_trashed(trashed for trashed, _ in pairs)
+		self._notify_invalidate()
+
+	def forget_trashed(self, trashed_paths):
+		# trashed items were deleted for good
+		trashed_paths = [(from_path(trashed),) for trashed in trashed_paths]
+		self.db.executemany('DELETE FROM trash WHERE trashed = ?', trashed_paths)
+		self.db.executemany('DELETE FROM trash_tags WHERE trashed = ?', trashed_paths)
+		self.db.executemany('DELETE FROM trash_captions WHERE trashed = ?', trashed_paths)
+
+	def list_trashed(self):
+		# (trashed, original) paths of items sent to trash
+		for row in fetch_rows(self.db.execute('SELECT trashed, original FROM trash ORDER BY rowid')):
+			yield row[0], row[1]
+
+	def find_trashed(self, path):
+		# path of the last item trashed from path, or None
+		for row in self.db.execute(
+			'SELECT trashed FROM trash WHERE original = ? ORDER BY rowid DESC LIMIT 1',
+			(from_path(path),)
+		):
+			return row[0]
+		return None
+
 	def list_tags(self):
-		for row in self.db.execute('SELECT DISTINCT tag FROM tags_files'):
+		for row in fetch_rows(self.db.execute('SELECT DISTINCT tag FROM tags_files')):
 			yield row[0]
 
 	def list_files(self):
-		for row in self.db.execute('SELECT DISTINCT file FROM tags_files'):
+		for row in fetch_rows(self.db.execute('SELECT DISTINCT file FROM tags_files')):
 			yield row[0]
 
 	@iter2list
@@ -148,16 +518,172 @@ class Db:
 		for row in self.db.execute('SELECT DISTINCT tag FROM tags_files WHERE file = ?', (path,)):
 			yield row[0]
 
-	@iter2list
-	def find_files_by_tags(self, tags):
-		if isinstance(tags, str):
-			tags = [tags]
+	def find_tags_by_files(self, paths):
+		# yield (path, tags) for each of paths, in the same order
+		for chunk in chunked(from_path(path) for path in paths):
+			items = ','.join('?' * len(chunk))
+			tags = {path: [] for path in chunk}
+			for path, tag in self.db.execute(
+				'SELECT DISTINCT file, tag FROM tags_files WHERE file IN (%s)' % items, chunk
+			):
+				tags[path].append(tag)
+			for path in chunk:
+				yield path, tags[path]
+
+	def _matching_files_query(self, tags):
+		# SQL selecting files having all tags, directly or through tags implying them
+		tags = list(dict.fromkeys(tags))
+		values = ', '.join(['(?)'] * len(tags))
 		items = ','.join('?' * len(tags))
-		params = list(tags) + [len(tags)]
-		for row in self.db.execute('SELECT file FROM tags_files WHERE tag IN (%s)'
-					   ' GROUP BY file HAVING COUNT(DISTINCT tag) = ?' % items, params):
+		sql = '''
+			SELECT file FROM tags_files JOIN (
+				SELECT column1 AS wanted, column1 AS tag FROM (VALUES %s)
+				UNION
+				SELECT ancestor, tag FROM tag_closure WHERE ancestor IN (%s)
+			) USING (tag)
+			GROUP BY file HAVING COUNT(DISTINCT wanted) = ?
+		''' % (values, items)
+		return sql, tags + tags + [len(tags)]
+
+	def find_files_by_tags(self, tags):
+		tags = self._canonical_tags(tags)
+		if not tags:
+			return
+		sql, params = self._matching_files_query(tags)
+		for row in fetch_rows(self.db.execute(sql, params)):
 			yield row[0]
 
+	def _state_key(self):
+		# changes whenever the db content changes, through this connection or another one
+		data_version = self.db.execute('PRAGMA data_version').fetchone()[0]
+		return (self.db.total_changes, data_version)
+
+	def facet_tags(self, tags):
+		# for files having all tags, count how many of them have each tag,
+		# directly or through an implied tag
+		# tags absent from all those files are not returned
+		tags = self._canonical_tags(tags)
+
+		key = (frozenset(tags), self._state_key())
+		try:
+			self._facets_cache.move_to_end(key)
+		except KeyError:
+			pass
+		else:
+			return dict(self._facets_cache[key])
+
+		if tags:
+			sql, params = self._matching_files_query(tags)
+			selected = 'SELECT file, tag FROM tags_files WHERE file IN (%s)' % sql
+		else:
+			selected = 'SELECT file, tag FROM tags_files'
+			params = []
+
+		cursor = self.db.execute(
+			'''
+			WITH selected AS (%s)
+			SELECT tag, COUNT(DISTINCT file) FROM (
+				SELECT file, tag FROM selected
+				UNION ALL
+				SELECT file, ancestor FROM selected JOIN tag_closure USING (tag)
+			)
+			GROUP BY tag
+			''' % selected,
+			params
+		)
+
+		result = dict(cursor)
+		self._facets_cache[key] = result
+		while len(self._facets_cache) > FACETS_CACHE_SIZE:
+			self._facets_cache.popitem(last=False)
+		return dict(result)
+
+	def count_tags_by_files(self, paths):
+		# for each tag, count how many of the files have it
+		counts = {}
+		for chunk in chunked(from_path(path) for path in paths):
+			items = ','.join('?' * len(chunk))
+			for tag, count in self.db.execute(
+				'SELECT tag, COUNT(DISTINCT file) FROM tags_files WHERE file IN (%s) GROUP BY tag' % items,
+				chunk,
+			):
+				counts[tag] = counts.get(tag, 0) + count
+		return counts
+
+	@iter2list
+	def find_segments(self, tag=None, at=None, overlapping=None, min_duration=None):
+		# find time-ranged tags (in milliseconds): at a given time, overlapping
+		# a (start, end) range, and/or lasting at least min_duration
+		conditions = []
+		params = []
+		if tag is not None:
+			tag = self.canonical_tag(tag)
+			conditions.append('tags_files.tag IN (SELECT ? UNION SELECT tag FROM tag_closure WHERE ancestor = ?)')
+			params += [tag, tag]
+		if at is not None:
+			overlapping = (at, at)
+		if overlapping is not None:
+			begin, end = overlapping
+			# segments is the index, but rtree coordinates may be rounded, so check exact values too
+			conditions.append('segments.start <= ? AND segments.end >= ?')
+			conditions.append('MIN(tags_files.start, tags_files.end) <= ? AND MAX(tags_files.start, tags_files.end) >= ?')
+			params += [end, begin, end, begin]
+		if min_duration is not None:
+			conditions.append('ABS(tags_files.end - tags_files.start) >= ?')
+			params.append(min_duration)
+
+		sql = '''
+			SELECT file, tag, MIN(tags_files.start, tags_files.end), MAX(tags_files.start, tags_files.end)
+			FROM segments JOIN tags_files ON tags_files.id = segments.id
+		'''
+		if conditions:
+			sql += ' WHERE ' + ' AND '.join(conditions)
+		sql += ' ORDER BY file, 3'
+
+		for row in self.db.execute(sql, params):
+			yield tuple(row)
+
+	@iter2list
+	def get_file_segments(self, path):
+		# all tags rows of a file, with their id and time range (None if not time-ranged)
+		path = from_path(path)
+		for row in self.db.execute(
+			'SELECT id, tag, start, end FROM tags_files WHERE file = ? ORDER BY start, tag', (path,)
+		):
+			yield tuple(row)
+
+	def update_file_segments(self, path, remove=(), add=()):
+		# remove tags rows by id, and add (tag, start, end) rows, returning their ids
+		LOGGER.info("updating file segments: %r - %r + %r", path, remove, add)
+		path = from_path(path)
+		old_tags = self.find_tags_by_file(path) if self.listeners else None
+
+		self.db.executemany('DELETE FROM tags_files WHERE id = ?', [(id,) for id in remove])
+
+		ids = []
+		for tag, start, end in add:
+			tag = self.canonical_tag(tag)
+			cursor = self.db.execute(
+				'INSERT OR IGNORE INTO tags_files (file, tag, start, end) VALUES (?, ?, ?, ?)',
+				(path, tag, start, end)
+			)
+			if cursor.rowcount:
+				ids.append(cursor.lastrowid)
+			else:
+				# already existing, it will be shared
+				ids.append(self.db.execute(
+					'SELECT id FROM tags_files WHERE file = ? AND tag = ? AND start IS ? AND end IS ?',
+					(path, tag, start, end)
+				).fetchone()[0])
+
+			if HIERARCHY_SEP in tag:
+				self._add_hierarchy(tag)
+
+		if self.listeners:
+			self._notify_file_tags(path, old_tags, self.find_tags_by_file(path))
+		self._update_caption(path)
+		return ids
+
 	@iter2list
 	def get_extras_for_file(self, path, tag):
 		path = from_path(path)
@@ -176,9 +702,21 @@ class Db:
 		if not caption:
 			return
 
-		caption = captiontools.tags_to_caption(self.find_tags_by_file(path), caption)
+		caption = captiontools.tags_to_caption(self.find_tags_by_file(path), caption, self.aliases)
 		self._set_caption_base(path, caption)
 
+	def _update_captions(self, paths):
+		# only files having a caption need an update
+		for chunk in chunked(paths):
+			items = ','.join('?' * len(chunk))
+			captioned = [
+				row[0] for row in self.db.execute(
+					"SELECT file FROM caption WHERE file IN (%s) AND caption != ''" % items, chunk
+				)
+			]
+			for path in captioned:
+				self._update_caption(path)
+
 	def set_caption(self, path, caption):
 		path = from_path(path)
 		if not caption or not caption.strip():
@@ -186,7 +724,7 @@ class Db:
 			self._set_caption_base(path, None)
 			return
 
-		target_tags = set(captiontools.extract_tags_from_caption(caption))
+		target_tags = set(captiontools.extract_tags_from_caption(caption, self.aliases))
 		current_tags = set(self.find_tags_by_file(path))
 
 		self._set_caption_base(path, caption)
@@ -211,12 +749,56 @@ class Db:
 			LOGGER.debug("database migration for version %r", ver)
 			with self.db:
 				for stmt in UPGRADES[ver]:
-					self.db.execute(stmt)
+					if callable(stmt):
+						stmt(self.db)
+					else:
+						self.db.execute(stmt)
 				self.db.execute('UPDATE version SET version = ?', (ver + 1,))
 
 
+def _create_segments_index(db):
+	# mirror time ranges of tags_files in an R*Tree, keyed by tags_files id
+	try:
+		db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS segments USING rtree(id, start, end)')
+	except sqlite3.OperationalError:
+		LOGGER.warning("sqlite has no rtree support, using a plain table for segments")
+		db.execute('CREATE TABLE IF NOT EXISTS segments (id INTEGER PRIMARY KEY, start, end)')
+		db.execute('CREATE INDEX IF NOT EXISTS idx_segments ON segments (start, end)')
+
+	# rtree requires start <= end, don't fail on reversed ranges
+	db.execute('''
+		CREATE TRIGGER IF NOT EXISTS segments_insert AFTER INSERT ON tags_files
+		WHEN NEW.start IS NOT NULL AND NEW.end IS NOT NULL
+		BEGIN
+			INSERT OR REPLACE INTO segments (id, start, end)
+			VALUES (NEW.id, MIN(NEW.start, NEW.end), MAX(NEW.start, NEW.end));
+		END
+	''')
+	db.execute('''
+		CREATE TRIGGER IF NOT EXISTS segments_delete AFTER DELETE ON tags_files
+		WHEN OLD.start IS NOT NULL AND OLD.end IS NOT NULL
+		BEGIN
+			DELETE FROM segments WHERE id = OLD.id;
+		END
+	''')
+	db.execute('''
+		CREATE TRIGGER IF NOT EXISTS segments_update AFTER UPDATE OF start, end ON tags_files
+		BEGIN
+			DELETE FROM segments WHERE id = OLD.id;
+			INSERT INTO segments (id, start, end)
+			SELECT NEW.id, MIN(NEW.start, NEW.end), MAX(NEW.start, NEW.end)
+			WHERE NEW.start IS NOT NULL AND NEW.end IS NOT NULL;
+		END
+	''')
+	db.execute('''
+		INSERT OR REPLACE INTO segments (id, start, end)
+		SELECT id, MIN(start, end), MAX(start, end) FROM tags_files
+		WHERE start IS NOT NULL AND end IS NOT NULL
+	''')
+
+
 # key: version to reach from preceding version
-# value: list of statements to execute
+# value: list of statements to execute, or functions taking the sqlite connection
 
 UPGRADES = {
 	0: [
@@ -233,4 +815,74 @@ UPGRADES = {
 	1: [
 		"CREATE TABLE IF NOT EXISTS caption (file TEXT PRIMARY KEY, caption TEXT)",
 	],
+	2: [
+		# covering index for tag -> files lookups, supersedes idx_tags
+		'CREATE INDEX IF NOT EXISTS idx_tags_files ON tags_files (tag, file)',
+		'DROP INDEX IF EXISTS idx_tags',
+	],
+	3: [
+		# explicit implications, like "cat" implies "animal", or "animal/cat" implies "animal"
+		'''
+		CREATE TABLE IF NOT EXISTS tag_relations (
+			tag TEXT NOT NULL, implied TEXT NOT NULL,
+			PRIMARY KEY (tag, implied)
+		)
+		''',
+		# transitive closure of tag_relations, maintained by Db
+		'''
+		CREATE TABLE IF NOT EXISTS tag_closure (
+			tag TEXT NOT NULL, ancestor TEXT NOT NULL,
+			PRIMARY KEY (tag, ancestor)
+		)
+		''',
+		'CREATE INDEX IF NOT EXISTS idx_closure_ancestor ON tag_closure (ancestor, tag)',
+		# hierarchy of existing "a/b/c" tags: "a/b/c" implies "a/b" which implies "a"
+		'''
+		INSERT OR IGNORE INTO tag_relations (tag, implied)
+		WITH RECURSIVE parents(child, parent) AS (
+			SELECT DISTINCT tag, rtrim(rtrim(tag, replace(tag, '/', '')), '/')
+			FROM tags_files WHERE instr(tag, '/')
+			UNION
+			SELECT parent, rtrim(rtrim(parent, replace(parent, '/', '')), '/')
+			FROM parents WHERE instr(parent, '/')
+		)
+		SELECT child, parent FROM parents WHERE parent != ''
+		''',
+		SQL_CLOSURE_REBUILD,
+	],
+	4: [
+		# alias -> canonical tag, like "kitty" -> "cat"
+		'CREATE TABLE IF NOT EXISTS tag_aliases (alias TEXT PRIMARY KEY, tag TEXT NOT NULL)',
+		'CREATE INDEX IF NOT EXISTS idx_aliases_tag ON tag_aliases (tag)',
+	],
+	5: [
+		# give tags_files an explicit id, unlike implicit rowids it is kept by VACUUM
+		'''
+		CREATE TABLE tags_files_new (
+			id INTEGER PRIMARY KEY,
+			file, tag, start, end,
+			CONSTRAINT pk_tf UNIQUE (file, tag, start, end)
+		)
+		''',
+		'INSERT INTO tags_files_new (id, file, tag, start, end) SELECT rowid, file, tag, start, end FROM tags_files',
+		'DROP TABLE tags_files',
+		'ALTER TABLE tags_files_new RENAME TO tags_files',
+		'CREATE INDEX IF NOT EXISTS idx_files ON tags_files (file)',
+		'CREATE INDEX IF NOT EXISTS idx_tags_files ON tags_files (tag, file)',
+		_create_segments_index,
+	],
+	6: [
+		# file lookups can use the pk_tf index, which starts with file
+		'DROP INDEX IF EXISTS idx_files',
+	],
+	7: [
+		# items sent to the XDG trash, and tags/captions of their files
+		# relative to them, kept until they are restored or deleted
+		'CREATE TABLE IF NOT EXISTS trash (trashed TEXT PRIMARY KEY, original TEXT NOT NULL)',
+		'CREATE INDEX IF NOT EXISTS idx_trash_original ON trash (original)',
+		'CREATE TABLE IF NOT EXISTS trash_tags (trashed TEXT NOT NULL, subpath TEXT NOT NULL, tag, start, end)',
+		'CREATE INDEX IF NOT EXISTS idx_trash_tags ON trash_tags (trashed)',
+		'CREATE TABLE IF NOT EXISTS trash_captions (trashed TEXT NOT NULL, subpath TEXT NOT NULL, caption TEXT)',
+		'CREATE INDEX IF NOT EXISTS idx_trash_captions ON trash_captions (trashed)',
+	],
 }
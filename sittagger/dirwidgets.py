@@ -9,8 +9,8 @@ from PyQt6.QtWidgets import (
 	QMessageBox, QHeaderView,
 )
 
-from .fileoperationdialog import FileOperationProgressDialog
-from .fsops import rename_folder, FileOperation, trash_items, can_trash
+from .fileoperationdialog import FileOperation, start_file_operation
+from .fsops import is_cross_device, rename_folder, trash_items
 from .fm_interop import ClipQt, get_files_clipboard, MIME_LIST, _parse_url
 
 
@@ -161,7 +161,11 @@ class DirTreeView(QTreeView):
 
 		new = current.with_name(new)
 
-		rename_folder(current, new, db)
+		if is_cross_device(current, new):
+			# data has to be copied, show progress
+			start_file_operation(self, FileOperation(new, [current], "cut", db))
+		else:
+			rename_folder(current, new, db)
 		self.selectPath(str(new))
 
 	def pasteFiles(self):
@@ -171,31 +175,16 @@ class DirTreeView(QTreeView):
 
 		assert op in ("copy", "cut")
 
-		treeop = FileOperation(target, files, op, self.window().db)
-		dlg = FileOperationProgressDialog(self)
-		treeop.setParent(dlg)
-		dlg.setOp(treeop)
-		dlg.start()
+		start_file_operation(self, FileOperation(target, files, op, self.window().db))
 
 	@Slot(FileOperation)
 	def modelFileOperation(self, treeop):
 		treeop.db = self.window().db
-		dlg = FileOperationProgressDialog(self)
-		dlg.setOp(treeop)
-		dlg.setModal(True)
-		treeop.setParent(dlg)
-		dlg.start()
+		start_file_operation(self, treeop)
 
 	@Slot()
 	def _trashFolder(self):
 		current = Path(self.selectedPath()).absolute()
-		if not can_trash():
-			QMessageBox.error(
-				self,
-				self.tr("Trash error"),
-				self.tr("trash-put is not installed, cannot trash files"),
-			)
-			return
 
 		button = QMessageBox.question(
 			self,
@@ -205,7 +194,14 @@ class DirTreeView(QTreeView):
 		if button != QMessageBox.StandardButton.Yes:
 			return
 
-		trash_items([current])
+		try:
+			trash_items([current], self.window().db)
+		except OSError as exc:
+			QMessageBox.critical(
+				self,
+				self.tr("Trash error"),
+				self.tr("Cannot send %s to trash: %s") % (current, exc),
+			)
 
 	@Slot()
 	def _createFolder(self):
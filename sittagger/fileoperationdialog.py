@@ -1,7 +1,72 @@
 # SPDX-License-Identifier: WTFPL
 
-from PyQt6.QtCore import pyqtSlot as Slot
-from PyQt6.QtWidgets import QProgressDialog
+from logging import getLogger
+
+from PyQt6.QtCore import QElapsedTimer, QThread, pyqtSignal as Signal, pyqtSlot as Slot
+from PyQt6.QtWidgets import QMessageBox, QProgressDialog
+
+from .fsops import Transfer
+
+
+LOGGER = getLogger(__name__)
+
+
+class FileOperation(QThread):
+	"""Long copy/cut files/trees operation, running a fsops.Transfer in a thread
+
+	Emits progress information of the whole operation, at most
+	fsops.PROGRESS_INTERVAL: current file, bytes done and total, files done
+	and total. `failed` is emitted with the error message if the operation
+	fails, before `finished`.
+	"""
+
+	# sizes may not fit in 32 bits
+	processing = Signal(str, 'qint64', 'qint64', int, int)
+
+	failed = Signal(str)
+
+	def __init__(self, dest, sources, op, db):
+		super().__init__()
+		self.transfer = Transfer(dest, sources, op, db, progress=self.processing.emit)
+
+	@property
+	def db(self):
+		return self.transfer.db
+
+	@db.setter
+	def db(self, db):
+		# drag-and-drop operations are created by models, which don't know the db
+		self.transfer.db = db
+
+	def run(self):
+		try:
+			self.transfer.run()
+		except OSError as exc:
+			# destination already existing, or copy differing from source for example
+			LOGGER.exception("file operation failed")
+			self.failed.emit(str(exc))
+
+	@Slot()
+	def cancel(self):
+		self.transfer.cancel()
+
+
+def format_size(size):
+	for unit in ('B', 'KiB', 'MiB', 'GiB'):
+		if size < 1024:
+			break
+		size /= 1024
+	else:
+		unit = 'TiB'
+	return '%.1f %s' % (size, unit) if unit != 'B' else '%d B' % size
+
+
+def format_duration(seconds):
+	minutes, seconds = divmod(int(seconds), 60)
+	hours, minutes = divmod(minutes, 60)
+	if hours:
+		return '%d:%02d:%02d' % (hours, minutes, seconds)
+	return '%d:%02d' % (minutes, seconds)
 
 
 class FileOperationProgressDialog(QProgressDialog):
@@ -13,20 +78,55 @@ class FileOperationProgressDialog(QProgressDialog):
 		self.setModal(True)
 		self.finished.connect(self.deleteLater)
 		self.op = None
+		self.error = None
+		self.elapsed = QElapsedTimer()
 
 	def setOp(self, op):
 		self.op = op
 		self.op.processing.connect(self.onProgress)
+		self.op.failed.connect(self.onFailed)
 		self.op.started.connect(self.exec)
-		self.op.finished.connect(self.accept)
+		self.op.finished.connect(self.onFinished)
 		self.canceled.connect(self.op.cancel)
 
-	@Slot(str, int, int)
-	def onProgress(self, name, current, total):
-		self.setLabelText(name)
-		self.setValue(current * 100 // total)
+	@Slot(str)
+	def onFailed(self, message):
+		# shown once finished, the dialog is deleted when closed
+		self.error = message
+
+	@Slot()
+	def onFinished(self):
+		# also called by showEvent, don't show the error twice
+		error, self.error = self.error, None
+		if error:
+			QMessageBox.critical(self, self.tr("Error"), self.tr("File operation failed: %s") % error)
+		self.accept()
+
+	@Slot(str, 'qint64', 'qint64', int, int)
+	def onProgress(self, name, done_bytes, total_bytes, done_files, total_files):
+		lines = [
+			name,
+			self.tr("%d of %d files") % (done_files, total_files),
+		]
+
+		if total_bytes:
+			self.setValue(done_bytes * 100 // total_bytes)
+
+			seconds = self.elapsed.elapsed() / 1000
+			lines.append(self.tr("%s of %s") % (format_size(done_bytes), format_size(total_bytes)))
+			if done_bytes and seconds >= 1:
+				# average since the start, more stable than instant throughput
+				speed = done_bytes / seconds
+				lines.append(self.tr("%s/s, %s left") % (
+					format_size(speed), format_duration((total_bytes - done_bytes) / speed)
+				))
+		elif total_files:
+			self.setValue(done_files * 100 // total_files)
+
+		self.setLabelText("\n".join(lines))
 
 	def start(self):
+		self.elapsed.start()
 		self.show()
 		self.open()
 		self.op.start()
@@ -34,4 +134,13 @@ class FileOperationProgressDialog(QProgressDialog):
 	def showEvent(self, ev):
 		super().showEvent(ev)
 		if self.op.isFinished():
-			self.accept()
+			self.onFinished()
+
+
+def start_file_operation(parent, op):
+	"""Start op, showing its progress in a modal dialog owning it"""
+	dlg = FileOperationProgressDialog(parent)
+	op.setParent(dlg)
+	dlg.setOp(op)
+	dlg.start()
+	return dlg
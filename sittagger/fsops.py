@@ -1,14 +1,38 @@
 # SPDX-License-Identifier: WTFPL
 
+"""Files operations keeping tags and thumbnails, without Qt
+
+This module is shared by the GUI (see fileoperationdialog.FileOperation)
+and the CLI, so it must not import PyQt. vignette probes PyQt when
+imported, so it is only imported by functions handling thumbnails.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import errno
+from functools import partial
+import glob
+import hashlib
+from itertools import groupby
+import json
 from logging import getLogger
 import os
 from pathlib import Path
 import shutil
-import subprocess
-from threading import Event
+import stat
+import struct
+import tempfile
+from threading import Condition, Event, Lock, Thread
+import time
+from urllib.parse import quote, unquote_to_bytes
+import zlib
 
-from PyQt6.QtCore import QThread, pyqtSignal as Signal, pyqtSlot as Slot
-import vignette
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+from .dbtag import chunked, from_path
 
 
 LOGGER = getLogger(__name__)
@@ -28,25 +52,12 @@ def _get_dev(path):
 	return path.lstat().st_dev
 
 
-def _rename_with_thumb(src, dst):
-	if src.startswith(vignette._thumb_path_prefix()):
-		return _os_rename(src, dst)
-
-	tsrc = vignette.try_get_thumbnail(src, 'large')
-	if not tsrc:
-		return _os_rename(src, dst)
-
-	ret = _os_rename(src, dst)
-
-	vignette.put_thumbnail(dst, 'large', tsrc)
-
-	return ret
-
-
 THUMB_SIZES = ("normal", "large")
 
 
 def _pre_copy_thumb(src):
+	import vignette
+
 	if isinstance(src, Path):
 		src = str(src)
 
@@ -63,6 +74,8 @@ def _pre_copy_thumb(src):
 
 
 def _post_copy_thumb(thumbs, dst):
+	import vignette
+
 	if thumbs is None:
 		return
 
@@ -74,142 +87,724 @@ def _post_copy_thumb(thumbs, dst):
 		vignette.put_thumbnail(dst, sz, tsrc)
 
 
-def rename_file(old, new, db):
-	old = Path(old).absolute()
-	new = Path(new).absolute()
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
 
-	if _get_dev(old) != _get_dev(new.parent):
-		raise NotImplementedError()
+# PNG chunks holding a "keyword\0..." text
+_PNG_TEXT_CHUNKS = {b'tEXt', b'zTXt', b'iTXt'}
 
-	thumbs = _call_log_exc(_pre_copy_thumb, old)
+# renamed files whose thumbnails a worker handles at once
+THUMB_CHUNK_SIZE = 256
 
-	_os_rename(str(old), str(new))
-	with db:
-		db.rename_file(str(old), str(new))
+# threads moving thumbnails
+THUMB_WORKERS = 8
+
+
+def _png_chunk(ctype, data):
+	return struct.pack('>I', len(data)) + ctype + data + struct.pack('>I', zlib.crc32(ctype + data))
+
+
+def _set_png_text(png, key, value):
+	# png data with text `key` set to `value`, without decoding the image
+	if not png.startswith(PNG_SIGNATURE):
+		raise ValueError('not a PNG file')
+
+	key = key.encode('latin-1')
+	parts = [PNG_SIGNATURE]
+	pos = len(PNG_SIGNATURE)
+	while pos < len(png):
+		length, ctype = struct.unpack_from('>I4s', png, pos)
+		end = pos + 12 + length
+		if ctype in _PNG_TEXT_CHUNKS and png[pos + 8:end - 4].split(b'\0', 1)[0] == key:
+			# replaced by a tEXt chunk before IEND
+			pass
+		elif ctype == b'IEND':
+			parts.append(_png_chunk(b'tEXt', key + b'\0' + value.encode('latin-1')))
+			parts.append(png[pos:end])
+			return b''.join(parts)
+		else:
+			parts.append(png[pos:end])
+		pos = end
+
+	raise ValueError('truncated PNG file')
 
-	_call_log_exc(_post_copy_thumb, thumbs, new)
 
+def _real_path(path):
+	# symlinks resolved like vignette does, but path may not exist anymore
+	path = os.path.abspath(path)
+	return os.path.join(os.path.realpath(os.path.dirname(path)), os.path.basename(path))
 
-def _scan_thumbs(path):
-	ret = {}
-	for sub in path.rglob('*'):
-		if not sub.is_file():
+
+def _thumb_listing(prefix):
+	# size -> names of the thumbnails of that size
+	result = {}
+	for size in THUMB_SIZES:
+		try:
+			result[size] = set(os.listdir(os.path.join(prefix, size)))
+		except FileNotFoundError:
+			result[size] = set()
+	return result
+
+
+def _renamed_files(renames):
+	# (old, new) paths of each file of renames, after they were done on disk
+	for kind, old, new in renames:
+		old = _real_path(old)
+		new = _real_path(new)
+		if kind == 'file':
+			yield old, new
+			continue
+
+		for root, _, names in os.walk(new):
+			old_root = old + root[len(new):]
+			for name in names:
+				yield os.path.join(old_root, name), os.path.join(root, name)
+
+
+def _move_thumbnail(old_thumb, new_thumb, new_uri):
+	with open(old_thumb, 'rb') as fd:
+		png = _set_png_text(fd.read(), 'Thumb::URI', new_uri)
+
+	fd, tmp = tempfile.mkstemp(suffix='.png', dir=os.path.dirname(new_thumb))
+	with os.fdopen(fd, 'wb') as fout:
+		fout.write(png)
+	os.replace(tmp, new_thumb)
+	os.unlink(old_thumb)
+
+
+def _move_thumbnails_chunk(prefix, listing, pairs):
+	import vignette
+
+	moved = 0
+	for old, new in pairs:
+		name = '%s.png' % vignette.hash_name(old)
+		sizes = [size for size in THUMB_SIZES if name in listing[size]]
+		if not sizes:
 			continue
 
-		thumb = vignette.try_get_thumbnail(str(sub), 'large')
-		if thumb:
-			ret[sub.lstat().st_ino] = thumb
+		new_name = '%s.png' % vignette.hash_name(new)
+		new_uri = vignette._any2uri(new)
+		for size in sizes:
+			try:
+				_move_thumbnail(
+					os.path.join(prefix, size, name), os.path.join(prefix, size, new_name), new_uri,
+				)
+			except (OSError, ValueError) as exc:
+				LOGGER.info("cannot move %s thumbnail of %r: %s", size, old, exc)
+			else:
+				moved += 1
+	return moved
 
-	return ret
 
+def move_thumbnails(renames, workers=THUMB_WORKERS):
+	"""Move cached thumbnails of renames done on disk, return how many were moved
 
-def _restore_thumbs(path, inodes):
-	for sub in path.rglob('*'):
-		thumb = inodes.get(sub.lstat().st_ino)
-		if thumb:
-			vignette.put_thumbnail(str(sub), 'large', thumb)
+	renames are ("file" or "folder", old, new) tuples, like MoveJournal's.
+	Thumbnails of all THUMB_SIZES are renamed to the new names and their
+	Thumb::URI is rewritten, without decoding them. Thumbnails directories
+	are listed once, so only files having a thumbnail cost more than their
+	name hash. Since files keep their mtime, thumbnails stay valid.
+	"""
+	import vignette
+
+	prefix = vignette._thumb_path_prefix()
+	listing = _thumb_listing(prefix)
+	if not any(listing.values()):
+		return 0
+
+	renames = [rename for rename in renames if not str(rename[1]).startswith(prefix)]
+	with ThreadPoolExecutor(workers) as executor:
+		futures = [
+			executor.submit(_move_thumbnails_chunk, prefix, listing, chunk)
+			for chunk in chunked(_renamed_files(renames), THUMB_CHUNK_SIZE)
+		]
+		return sum(future.result() for future in futures)
+
+
+def is_cross_device(old, new):
+	# renaming old to new requires copying data
+	return _get_dev(Path(old)) != _get_dev(Path(new).absolute().parent)
+
+
+def rename_file(old, new, db):
+	old = Path(old).absolute()
+	new = Path(new).absolute()
+
+	if is_cross_device(old, new):
+		# see FileOperation for a progress report
+		Transfer(new, [old], "cut", db).run()
+		return
+
+	_os_rename(str(old), str(new))
+	with db:
+		db.rename_file(str(old), str(new))
+
+	_call_log_exc(move_thumbnails, [('file', old, new)])
 
 
 def rename_folder(old, new, db):
 	old = Path(old).absolute()
 	new = Path(new).absolute()
 
-	if _get_dev(old) != _get_dev(new.parent):
-		raise NotImplementedError()
+	if is_cross_device(old, new):
+		Transfer(new, [old], "cut", db).run()
+		return
 
-	inodes = _scan_thumbs(old)
 	_os_rename(old, new)
-	_restore_thumbs(new, inodes)
 	with db:
 		db.rename_folder(str(old), str(new))
 
+	_call_log_exc(move_thumbnails, [('folder', old, new)])
+
+
+# journal files are named after the database, plus this and a unique suffix
+JOURNAL_INFIX = '-moves-'
+JOURNAL_TMP_INFIX = '-moving-'
+
+
+def _lock(fd):
+	# exclusive lock, released when closed or when the process dies
+	if fcntl is None:
+		return True
+	try:
+		fcntl.flock(fd.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except OSError:
+		return False
+	return True
+
+
+def _apply_renames(db, renames):
+	# renames are (kind, old, new), consecutive files are renamed in bulk
+	for kind, group in groupby(renames, key=lambda rename: rename[0]):
+		if kind == 'file':
+			db.rename_files([(old, new) for _, old, new in group])
+		else:
+			for _, old, new in group:
+				db.rename_folder(old, new)
+
+
+class MoveJournal:
+	"""Renames done on disk, applied to the db in a single transaction
+
+	Moving a tree file by file would otherwise commit once per file.
+	Thumbnails are then moved in bulk, see move_thumbnails. Renames are
+	also appended to a journal file next to the database, so
+	if the process dies before `commit()`, they are applied by
+	`replay_journals` the next time the database is opened.
+	"""
+
+	def __init__(self, db):
+		self.db = db
+		self.renames = []
+		self.path = None
+		self._fd = None
+
+		if db.db_path and str(db.db_path) != ':memory:':
+			db_path = os.path.abspath(db.db_path)
+			# not matched by replay_journals until locked
+			prefix = os.path.basename(db_path) + JOURNAL_TMP_INFIX
+			fd, tmp_path = tempfile.mkstemp(prefix=prefix, dir=os.path.dirname(db_path))
+			self._fd = os.fdopen(fd, 'w', encoding='utf-8')
+			# tell replay_journals the move is still running
+			_lock(self._fd)
+
+			# unique as the temporary name is
+			self.path = db_path + JOURNAL_INFIX + os.path.basename(tmp_path)[len(prefix):]
+			os.rename(tmp_path, self.path)
+
+	def _record(self, kind, old, new):
+		rename = (kind, from_path(old), from_path(new))
+		self.renames.append(rename)
+		if self._fd:
+			# flushed so it survives a crash of the process
+			self._fd.write(json.dumps(rename) + '\n')
+			self._fd.flush()
+
+	def file_renamed(self, old, new):
+		self._record('file', old, new)
+
+	def folder_renamed(self, old, new):
+		self._record('folder', old, new)
+
+	def close(self):
+		# keep the journal file for replay
+		if self._fd:
+			self._fd.close()
+			self._fd = None
+
+	def commit(self):
+		try:
+			with self.db:
+				_apply_renames(self.db, self.renames)
+		finally:
+			self.close()
+
+		renames, self.renames = self.renames, []
+		if self.path:
+			os.unlink(self.path)
+			self.path = None
+
+		_call_log_exc(move_thumbnails, renames)
+
+
+def _read_journal(fd):
+	for line in fd:
+		try:
+			kind, old, new = json.loads(line)
+		except ValueError:
+			# partially written when the process died
+			LOGGER.warning("ignoring truncated journal line %r", line)
+			continue
+		yield kind, old, new
+
+
+def replay_journals(db):
+	"""Apply renames of moves interrupted before updating the db"""
+	if not db.db_path or str(db.db_path) == ':memory:':
+		return
+
+	pattern = glob.escape(os.path.abspath(db.db_path)) + JOURNAL_INFIX + '*'
+	for path in glob.glob(pattern):
+		with open(path, encoding='utf-8') as fd:
+			if not _lock(fd):
+				# the move is still running
+				continue
+
+			renames = list(_read_journal(fd))
+			LOGGER.warning("replaying %d renames from %r", len(renames), path)
+			with db:
+				_apply_renames(db, renames)
+			os.unlink(path)
+
+
+# ioctl making a file share the data blocks of another one, from linux/fs.h
+FICLONE = 0x40049409
+
+# bytes copied by the kernel between cancellation checks
+KERNEL_COPY_SIZE = 16 * 1024 * 1024
+
+# in-kernel copy is not possible, but copying through userspace may work
+_KERNEL_COPY_UNSUPPORTED = {
+	errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF, errno.EPERM,
+}
+
+
+def _reflink(fsrc, fdst):
+	# instant copy-on-write copy, on btrfs or XFS for example
+	if fcntl is None:
+		return False
+	try:
+		fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+	except OSError as exc:
+		LOGGER.debug("cannot reflink %r: %s", fsrc.name, exc)
+		return False
+	return True
+
+
+def _kernel_copy(copy_chunk, fsrc, fdst):
+	# yield bytes copied so far, return False if the kernel can't copy those files
+	copied = 0
+	while True:
+		try:
+			size = copy_chunk(fsrc.fileno(), fdst.fileno(), KERNEL_COPY_SIZE)
+		except OSError as exc:
+			if not copied and exc.errno in _KERNEL_COPY_UNSUPPORTED:
+				LOGGER.debug("cannot copy %r with %s: %s", fsrc.name, copy_chunk.__name__, exc)
+				return False
+			raise
+
+		if not size:
+			return True
+		copied += size
+		yield copied
+
+
+def _copy_file_range(infd, outfd, count):
+	return os.copy_file_range(infd, outfd, count)
+
+
+def _sendfile(infd, outfd, count):
+	return os.sendfile(outfd, infd, None, count)
+
+
+def _userspace_copy(fsrc, fdst, digest=None):
+	copied = 0
+	while True:
+		buf = fsrc.read(shutil.COPY_BUFSIZE if digest is None else CHECKSUM_BUFSIZE)
+		if not buf:
+			return True
+		if digest is not None:
+			digest.update(buf)
+		fdst.write(buf)
+		copied += len(buf)
+		yield copied
+
+
+def copy_data(fsrc, fdst):
+	"""Copy content of fsrc to fdst, yielding the number of bytes copied so far
+
+	The fastest method available is used: a reflink, sharing data blocks
+	between files, then in-kernel copy with copy_file_range or sendfile,
+	then copying through userspace buffers. Stop iterating to interrupt the
+	copy.
+	"""
+	if _reflink(fsrc, fdst):
+		yield os.fstat(fsrc.fileno()).st_size
+		return
+
+	methods = []
+	if hasattr(os, 'copy_file_range'):
+		methods.append(partial(_kernel_copy, _copy_file_range))
+	if hasattr(os, 'sendfile'):
+		methods.append(partial(_kernel_copy, _sendfile))
+	methods.append(_userspace_copy)
+
+	for method in methods:
+		if (yield from method(fsrc, fdst)):
+			return
+
+
+# hash of data copied to another device, checked before deleting the source
+CHECKSUM = 'blake2b'
+
+# bigger buffers let hashlib release the GIL longer
+CHECKSUM_BUFSIZE = 1024 * 1024
+
+
+class ChecksumError(OSError):
+	pass
+
+
+def _file_digest(path):
+	# digest of the data on disk, not of the page cache
+	with open(path, 'rb') as fd:
+		if hasattr(os, 'posix_fadvise'):
+			os.posix_fadvise(fd.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+		digest = hashlib.new(CHECKSUM)
+		while True:
+			buf = fd.read(CHECKSUM_BUFSIZE)
+			if not buf:
+				return digest.digest()
+			digest.update(buf)
+
+
+def _remove(path):
+	if os.path.isdir(path) and not os.path.islink(path):
+		shutil.rmtree(path)
+	else:
+		os.unlink(path)
+
+
+def tree_size(path):
+	# total size and number of files in path, recursively
+	size = 0
+	files = 0
+	stack = [path]
+	while stack:
+		try:
+			with os.scandir(stack.pop()) as it:
+				for entry in it:
+					if entry.is_dir(follow_symlinks=False):
+						stack.append(entry.path)
+					else:
+						size += entry.stat(follow_symlinks=False).st_size
+						files += 1
+		except NotADirectoryError:
+			return os.lstat(path).st_size, 1
+	return size, files
+
+
+# minimum delay between progress reports, in seconds
+PROGRESS_INTERVAL = 1 / 30
+
+# threads copying files
+COPY_WORKERS = 8
+
+# concurrent copies reading or writing a non-rotational device
+DEVICE_CONCURRENCY = 4
+
+
+def _is_rotational(dev):
+	# hard disks are slowed down by seeking between concurrent copies
+	base = '/sys/dev/block/%d:%d' % (os.major(dev), os.minor(dev))
+	# partitions don't have a queue, their disk has
+	for path in (base + '/queue/rotational', base + '/../queue/rotational'):
+		try:
+			with open(path) as fd:
+				return fd.read().strip() == '1'
+		except OSError:
+			pass
+	return False
+
+
+class CopyScheduler:
+	"""Run copy jobs in a pool of threads, limiting concurrent copies per device
+
+	A job is a (src, dst, devices) tuple, devices being the st_dev of the
+	source and destination. A device is used by at most DEVICE_CONCURRENCY
+	jobs at once, or 1 for a rotational disk.
+	"""
+
+	def __init__(self, copy, workers=COPY_WORKERS, cancelled=None):
+		self.copy = copy
+		self.workers = workers
+		self.cancelled = cancelled or Event()
+
+		self.cond = Condition()
+		self.capacities = {}
+		self.used = {}
+		# jobs of the same devices are queued together
+		self.pending = {}
+		self.errors = []
+
+	def _capacity(self, dev):
+		try:
+			return self.capacities[dev]
+		except KeyError:
+			pass
+		result = self.capacities[dev] = 1 if _is_rotational(dev) else DEVICE_CONCURRENCY
+		return result
+
+	def _pick(self):
+		# next job whose devices are available, with the condition held
+		for devices, jobs in self.pending.items():
+			if all(self.used.get(dev, 0) < self._capacity(dev) for dev in devices):
+				job = jobs.popleft()
+				if not jobs:
+					del self.pending[devices]
+				for dev in devices:
+					self.used[dev] = self.used.get(dev, 0) + 1
+				return job
+		return None
+
+	def _release(self, devices):
+		with self.cond:
+			for dev in devices:
+				self.used[dev] -= 1
+			self.cond.notify_all()
+
+	def _work(self):
+		while True:
+			with self.cond:
+				job = None
+				while job is None:
+					if not self.pending or self.errors or self.cancelled.is_set():
+						self.cond.notify_all()
+						return
+					job = self._pick()
+					if job is None:
+						self.cond.wait()
+
+			src, dst, devices = job
+			try:
+				self.copy(src, dst)
+			except BaseException as exc:
+				with self.cond:
+					self.errors.append(exc)
+			finally:
+				self._release(devices)
+
+	def run(self, jobs):
+		"""Copy all jobs, raise the first error if a copy failed"""
+		for job in jobs:
+			self.pending.setdefault(frozenset(job[2]), deque()).append(job)
+
+		threads = [Thread(target=self._work) for _ in range(min(self.workers, len(jobs)))]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		if self.errors:
+			raise self.errors[0]
+
 
 class Cancelled(Exception):
 	pass
 
 
-class FileOperation(QThread):
+class Transfer:
 	"""Long copy/cut files/trees operation
 
-	Emits progress information for current file, not the whole tree.
+	Sources are copied or moved into dest directory. If dest is not a
+	directory, the only source is copied or moved to dest itself.
+	`progress(path, done_bytes, total_bytes, done_files, total_files)` is
+	called with progress of the whole operation, at most every
+	PROGRESS_INTERVAL. Moves within a device count as files, not bytes,
+	since no data is copied. `cancel()` can be called from another thread.
+
+	Moves update the db in a single transaction at the end, see
+	MoveJournal. Moves to another device copy data with a checksum, which
+	is verified against the written data. Sources are deleted only once
+	the db was updated.
 	"""
 
-	processing = Signal(str, int, int)
-
-	def __init__(self, dest, sources, op, db):
-		super().__init__()
+	def __init__(self, dest, sources, op, db, progress=None, workers=COPY_WORKERS):
 		self.dest = dest
 		self.sources = sources
 		self.op = op
 		self.db = db
+		self.progress = progress or (lambda *args: None)
 		self.is_cancelled = Event()
 		assert op in ("cut", "copy")
-		assert self.dest.is_dir()
-
-	def _copytree(self, src, dst):
-		shutil.copytree(src, dst, copy=self._copy)
-
-	def _movetree(self, src, dstdir):
-		is_dir = src.is_dir()
-		xdev = _get_dev(src) != _get_dev(dstdir)
-
-		thumbs_inodes = None
-		thumbs = None
-		if not xdev:
-			if is_dir:
-				thumbs_inodes = _scan_thumbs(src)
-			else:
-				thumbs = _call_log_exc(_pre_copy_thumb, src)
+		assert self.dest.is_dir() or len(self.sources) == 1
+
+		self.workers = workers
+		self.total_bytes = self.total_files = 0
+		self.done_bytes = self.done_files = 0
+		self._last_report = None
+		# copies may run in parallel
+		self._progress_lock = Lock()
+
+	def _scan(self):
+		# compute the whole operation size before starting
+		self._source_files = {}
+		for src in self.sources:
+			size, files = tree_size(src)
+			if self.op == "cut" and _get_dev(src) == _get_dev(self._target(src).parent):
+				# renamed, not copied
+				size = 0
+			self._source_files[src] = files
+			self.total_bytes += size
+			self.total_files += files
+
+	def _report(self, path, add_bytes=0, add_files=0, force=False):
+		with self._progress_lock:
+			self.done_bytes += add_bytes
+			self.done_files += add_files
+
+			now = time.monotonic()
+			if not force and self._last_report is not None and now - self._last_report < PROGRESS_INTERVAL:
+				return
+			self._last_report = now
+			args = (str(path), self.done_bytes, self.total_bytes, self.done_files, self.total_files)
+		self.progress(*args)
+
+	def _target(self, src):
+		if self.dest.is_dir():
+			return self.dest.joinpath(src.name)
+		return self.dest
+
+	def _plan_copytree(self, src, dst, symlinks=False):
+		# create the subdirectories of the copy in dst, which must exist, return
+		# files copy jobs and directories whose metadata should be copied once files are
+		jobs = []
+		dirs = []
+		for root, subdirs, names in os.walk(src, followlinks=not symlinks):
+			target = os.path.normpath(os.path.join(dst, os.path.relpath(root, src)))
+			if os.path.normpath(root) != os.path.normpath(src):
+				os.mkdir(target)
+			dirs.append((root, target))
+
+			if symlinks:
+				# symlinks to directories are not walked
+				names = names + [name for name in subdirs if os.path.islink(os.path.join(root, name))]
+
+			devices = (os.stat(root).st_dev, os.stat(target).st_dev)
+			for name in names:
+				path = os.path.join(root, name)
+				if symlinks and os.path.islink(path):
+					os.symlink(os.readlink(path), os.path.join(target, name))
+					self._report(path, add_bytes=os.lstat(path).st_size, add_files=1)
+				else:
+					jobs.append((path, os.path.join(target, name), devices))
+		return jobs, dirs
+
+	def _movetree(self, src, dst):
+		if os.path.lexists(dst):
+			# a file would be overwritten, a directory would get src nested in it
+			raise FileExistsError(errno.EEXIST, 'destination already exists', str(dst))
+
+		if _get_dev(src) != _get_dev(dst.parent):
+			self._move_xdev(src, dst)
+			return
 
-		shutil.move(src, dstdir, copy_function=self._copy_for_move)
+		is_dir = src.is_dir() and not src.is_symlink()
+		shutil.move(src, dst, copy_function=self._copy_for_move)
+		self._report(src, add_files=self._source_files[src])
 
-		if not xdev:
-			dstentry = dstdir.joinpath(src.name)
+		if is_dir:
+			self.journal.folder_renamed(src, dst)
+		else:
+			self.journal.file_renamed(src, dst)
 
-			if is_dir:
-				with self.db:
-					self.db.rename_folder(src, dstentry)
+	def _move_xdev(self, src, dst):
+		# copy to dst, src is deleted once the journal is committed
+		# dst is created exclusively, it may have appeared since _movetree checked
+		created = False
+		try:
+			if src.is_symlink():
+				os.symlink(os.readlink(src), dst)
+				created = True
+				self._report(src, add_bytes=src.lstat().st_size, add_files=1)
+				self.journal.file_renamed(src, dst)
+			elif src.is_dir():
+				os.mkdir(dst)
+				created = True
+				jobs, dirs = self._plan_copytree(src, dst, symlinks=True)
+				CopyScheduler(self._copy_verified, self.workers, self.is_cancelled).run(jobs)
+				if self.is_cancelled.is_set():
+					# jobs were left
+					raise Cancelled()
 
-				_restore_thumbs(dstentry, thumbs_inodes)
+				for dsrc, ddst in reversed(dirs):
+					shutil.copystat(dsrc, ddst)
+				self.journal.folder_renamed(src, dst)
 			else:
-				with self.db:
-					self.db.rename_file(src, dstentry)
-
-				_call_log_exc(_post_copy_thumb, thumbs, dstentry)
+				os.close(os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+				created = True
+				self._copy_verified(src, dst)
+				self.journal.file_renamed(src, dst)
+		except BaseException:
+			# don't leave a partial copy behind, but never remove what was there before
+			if created:
+				_call_log_exc(_remove, dst)
+			raise
+
+		self._copied_sources.append(src)
 
 	def _copy_for_move(self, src, dst):
-		self._copy(src, dst)
-		with self.db:
-			self.db.rename_file(src, dst)
-
-	def _copy(self, src, dst):
+		# rename failed within a device, which can happen with bind mounts
+		self._copy_verified(src, dst)
+		self.journal.file_renamed(src, dst)
+
+	def _copy_verified(self, src, dst):
+		digest = hashlib.new(CHECKSUM)
+		# thumbnails are moved by the journal
+		self._copy(src, dst, copy_thumbs=False, digest=digest)
+		if _file_digest(dst) != digest.digest():
+			raise ChecksumError(errno.EIO, 'copy differs from %r' % str(src), str(dst))
+
+	def _copy(self, src, dst, copy_thumbs=True, digest=None):
 		if self.is_cancelled.is_set():
 			raise Cancelled()
 
-		thumbs = _call_log_exc(_pre_copy_thumb, src)
+		thumbs = _call_log_exc(_pre_copy_thumb, src) if copy_thumbs else None
 
-		total = os.path.getsize(src)
-		current = 0
-		self.processing.emit(str(src), 0, total)
-		length = shutil.COPY_BUFSIZE
+		self._report(src)
 
+		copied = 0
 		with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
-			fsrc_read = fsrc.read
-			fdst_write = fdst.write
+			if digest is None:
+				chunks = copy_data(fsrc, fdst)
+			else:
+				# the data has to go through userspace to be hashed
+				chunks = _userspace_copy(fsrc, fdst, digest)
 
-			while True:
+			for current in chunks:
 				if self.is_cancelled.is_set():
 					raise Cancelled()
 
-				buf = fsrc_read(length)
-				if not buf:
-					break
-				fdst_write(buf)
-				current += len(buf)
+				self._report(src, add_bytes=current - copied)
+				copied = current
 
-				self.processing.emit(str(src), current, total)
+			if digest is not None:
+				# written to disk before the source is deleted
+				fdst.flush()
+				os.fsync(fdst.fileno())
 
 		shutil.copystat(src, dst)
+		self._report(src, add_files=1)
 		_call_log_exc(_post_copy_thumb, thumbs, dst)
 
 	def run(self):
@@ -218,38 +813,236 @@ class FileOperation(QThread):
 			# TODO
 			return
 
+		self._scan()
 		try:
 			getattr(self, "_run_%s" % self.op)()
 		except Cancelled:
 			pass
+		self._report(self.dest, force=True)
 
 	def _run_copy(self):
+		jobs = []
+		dirs = []
 		for src in self.sources:
-			if self.is_cancelled.is_set():
-				break
-
+			dst = self._target(src)
 			if src.is_file():
-				dest = self.dest.joinpath(src.name)
-				self._copy(src, dest)
+				jobs.append((src, dst, (_get_dev(src), _get_dev(dst.parent))))
 			elif src.is_dir():
-				self._copytree(src, self.dest)
+				os.mkdir(dst)
+				tree_jobs, tree_dirs = self._plan_copytree(src, dst)
+				jobs += tree_jobs
+				dirs += tree_dirs
+
+		CopyScheduler(self._copy, self.workers, self.is_cancelled).run(jobs)
+
+		for src, dst in reversed(dirs):
+			shutil.copystat(src, dst)
 
 	def _run_cut(self):
-		for src in self.sources:
-			if self.is_cancelled.is_set():
-				break
+		self.journal = MoveJournal(self.db)
+		self._copied_sources = []
+		try:
+			for src in self.sources:
+				if self.is_cancelled.is_set():
+					break
+
+				self._movetree(src, self._target(src))
+		finally:
+			# also what was moved before an error or cancellation
+			self.journal.commit()
 
-			self._movetree(src, self.dest)
+			for src in self._copied_sources:
+				_remove(src)
 
-	@Slot()
 	def cancel(self):
 		self.is_cancelled.set()
 
 
-def can_trash():
-	return bool(shutil.which("trash-put"))
+# freedesktop.org trash specification, version 1.0
+TRASHINFO_SUFFIX = '.trashinfo'
+
+
+def _home_trash():
+	data_home = os.getenv('XDG_DATA_HOME') or os.path.expanduser('~/.local/share')
+	return os.path.join(data_home, 'Trash')
+
+
+def _make_trash(trash):
+	os.makedirs(trash, mode=0o700, exist_ok=True)
+	for sub in ('files', 'info'):
+		os.makedirs(os.path.join(trash, sub), mode=0o700, exist_ok=True)
+	return trash
+
+
+def _top_dir(path):
+	# mount point of the filesystem containing path
+	path = os.path.realpath(path)
+	while not os.path.ismount(path):
+		path = os.path.dirname(path)
+	return path
 
 
-def trash_items(paths):
-	LOGGER.info("sending %s to trash", paths)
-	subprocess.run(["trash-put", "-v", *map(str, paths)])
+def _find_trash(path):
+	# (trash directory, top dir for relative paths or None) for path
+	home = _home_trash()
+	os.makedirs(home, mode=0o700, exist_ok=True)
+	if os.lstat(path).st_dev == os.stat(home).st_dev:
+		return _make_trash(home), None
+
+	top = _top_dir(os.path.dirname(path))
+	shared = os.path.join(top, '.Trash')
+	try:
+		st = os.lstat(shared)
+	except FileNotFoundError:
+		pass
+	else:
+		# the admin-created trash must be sticky, and not a symlink
+		if stat.S_ISDIR(st.st_mode) and st.st_mode & stat.S_ISVTX:
+			try:
+				return _make_trash(os.path.join(shared, str(os.getuid()))), top
+			except OSError as exc:
+				LOGGER.info("cannot use %r: %s", shared, exc)
+
+	return _make_trash(os.path.join(top, '.Trash-%d' % os.getuid())), top
+
+
+def _write_trashinfo(trash, top, path, date):
+	# create a unique info file for path, return the name of the item in trash
+	base = os.path.basename(path)
+	original = path if top is None else os.path.relpath(path, top)
+	content = '[Trash Info]\nPath=%s\nDeletionDate=%s\n' % (quote(os.fsencode(original)), date)
+
+	name = base
+	counter = 1
+	while True:
+		info = os.path.join(trash, 'info', name + TRASHINFO_SUFFIX)
+		try:
+			fd = os.open(info, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+		except FileExistsError:
+			pass
+		else:
+			if not os.path.lexists(os.path.join(trash, 'files', name)):
+				with os.fdopen(fd, 'w', encoding='utf-8') as fout:
+					fout.write(content)
+				return name
+
+			# trashed item left without its info file, it would be overwritten
+			os.close(fd)
+			os.unlink(info)
+
+		counter += 1
+		name = '%s.%d' % (base, counter)
+
+
+def _trash_batch(trash, top, paths, trashed):
+	# info files are all written first, like the spec requires
+	date = time.strftime('%Y-%m-%dT%H:%M:%S')
+	names = []
+	moved = []
+	try:
+		for path in paths:
+			names.append(_write_trashinfo(trash, top, path, date))
+
+		for path, name in zip(paths, names):
+			target = os.path.join(trash, 'files', name)
+			os.rename(path, target)
+			moved.append((path, target))
+	finally:
+		trashed.extend(moved)
+		# info files of items which could not be trashed
+		for name in names[len(moved):]:
+			_call_log_exc(os.unlink, os.path.join(trash, 'info', name + TRASHINFO_SUFFIX))
+
+
+def trash_items(paths, db):
+	"""Send paths to the freedesktop.org trash, return (path, trashed) pairs
+
+	Items are renamed into the home trash if on the same device, else into
+	the trash of the top directory of their filesystem. Their tags and
+	captions are taken out of db in a single transaction, and put back by
+	restore_items.
+	"""
+	LOGGER.info("sending %d items to trash", len(paths))
+
+	batches = {}
+	trashes = {}
+	for path in paths:
+		path = os.path.abspath(path)
+		dev = os.lstat(path).st_dev
+		if dev not in trashes:
+			trashes[dev] = _find_trash(path)
+		batches.setdefault(trashes[dev], []).append(path)
+
+	trashed = []
+	try:
+		for (trash, top), batch in batches.items():
+			_trash_batch(trash, top, batch, trashed)
+	finally:
+		# also what was trashed before an error
+		with db:
+			db.trash_files(trashed)
+	return trashed
+
+
+def _read_trashinfo(trashed):
+	# original path of trashed item, from its info file
+	trash = os.path.dirname(os.path.dirname(trashed))
+	info = os.path.join(trash, 'info', os.path.basename(trashed) + TRASHINFO_SUFFIX)
+	with open(info, encoding='utf-8') as fd:
+		for line in fd:
+			if line.startswith('Path='):
+				path = os.fsdecode(unquote_to_bytes(line[len('Path='):].rstrip('\n')))
+				break
+		else:
+			raise ValueError('no Path in %r' % info)
+
+	if not os.path.isabs(path):
+		# relative to the top dir of a .Trash/$uid or .Trash-$uid trash
+		top = os.path.dirname(trash)
+		if os.path.basename(top) == '.Trash':
+			top = os.path.dirname(top)
+		path = os.path.join(top, path)
+	return info, path
+
+
+def restore_items(trashed_paths, db):
+	"""Restore items of the trash to their original path, with their tags
+
+	Return (trashed, path) pairs of restored items.
+	"""
+	restored = []
+	try:
+		for trashed in trashed_paths:
+			info, path = _read_trashinfo(trashed)
+			if os.path.lexists(path):
+				raise FileExistsError(errno.EEXIST, 'cannot restore, file exists', path)
+
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			os.rename(trashed, path)
+			os.unlink(info)
+			restored.append((trashed, path))
+	finally:
+		with db:
+			db.restore_trashed(restored)
+	return restored
+
+
+def sync_trash(db):
+	"""Catch up with the trash changes made by other programs
+
+	Tags of items restored by other programs are restored, those of items
+	deleted from the trash are forgotten.
+	"""
+	restored = []
+	deleted = []
+	for trashed, original in db.list_trashed():
+		if os.path.lexists(trashed):
+			continue
+		elif os.path.lexists(original):
+			restored.append((trashed, original))
+		else:
+			deleted.append(trashed)
+
+	with db:
+		db.restore_trashed(restored)
+		db.forget_trashed(deleted)
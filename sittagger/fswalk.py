@@ -0,0 +1,212 @@
+# SPDX-License-Identifier: WTFPL
+
+"""Parallel recursive listing of files, with filters and ignore files
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import fnmatch
+from logging import getLogger
+import mimetypes
+import os
+import re
+
+
+LOGGER = getLogger(__name__)
+
+# gitignore-like patterns, applying to the directory containing it and below
+IGNORE_FILE = '.sittaggerignore'
+
+# directories scanned concurrently, scandir releases the GIL during syscalls
+WALK_THREADS = 8
+
+
+def _compile_regexes(regexes):
+	# match function for any of regexes, or None if there are none
+	if not regexes:
+		return None
+	return re.compile('|'.join(regexes)).match
+
+
+def _compile(patterns):
+	# match function for any of fnmatch patterns, or None if there are none
+	return _compile_regexes([fnmatch.translate(pattern) for pattern in patterns])
+
+
+def _translate_path(pattern):
+	# regex for a gitignore path pattern: wildcards don't match "/", except "**"
+	parts = []
+	i = 0
+	while i < len(pattern):
+		if pattern.startswith('**/', i):
+			# zero or more directories
+			parts.append('(?:.*/)?')
+			i += 3
+		elif pattern.startswith('**', i):
+			parts.append('.*')
+			i += 2
+		elif pattern[i] == '*':
+			parts.append('[^/]*')
+			i += 1
+		elif pattern[i] == '?':
+			parts.append('[^/]')
+			i += 1
+		elif pattern[i] == '[':
+			# like fnmatch, "]" right after "[" or "[!" is part of the set
+			end = i + 1
+			if pattern.startswith('!', end):
+				end += 1
+			if pattern.startswith(']', end):
+				end += 1
+			end = pattern.find(']', end)
+			if end < 0:
+				parts.append(re.escape('['))
+				i += 1
+				continue
+
+			chars = pattern[i + 1:end]
+			negated = chars.startswith('!')
+			if negated:
+				chars = chars[1:]
+			chars = re.sub(r'([\\\[^&~|])', r'\\\1', chars)
+			parts.append('[^/%s]' % chars if negated else '[%s]' % chars)
+			i = end + 1
+		else:
+			parts.append(re.escape(pattern[i]))
+			i += 1
+	return '(?s:%s)\\Z' % ''.join(parts)
+
+
+class IgnoreRules:
+	"""gitignore-like patterns, compiled for fast matching
+
+	Like .gitignore: blank lines and lines starting with "#" are skipped,
+	a trailing "/" matches only directories, and patterns containing a "/"
+	are relative to the directory of the ignore file, else they match
+	entries names at any depth. In those, wildcards don't match "/", but
+	"**" does. "!" negation is not supported.
+	"""
+
+	def __init__(self):
+		# (regex, against full path, only directories)
+		self.rules = []
+		self._compile()
+
+	def _compile(self):
+		self.match_file_name = _compile_regexes([r for r, full, dirs in self.rules if not full and not dirs])
+		self.match_file_path = _compile_regexes([r for r, full, dirs in self.rules if full and not dirs])
+		self.match_dir_name = _compile_regexes([r for r, full, _ in self.rules if not full])
+		self.match_dir_path = _compile_regexes([r for r, full, _ in self.rules if full])
+
+	def extended(self, path):
+		# new rules with those of ignore file at path
+		result = IgnoreRules()
+		result.rules = self.rules[:]
+
+		with open(path, encoding='utf-8', errors='surrogateescape') as fd:
+			for line in fd:
+				line = line.rstrip('\n')
+				if not line.strip() or line.startswith('#'):
+					continue
+
+				only_dirs = line.endswith('/')
+				pattern = line.rstrip('/')
+				full = '/' in pattern
+				if full:
+					# the directory is literal, even if it contains wildcards characters
+					prefix = os.path.join(os.path.dirname(path), '')
+					regex = re.escape(prefix) + _translate_path(pattern.lstrip('/'))
+				else:
+					regex = fnmatch.translate(pattern)
+				result.rules.append((regex, full, only_dirs))
+
+		result._compile()
+		return result
+
+	def ignores(self, entry, is_dir):
+		if is_dir:
+			match_name, match_path = self.match_dir_name, self.match_dir_path
+		else:
+			match_name, match_path = self.match_file_name, self.match_file_path
+		return bool(
+			(match_name and match_name(entry.name))
+			or (match_path and match_path(entry.path))
+		)
+
+
+class FileFilter:
+	"""File names matching any of globs, and whose type matches any of mimes
+
+	Types are guessed from the file extension, without reading the file.
+	"""
+
+	def __init__(self, globs=(), mimes=()):
+		self.match_glob = _compile(globs)
+		self.match_mime = _compile(mimes)
+		# extension -> whether its type matches
+		self._extensions = {}
+
+	def _mime_matches(self, name):
+		ext = os.path.splitext(name)[1].lower()
+		try:
+			return self._extensions[ext]
+		except KeyError:
+			pass
+
+		mime = mimetypes.guess_type('file' + ext, strict=False)[0]
+		result = self._extensions[ext] = bool(mime and self.match_mime(mime))
+		return result
+
+	def __call__(self, name):
+		if self.match_glob and not self.match_glob(name):
+			return False
+		if self.match_mime and not self._mime_matches(name):
+			return False
+		return True
+
+
+def _scan(path, rules, file_filter):
+	# list a single directory: matching files and subdirectories to scan
+	ignore_path = os.path.join(path, IGNORE_FILE)
+	if os.path.exists(ignore_path):
+		rules = rules.extended(ignore_path)
+
+	files = []
+	subdirs = []
+	try:
+		with os.scandir(path) as it:
+			for entry in it:
+				# don't follow symlinks to directories, they could loop
+				if entry.is_dir(follow_symlinks=False):
+					if not rules.ignores(entry, True):
+						subdirs.append(entry.path)
+				elif entry.is_file():
+					if (
+						file_filter(entry.name) and not rules.ignores(entry, False)
+						and entry.name != IGNORE_FILE
+					):
+						files.append(entry.path)
+	except OSError as exc:
+		LOGGER.warning("cannot list %r: %s", path, exc)
+	return files, subdirs, rules
+
+
+def walk_files(roots, globs=(), mimes=(), threads=WALK_THREADS):
+	"""Yield files under roots directories matching globs and mimes patterns
+
+	Directories are listed concurrently, files are yielded as soon as their
+	directory has been listed, in no particular order.
+	"""
+	if mimes:
+		# load types database before threads race to do it
+		mimetypes.init()
+
+	with ThreadPoolExecutor(threads) as executor:
+		file_filter = FileFilter(globs, mimes)
+		pending = {executor.submit(_scan, root, IgnoreRules(), file_filter) for root in roots}
+		while pending:
+			done, pending = wait(pending, return_when=FIRST_COMPLETED)
+			for future in done:
+				files, subdirs, rules = future.result()
+				for subdir in subdirs:
+					pending.add(executor.submit(_scan, subdir, rules, file_filter))
+				yield from files
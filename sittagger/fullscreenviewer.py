@@ -1,13 +1,19 @@
 # SPDX-License-Identifier: WTFPL
 
 from PyQt6.QtCore import (
-	Qt, pyqtSignal as Signal, pyqtSlot as Slot, QTimer, QPointF,
+	Qt, pyqtSignal as Signal, pyqtSlot as Slot, QTimer, QPointF, QSize, QSizeF, QRect, QRectF,
 )
 from PyQt6.QtGui import (
-	QKeySequence, QPalette, QPixmap, QMovie, QIcon, QImageReader, QCursor,
+	QKeySequence, QIcon, QCursor, QImage, QTransform,
+)
+from PyQt6.QtWidgets import (
+	QMainWindow, QDockWidget, QToolBar, QFrame, QGraphicsItem, QGraphicsScene, QGraphicsView,
 )
-from PyQt6.QtWidgets import QMainWindow, QScrollArea, QDockWidget, QToolBar, QLabel, QFrame
 
+from .animation import AnimationPlayer
+from .imageloader import (
+	ImageLoader, PREFETCH_AHEAD, PREFETCH_BEHIND, TILE_SIZE, level_for_scale, level_size, tile_rect,
+)
 from .tagwidgets import TagEditor
 
 
@@ -15,6 +21,9 @@ ZOOM_FACTOR = 0
 ZOOM_FITALL = 1
 ZOOM_FITCUT = 2
 
+# milliseconds without zooming or scrolling before the image is rendered smoothly
+SMOOTH_DELAY = 150
+
 
 class AutoHideMixin:
 	def leaveEvent(self, ev):
@@ -34,6 +43,9 @@ class ImageViewer(QMainWindow):
 		self.db = db
 		self.currentIndex = -1
 		self.files = []
+		# 1 when going to next files, -1 when going to previous ones
+		self.direction = 1
+		self.loader = ImageLoader(self)
 
 		self._init_widgets()
 
@@ -61,7 +73,7 @@ class ImageViewer(QMainWindow):
 
 		self.toolbar.addSeparator()
 
-		self.scrollview = ImageViewerCenter()
+		self.scrollview = ImageViewerCenter(self.loader)
 		self.setCentralWidget(self.scrollview)
 
 		action = self.toolbar.addAction(QIcon.fromTheme('zoom-original'), 'Z 1:1')
@@ -128,6 +140,31 @@ class ImageViewer(QMainWindow):
 		self.tageditor.setFile(file)
 		self.scrollview.setFile(file)
 		self.setWindowTitle(file)
+		self._prefetch()
+
+	def _prefetch(self):
+		# decode neighbors, most likely to be shown next first
+		indexes = [self.currentIndex]
+		for distance in range(1, max(PREFETCH_AHEAD, PREFETCH_BEHIND) + 1):
+			if distance <= PREFETCH_AHEAD:
+				indexes.append(self.currentIndex + self.direction * distance)
+			if distance <= PREFETCH_BEHIND:
+				indexes.append(self.currentIndex - self.direction * distance)
+
+		spec = self.scrollview.decodeSpec()
+		keys = [
+			(self.files[index], spec) for index in indexes
+			if 0 <= index < len(self.files)
+		]
+		if self.scrollview.key and self.scrollview.key not in keys:
+			# displayed, keep it in cache
+			keys.insert(0, self.scrollview.key)
+		self.loader.prefetch(keys)
+
+	def closeEvent(self, ev):
+		self.scrollview.stopAnimation()
+		self.loader.stop()
+		super().closeEvent(ev)
 
 	@Slot()
 	def copyPreviousTags(self):
@@ -151,16 +188,143 @@ class ImageViewer(QMainWindow):
 	def showPreviousFile(self):
 		if self.currentIndex > 0:
 			self.currentIndex -= 1
+			self.direction = -1
 			self.setFile(self.files[self.currentIndex])
 
 	@Slot()
 	def showNextFile(self):
 		if self.currentIndex < len(self.files) - 1:
 			self.currentIndex += 1
+			self.direction = 1
 			self.setFile(self.files[self.currentIndex])
 
 
-class ImageViewerCenter(QScrollArea):
+def _device_rect(rect):
+	# QRectF to QRect, rounding each edge so adjacent rects stay adjacent
+	left, top = round(rect.left()), round(rect.top())
+	return QRect(left, top, round(rect.right()) - left, round(rect.bottom()) - top)
+
+
+class ImageItem(QGraphicsItem):
+	"""Image at its full size, painted from a scaled decode and tiles
+
+	`image` may have less pixels than the full size, then tiles of the
+	image file at the level nearest to the displayed scale are painted over
+	it. Only visible tiles are decoded, in the background, the scaled image
+	being shown where they are missing.
+
+	Images are painted without filtering, which is fast enough to follow
+	zoom steps. `smooth` is a smoothly scaled rendering of the visible
+	part, painted over them when it was rendered for the current scale.
+	"""
+
+	def __init__(self, loader, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption)
+		self.loader = loader
+		# file to decode tiles from, None for no tiles
+		self.file = None
+		self.image = QImage()
+		self.fullSize = QSize()
+		# (scale, rect in item coordinates, image) or None
+		self.smooth = None
+
+	def setImage(self, file, image, fullSize):
+		self.prepareGeometryChange()
+		self.file = file
+		self.image = image
+		self.fullSize = fullSize
+		self.smooth = None
+		self.update()
+
+	def boundingRect(self):
+		return QRectF(QPointF(), QSizeF(self.fullSize))
+
+	def _visibleTiles(self, rect, scale):
+		# level and [(col, row, item rect)] of tiles covering rect, or None if
+		# the image is enough for scale
+		if self.file is None or self.image.width() >= self.fullSize.width() * scale:
+			return None, []
+
+		level = level_for_scale(scale)
+		size = level_size(self.fullSize, level)
+		# item pixels per level pixel
+		xfactor = self.fullSize.width() / size.width()
+		yfactor = self.fullSize.height() / size.height()
+
+		rect = rect.intersected(self.boundingRect())
+		if rect.isEmpty():
+			return level, []
+
+		tiles = []
+		for row in range(int(rect.top() / yfactor) // TILE_SIZE, int(rect.bottom() / yfactor - 1e-6) // TILE_SIZE + 1):
+			for col in range(int(rect.left() / xfactor) // TILE_SIZE, int(rect.right() / xfactor - 1e-6) // TILE_SIZE + 1):
+				tile = tile_rect(size, col, row)
+				tiles.append((col, row, QRectF(
+					tile.x() * xfactor, tile.y() * yfactor, tile.width() * xfactor, tile.height() * yfactor,
+				)))
+		return level, tiles
+
+	def _imageSource(self, rect):
+		# rect in item coordinates to rect in `image`
+		xratio = self.image.width() / self.fullSize.width()
+		yratio = self.image.height() / self.fullSize.height()
+		return QRectF(rect.x() * xratio, rect.y() * yratio, rect.width() * xratio, rect.height() * yratio)
+
+	def paint(self, painter, option, widget=None):
+		if self.image.isNull():
+			return
+
+		exposed = option.exposedRect
+		painter.drawImage(exposed, self.image, self._imageSource(exposed))
+
+		scale = painter.worldTransform().m11()
+		visible = painter.worldTransform().inverted()[0].mapRect(QRectF(widget.rect()))
+		level, tiles = self._visibleTiles(visible, scale)
+		missing = False
+		for col, row, rect in tiles:
+			image = self.loader.tiles.get((self.file, level, col, row))
+			if image is None:
+				missing = True
+			elif rect.intersects(exposed):
+				painter.drawImage(rect, image)
+
+		if missing:
+			self.loader.requestTiles(self.file, level, [(col, row) for col, row, _ in tiles])
+
+		if self.smooth is not None and self.smooth[0] == scale:
+			_, rect, image = self.smooth
+			painter.drawImage(rect, image)
+
+	def smoothPieces(self, rect, scale):
+		"""Return size and pieces to render rect at scale, see render_scaled()
+
+		None is returned if the image is painted without scaling anyway.
+		"""
+		rect = rect.intersected(self.boundingRect())
+		level, tiles = self._visibleTiles(rect, scale)
+		if rect.isEmpty() or (not tiles and abs(self.image.width() - self.fullSize.width() * scale) < 1):
+			return None
+
+		def target(piece):
+			return _device_rect(QRectF((piece.topLeft() - rect.topLeft()) * scale, piece.size() * scale))
+
+		source = self._imageSource(rect).toAlignedRect().intersected(self.image.rect())
+		xratio = self.fullSize.width() / self.image.width()
+		yratio = self.fullSize.height() / self.image.height()
+		pieces = [(self.image, source, target(QRectF(
+			source.x() * xratio, source.y() * yratio, source.width() * xratio, source.height() * yratio,
+		)))]
+
+		for col, row, tile in tiles:
+			image = self.loader.tiles.get((self.file, level, col, row))
+			if image is not None:
+				pieces.append((image, image.rect(), target(tile)))
+
+		return (rect.size() * scale).toSize(), pieces
+
+
+class ImageViewerCenter(QGraphicsView):
 	topZoneEntered = Signal()
 	topZoneLeft = Signal()
 	leftZoneEntered = Signal()
@@ -169,32 +333,44 @@ class ImageViewerCenter(QScrollArea):
 	leftMargin = 30
 	topMargin = 30
 
-	def __init__(self, *args, **kwargs):
+	def __init__(self, loader, *args, **kwargs):
 		super().__init__(*args, **kwargs)
+		self.loader = loader
+		self.loader.loaded.connect(self._imageLoaded)
+		self.loader.tileLoaded.connect(self._tileLoaded)
+		self.loader.rendered.connect(self._smoothRendered)
 		self.zoomMode = ZOOM_FACTOR
 		self.zoomFactor = 1
-		self.oldZoomFactor = self.zoomFactor
 		self.moving = None
 
-		imgWidget = QLabel()
-		imgWidget.setMouseTracking(True)
-		imgWidget.setAlignment(Qt.AlignmentFlag.AlignCenter)
-		self.setWidget(imgWidget)
+		self.item = ImageItem(self.loader)
+		self.setScene(QGraphicsScene(self))
+		self.scene().addItem(self.item)
 
+		# zooming is anchored by _rebuildZoom
+		self.setTransformationAnchor(QGraphicsView.ViewportAnchor.NoAnchor)
 		self.setAlignment(Qt.AlignmentFlag.AlignCenter)
 		self.setMouseTracking(True)
 		self.setFrameShape(QFrame.Shape.NoFrame)
-		self.setWidgetResizable(True)
+		self.setBackgroundBrush(Qt.GlobalColor.black)
 
-		pal = QPalette()
-		pal.setColor(QPalette.ColorRole.Window, Qt.GlobalColor.black)
-		self.setPalette(pal)
+		# smooth rendering is done when zooming and scrolling stopped
+		self.smoothTimer = QTimer(self)
+		self.smoothTimer.setSingleShot(True)
+		self.smoothTimer.setInterval(SMOOTH_DELAY)
+		self.smoothTimer.timeout.connect(self._renderSmooth)
+		self.horizontalScrollBar().valueChanged.connect(self.smoothTimer.start)
+		self.verticalScrollBar().valueChanged.connect(self.smoothTimer.start)
 
 		self.leftZone = False
 		self.topZone = False
 
 		self.file = None
-		self.movie = None
+		self.player = None
+		# best decoded image of file, and its (file, spec) loader key
+		self.originalImage = QImage()
+		self.key = None
+		self.fullSize = QSize()
 
 	### events
 	def mousePressEvent(self, ev):
@@ -231,7 +407,7 @@ class ImageViewerCenter(QScrollArea):
 
 	def keyPressEvent_(self, ev):
 		if ev.key() not in (Qt.Key.Key_PageUp, Qt.Key.Key_PageDown):
-			QScrollArea.keyPressEvent(self, ev)
+			QGraphicsView.keyPressEvent(self, ev)
 
 	def keyReleaseEvent_(self, ev):
 		if ev.key() == Qt.Key.Key_PageUp:
@@ -239,7 +415,7 @@ class ImageViewerCenter(QScrollArea):
 		elif ev.key() == Qt.Key.Key_PageDown:
 			self.imageviewer.nextImage_s()
 		else:
-			QScrollArea.keyReleaseEvent(self, ev)
+			QGraphicsView.keyReleaseEvent(self, ev)
 
 	def wheelEvent(self, event):
 		if not (event.modifiers() & Qt.KeyboardModifier.ControlModifier):
@@ -279,7 +455,6 @@ class ImageViewerCenter(QScrollArea):
 		self._rebuildZoom(at_cursor)
 
 	def setZoomFactor(self, factor, at_cursor):
-		self.oldZoomFactor = self.zoomFactor
 		self.zoomFactor = factor
 		self.setZoomMode(ZOOM_FACTOR, at_cursor)
 
@@ -288,74 +463,111 @@ class ImageViewerCenter(QScrollArea):
 
 	def setFile(self, file):
 		self.file = file
-		if file.lower().endswith('.gif'):
-			self.movie = QMovie(file)
-			self.widget().setMovie(self.movie)
-			self.movie.finished.connect(self.movie.start)
-			self.movie.start()
-		else:
-			self.movie = None
+		self.key = None
+		self.originalImage = QImage()
+		self.item.setImage(None, self.originalImage, QSize())
+		self.stopAnimation()
+
+		key = (file, self.decodeSpec())
+		img = self.loader.cache.get(key)
+		if img is not None:
+			self._setImage(key, img)
+			return
 
-			img_reader = QImageReader(file)
-			img_reader.setAutoTransform(True)
-			img = img_reader.read()
+		# shown by _imageLoaded
+		self.loader.request(*key)
 
-			self.originalPixmap = QPixmap.fromImage(img)
-			self._rebuildZoom()
+	def stopAnimation(self):
+		if self.player:
+			self.player.stop()
+			self.player.deleteLater()
+			self.player = None
+
+	def decodeSpec(self):
+		# box images should be decoded for, zooming in is done with tiles
+		size = self.viewport().size()
+		return (size.width(), size.height(), self.zoomMode == ZOOM_FITCUT)
 
 	###
-	def _rebuildZoom(self, at_cursor=False):
-		if self.movie:
+	@Slot(str, object, QImage)
+	def _imageLoaded(self, file, spec, img):
+		if file != self.file or self.player:
 			return
+		if self.key is None or img.width() > self.originalImage.width():
+			self._setImage((file, spec), img)
+
+	def _setImage(self, key, img):
+		self.key = key
+		self.fullSize = self.loader.fullSizes.get(key[0], img.size())
+		self.originalImage = img
+		if self.file in self.loader.animated:
+			# the first frame is shown until the player is started, no tiles
+			self.item.setImage(None, img, self.fullSize)
+			self.player = AnimationPlayer(self.file, self)
+			self.player.frameChanged.connect(self._animationFrame)
+			self.player.start()
+		else:
+			self.item.setImage(self.file, img, self.fullSize)
+		self.setSceneRect(self.item.boundingRect())
+		self._rebuildZoom()
+
+	@Slot(QImage)
+	def _animationFrame(self, img):
+		self.originalImage = img
+		self.item.setImage(None, img, self.fullSize)
+
+	@Slot(str, int)
+	def _tileLoaded(self, file, level):
+		if file == self.item.file:
+			# the smooth rendering has less details than the new tiles
+			self.item.smooth = None
+			self.item.update()
+			self.smoothTimer.start()
 
-		# save relative scroll position to restore it later
-		vbar = self.verticalScrollBar()
-		hbar = self.horizontalScrollBar()
-		vpos = hpos = 0
-		if vbar.maximum():
-			vpos = vbar.value() / vbar.maximum()
-		if hbar.maximum():
-			hpos = hbar.value() / hbar.maximum()
+	@Slot()
+	def _renderSmooth(self):
+		if self.player:
+			return
+		rect = self.mapToScene(self.viewport().rect()).boundingRect()
+		scale = self.transform().m11()
+		result = self.item.smoothPieces(rect, scale)
+		if result is not None:
+			self.loader.render((self.file, scale, rect), *result)
+
+	@Slot(object, QImage)
+	def _smoothRendered(self, key, image):
+		file, scale, rect = key
+		if file == self.file and scale == self.transform().m11():
+			self.item.smooth = (scale, rect.intersected(self.item.boundingRect()), image)
+			self.item.update()
+
+	def _targetSize(self):
+		# size at which the image should be displayed
+		if self.zoomMode == ZOOM_FACTOR:
+			return self.fullSize * self.zoomFactor
+		elif self.zoomMode == ZOOM_FITALL:
+			return self.fullSize.scaled(self.viewport().size(), Qt.AspectRatioMode.KeepAspectRatio)
+		else:
+			return self.fullSize.scaled(self.viewport().size(), Qt.AspectRatioMode.KeepAspectRatioByExpanding)
+
+	def _rebuildZoom(self, at_cursor=False):
+		if self.originalImage.isNull():
+			return
 
-		oldScale = self.oldZoomFactor
-		scrollbarPos = QPointF(hbar.value(), vbar.value())
+		if self.zoomMode != ZOOM_FACTOR:
+			self.zoomFactor = self._targetSize().width() / float(self.fullSize.width())
 
+		# keep the image point under the cursor (or the center) in place
 		if at_cursor:
-			# zoom at cursor algorithm from https://stackoverflow.com/a/32269574/6541288
-			gcur = QPointF(QCursor.pos())
-			deltaToPos = self.mapFromGlobal(gcur.toPoint()) / oldScale - self.widget().pos() / oldScale
+			anchor = self.viewport().mapFromGlobal(QCursor.pos())
 		else:
-			deltaToPos = QPointF(self.viewport().rect().center()) / oldScale - QPointF(self.widget().pos()) / oldScale
-
-		if self.zoomMode == ZOOM_FACTOR:
-			if self.zoomFactor == 1:
-				self._setPixmap(self.originalPixmap)
-			else:
-				self._setPixmap(self._getScaledPixmap(self.originalPixmap.size() * self.zoomFactor))
-		elif self.zoomMode == ZOOM_FITALL:
-			newpix = self._getScaledPixmap(self.viewport().size())
-			self._setPixmap(newpix)
-			self.oldZoomFactor = self.zoomFactor
-			self.zoomFactor = newpix.size().width() / float(self.originalPixmap.size().width())
-		elif self.zoomMode == ZOOM_FITCUT:
-			newpix = self._getScaledPixmap(self.viewport().size(), Qt.AspectRatioMode.KeepAspectRatioByExpanding)
-			self._setPixmap(newpix)
-			self.oldZoomFactor = self.zoomFactor
-			self.zoomFactor = newpix.size().width() / float(self.originalPixmap.size().width())
-
-		def scroll_after_zoom():
-			hbar.setValue(int(scrollbarPos.x() + delta.x()))
-			vbar.setValue(int(scrollbarPos.y() + delta.y()))
-
-		newScale = self.zoomFactor
-		delta = deltaToPos * newScale - deltaToPos * oldScale
-
-		# XXX the pixmap is not fully loaded and displayed yet, so the scrollbars maximum values
-		# are not up to date yet, so we have to wait before restoring the relative scroll position
-		QTimer.singleShot(0, scroll_after_zoom)
-
-	def _getScaledPixmap(self, size, mode=Qt.AspectRatioMode.KeepAspectRatio):
-		return self.originalPixmap.scaled(size, mode, Qt.TransformationMode.SmoothTransformation)
-
-	def _setPixmap(self, pixmap):
-		self.widget().setPixmap(pixmap)
+			anchor = self.viewport().rect().center()
+		scenePos = self.mapToScene(anchor)
+
+		# only the transform changes, the image is painted at the new scale
+		# right away, and smoothly after a delay
+		self.setTransform(QTransform.fromScale(self.zoomFactor, self.zoomFactor))
+		delta = self.mapFromScene(scenePos) - anchor
+		self.horizontalScrollBar().setValue(self.horizontalScrollBar().value() + delta.x())
+		self.verticalScrollBar().setValue(self.verticalScrollBar().value() + delta.y())
+		self.smoothTimer.start()
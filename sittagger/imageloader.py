@@ -0,0 +1,439 @@
+# SPDX-License-Identifier: WTFPL
+
+"""Decoding of images in a thread pool, kept in a memory-budgeted cache
+
+Large images are also decoded as tiles of a pyramid of levels, level n
+being the image scaled by 1/2**n, so only the visible part of the image
+is decoded, at the resolution it is displayed at.
+
+The pool also renders the visible part of images with smooth scaling,
+which is too slow to be done while zooming.
+"""
+
+from collections import OrderedDict
+from logging import getLogger
+import math
+
+from PyQt6.QtCore import (
+	QObject, QPoint, QRect, QRunnable, QSize, QThreadPool, Qt,
+	pyqtSignal as Signal, pyqtSlot as Slot,
+)
+from PyQt6.QtGui import QImage, QImageIOHandler, QImageReader, QPainter
+
+from .animation import is_animated
+
+
+LOGGER = getLogger(__name__)
+
+# bytes of decoded images kept in memory
+CACHE_BUDGET = 512 * 1024 * 1024
+
+# images decoded in advance in the navigation direction, and behind
+PREFETCH_AHEAD = 3
+PREFETCH_BEHIND = 1
+
+# requested images are decoded before prefetched ones
+PRIORITY_URGENT = 100
+
+# side of square tiles, in pixels of their level
+TILE_SIZE = 512
+
+# bytes of decoded tiles kept in memory
+TILE_CACHE_BUDGET = 256 * 1024 * 1024
+
+
+def fit_size(size, spec):
+	# size scaled to fit in a (width, height, expand) box, see decode
+	width, height, expand = spec
+	if expand:
+		mode = Qt.AspectRatioMode.KeepAspectRatioByExpanding
+	else:
+		mode = Qt.AspectRatioMode.KeepAspectRatio
+	return size.scaled(QSize(width, height), mode)
+
+
+def decode(path, spec=None):
+	"""Decode image at path, return it, its full size and if it is animated
+
+	Only the first frame of animations is decoded, see animation module.
+
+	If spec is a (width, height, expand) box, the image is decoded at the
+	size fitting in the box (or filling it if expand is true), but not
+	larger than its full size. Formats like JPEG decode directly at a
+	lower resolution, which is much faster and uses less memory.
+	"""
+	reader = QImageReader(path)
+	reader.setAutoTransform(True)
+	animated = is_animated(reader)
+
+	# known from the header, without decoding
+	full = reader.size()
+	rotated = bool(reader.transformation() & QImageIOHandler.Transformation.TransformationRotate90)
+	if full.isValid() and rotated:
+		full.transpose()
+
+	if spec is not None and full.isValid():
+		target = fit_size(full, spec)
+		if target.width() < full.width():
+			if rotated:
+				# scaled before being rotated
+				target.transpose()
+			reader.setScaledSize(target)
+
+	image = reader.read()
+	if image.isNull():
+		LOGGER.warning("cannot decode %r: %s", path, reader.errorString())
+	elif not full.isValid():
+		full = image.size()
+		if spec is not None:
+			image = image.scaled(
+				fit_size(full, spec).boundedTo(full), Qt.AspectRatioMode.IgnoreAspectRatio,
+				Qt.TransformationMode.SmoothTransformation,
+			)
+	return image, full, animated
+
+
+def level_for_scale(scale):
+	# coarsest level having at least the resolution of `scale`
+	if scale >= 1:
+		return 0
+	return int(math.log2(1 / scale))
+
+
+def level_size(full, level):
+	factor = 1 << level
+	return QSize(-(-full.width() // factor), -(-full.height() // factor))
+
+
+def tile_rect(size, col, row):
+	# rect of a tile in a level of `size`
+	rect = QRect(col * TILE_SIZE, row * TILE_SIZE, TILE_SIZE, TILE_SIZE)
+	return rect.intersected(QRect(QPoint(), size))
+
+
+def _raw_rect(rect, size, transformation):
+	# map rect of the transformed image of `size` to the image as stored,
+	# undoing the rotation then the mirroring, see QImageReader.setAutoTransform
+	Transformation = QImageIOHandler.Transformation
+	x, y, width, height = rect.x(), rect.y(), rect.width(), rect.height()
+	if transformation & Transformation.TransformationRotate90:
+		x, y, width, height = y, size.width() - x - width, height, width
+		size = size.transposed()
+	if transformation & Transformation.TransformationMirror:
+		x = size.width() - x - width
+	if transformation & Transformation.TransformationFlip:
+		y = size.height() - y - height
+	return QRect(x, y, width, height)
+
+
+def decode_tiles(path, level, rect):
+	"""Decode tiles of image at path, return a list of (col, row, image)
+
+	`rect` is in coordinates of `level`, aligned on tiles. Formats which
+	can decode a region (JPEG) decode only `rect`, and skip DCT blocks when
+	scaling down. Other formats decode the whole level, then all its tiles
+	are returned, so it is done once.
+	"""
+	reader = QImageReader(path)
+	reader.setAutoTransform(True)
+
+	full = reader.size()
+	transformation = reader.transformation()
+	rotated = bool(transformation & QImageIOHandler.Transformation.TransformationRotate90)
+	if full.isValid() and rotated:
+		full.transpose()
+
+	if full.isValid() and reader.supportsOption(QImageIOHandler.ImageOption.ClipRect):
+		factor = 1 << level
+		clip = QRect(rect.topLeft() * factor, rect.size() * factor).intersected(QRect(QPoint(), full))
+		reader.setClipRect(_raw_rect(clip, full, transformation))
+		scaled = rect.size()
+	else:
+		if not full.isValid():
+			full = reader.read().size()
+			reader = QImageReader(path)
+			reader.setAutoTransform(True)
+		rect = QRect(QPoint(), level_size(full, level))
+		scaled = rect.size()
+	if rotated:
+		scaled.transpose()
+	reader.setScaledSize(scaled)
+
+	image = reader.read()
+	if image.isNull():
+		LOGGER.warning("cannot decode %r: %s", path, reader.errorString())
+		return []
+
+	tiles = []
+	for y in range(0, image.height(), TILE_SIZE):
+		for x in range(0, image.width(), TILE_SIZE):
+			tiles.append((
+				(rect.x() + x) // TILE_SIZE, (rect.y() + y) // TILE_SIZE,
+				image.copy(QRect(x, y, TILE_SIZE, TILE_SIZE).intersected(image.rect())),
+			))
+	return tiles
+
+
+def render_scaled(size, pieces):
+	"""Render pieces of images in a new image of `size`, with smooth scaling
+
+	pieces are (image, source rect, target rect) tuples, painted in order.
+	"""
+	result = QImage(size, QImage.Format.Format_ARGB32_Premultiplied)
+	result.fill(Qt.GlobalColor.transparent)
+	with QPainter(result) as painter:
+		for image, source, target in pieces:
+			scaled = image.copy(source).scaled(
+				target.size(), Qt.AspectRatioMode.IgnoreAspectRatio,
+				Qt.TransformationMode.SmoothTransformation,
+			)
+			painter.drawImage(target.topLeft(), scaled)
+	return result
+
+
+class ImageCache:
+	"""LRU of decoded QImages, using at most `budget` bytes
+
+	Images of `priorities` keys are evicted last, lowest priority first,
+	so prefetching images does not evict the one being displayed.
+	"""
+
+	def __init__(self, budget=CACHE_BUDGET):
+		self.budget = budget
+		self.size = 0
+		self.images = OrderedDict()
+		self.priorities = []
+
+	def __contains__(self, key):
+		return key in self.images
+
+	def get(self, key):
+		try:
+			self.images.move_to_end(key)
+		except KeyError:
+			return None
+		return self.images[key]
+
+	def put(self, key, image):
+		self.discard(key)
+		self.images[key] = image
+		self.size += image.sizeInBytes()
+		self._evict()
+
+	def discard(self, key):
+		image = self.images.pop(key, None)
+		if image is not None:
+			self.size -= image.sizeInBytes()
+
+	def setPriorities(self, keys):
+		# keys from the most to the least important
+		self.priorities = list(keys)
+		self._evict()
+
+	def _evict(self):
+		if self.size <= self.budget:
+			return
+
+		kept = set(self.priorities)
+		victims = [key for key in self.images if key not in kept]
+		victims += [key for key in reversed(self.priorities) if key in self.images]
+		for key in victims:
+			if self.size <= self.budget:
+				break
+			LOGGER.debug("evicting %r from cache", key)
+			self.discard(key)
+
+
+class _DecodeTask(QRunnable):
+	def __init__(self, loader, key, priority):
+		super().__init__()
+		# kept alive by the loader, which may take it back from the pool
+		self.setAutoDelete(False)
+		self.loader = loader
+		self.key = key
+		self.priority = priority
+
+	def run(self):
+		if self.key not in self.loader.wanted:
+			# navigation went elsewhere since it was queued
+			self.loader.decoded.emit(self.key, QImage(), QSize(), False, False)
+			return
+
+		self.loader.decoded.emit(self.key, *decode(*self.key), True)
+
+
+class _TileTask(QRunnable):
+	def __init__(self, loader, path, level, rect, keys):
+		super().__init__()
+		self.loader = loader
+		self.path = path
+		self.level = level
+		self.rect = rect
+		self.keys = keys
+
+	def run(self):
+		if self.loader.wantedTiles.isdisjoint(self.keys):
+			# scrolled away since it was queued
+			self.loader.tilesDecoded.emit(self.path, self.level, self.keys, [])
+			return
+
+		tiles = decode_tiles(self.path, self.level, self.rect)
+		self.loader.tilesDecoded.emit(self.path, self.level, self.keys, tiles)
+
+
+class _RenderTask(QRunnable):
+	def __init__(self, loader, key, size, pieces):
+		super().__init__()
+		self.loader = loader
+		self.key = key
+		self.size = size
+		self.pieces = pieces
+
+	def run(self):
+		if self.key != self.loader.wantedRender:
+			# view changed since it was queued
+			return
+		self.loader.rendered.emit(self.key, render_scaled(self.size, self.pieces))
+
+
+class ImageLoader(QObject):
+	"""Decode images in a thread pool, emitting `loaded` for each
+
+	Images are identified by (path, spec) keys, spec being None for the
+	full resolution, or a box to decode the image for, see decode().
+	Decoded images are put in `cache`, and their full size in `fullSizes`,
+	animated images are added to `animated`.
+	`prefetch()` decodes images which will likely be requested soon.
+
+	Tiles are keyed by (path, level, col, row), they are put in `tiles`
+	and `tileLoaded` is emitted when some are decoded.
+
+	`render()` renders pieces of images with render_scaled(), emitting
+	`rendered` unless another render was requested meanwhile.
+	"""
+
+	# path, spec, image
+	loaded = Signal(str, object, QImage)
+
+	# emitted from pool threads: key, image, full size, animated, whether it was decoded
+	decoded = Signal(object, QImage, QSize, bool, bool)
+
+	# path, level
+	tileLoaded = Signal(str, int)
+
+	# emitted from pool threads: path, level, requested keys, [(col, row, image)]
+	tilesDecoded = Signal(str, int, object, object)
+
+	# key given to render(), rendered image
+	rendered = Signal(object, QImage)
+
+	def __init__(self, parent=None, cache=None, tiles=None):
+		super().__init__(parent)
+		self.cache = cache or ImageCache()
+		self.tiles = tiles or ImageCache(TILE_CACHE_BUDGET)
+		self.pool = QThreadPool(self)
+		# path -> full size of the image
+		self.fullSizes = {}
+		self.animated = set()
+		# key -> task queued or being decoded
+		self.pending = {}
+		# keys which should still be decoded when their turn comes
+		self.wanted = frozenset()
+		# tiles keys queued or being decoded, and those still wanted
+		self.pendingTiles = set()
+		self.wantedTiles = frozenset()
+		self.wantedRender = None
+		self.decoded.connect(self._decoded)
+		self.tilesDecoded.connect(self._tilesDecoded)
+
+	def request(self, path, spec=None):
+		"""Decode image as soon as possible, unless it is in cache"""
+		key = (path, spec)
+		self.wanted = self.wanted | {key}
+		self._start(key, PRIORITY_URGENT)
+
+	def prefetch(self, keys):
+		"""Decode (path, spec) keys in the background, in this order, and drop other requests"""
+		keys = list(keys)
+		self.wanted = frozenset(keys)
+		self.cache.setPriorities(keys)
+		for priority, key in enumerate(reversed(keys)):
+			self._start(key, priority)
+
+	def requestTiles(self, path, level, tiles):
+		"""Decode (col, row) tiles of a level of image, and drop other tiles requests
+
+		Tiles missing from the cache are decoded together, as the smallest
+		rect containing them all.
+		"""
+		keys = [(path, level, col, row) for col, row in tiles]
+		self.wantedTiles = frozenset(keys)
+		self.tiles.setPriorities(keys)
+
+		missing = [key for key in keys if key not in self.tiles and key not in self.pendingTiles]
+		if not missing:
+			return
+
+		size = level_size(self.fullSizes[path], level)
+		rect = QRect()
+		for _, _, col, row in missing:
+			rect = rect.united(tile_rect(size, col, row))
+		self.pendingTiles.update(missing)
+		self.pool.start(_TileTask(self, path, level, rect, missing), PRIORITY_URGENT)
+
+	def render(self, key, size, pieces):
+		"""Render pieces in the background, see render_scaled()"""
+		self.wantedRender = key
+		self.pool.start(_RenderTask(self, key, size, pieces), PRIORITY_URGENT)
+
+	def _start(self, key, priority):
+		if key in self.cache:
+			return
+
+		task = self.pending.get(key)
+		if task is not None:
+			# requeue with a higher priority, unless it already started
+			if priority <= task.priority:
+				return
+			if not self.pool.tryTake(task):
+				# it may have been skipped, _decoded restarts it with this priority
+				task.priority = priority
+				return
+
+		task = self.pending[key] = _DecodeTask(self, key, priority)
+		self.pool.start(task, priority)
+
+	@Slot(object, QImage, QSize, bool, bool)
+	def _decoded(self, key, image, full, animated, done):
+		task = self.pending.pop(key, None)
+		if not done:
+			if task is not None and key in self.wanted:
+				# requested again after the task found it unwanted
+				self._start(key, task.priority)
+			return
+
+		path, spec = key
+		self.fullSizes[path] = full
+		if animated:
+			self.animated.add(path)
+		else:
+			self.animated.discard(path)
+		self.cache.put(key, image)
+		self.loaded.emit(path, spec, image)
+
+	@Slot(str, int, object, object)
+	def _tilesDecoded(self, path, level, keys, tiles):
+		self.pendingTiles.difference_update(keys)
+		for col, row, image in tiles:
+			self.tiles.put((path, level, col, row), image)
+		if tiles:
+			self.tileLoaded.emit(path, level)
+
+	def stop(self):
+		self.wanted = frozenset()
+		self.wantedTiles = frozenset()
+		self.wantedRender = None
+		self.pool.clear()
+		self.pool.waitForDone()
+		self.pending.clear()
+		self.pendingTiles.clear()
@@ -13,9 +13,9 @@ from PyQt6.QtWidgets import (
 	QListView, QInputDialog, QLineEdit, QMessageBox,
 )
 
-from .fileoperationdialog import FileOperationProgressDialog
+from .fileoperationdialog import FileOperation, start_file_operation
 from .fm_interop import mark_for_copy, mark_for_cut, ClipQt, MIME_LIST, _parse_url
-from .fsops import rename_file, FileOperation, trash_items, can_trash
+from .fsops import is_cross_device, rename_file, trash_items
 from . import thumbnailmaker
 
 
@@ -417,7 +417,11 @@ class ImageList(QListView):
 
 		new = current.with_name(new)
 
-		rename_file(current, new, db)
+		if is_cross_device(current, new):
+			# data has to be copied, show progress
+			start_file_operation(self, FileOperation(new, [current], "cut", db))
+		else:
+			rename_file(current, new, db)
 		# TODO update model
 
 	def selectedPaths(self):
@@ -446,22 +450,11 @@ class ImageList(QListView):
 	@Slot(FileOperation)
 	def modelFileOperation(self, treeop):
 		treeop.db = self.window().db
-		dlg = FileOperationProgressDialog(self)
-		dlg.setOp(treeop)
-		dlg.setModal(True)
-		treeop.setParent(dlg)
-		dlg.start()
+		start_file_operation(self, treeop)
 
 	@Slot()
 	def trashSelected(self):
 		paths = self.selectedPaths()
-		if not can_trash():
-			QMessageBox.error(
-				self,
-				self.tr("Trash error"),
-				self.tr("trash-put is not installed, cannot trash files"),
-			)
-			return
 
 		button = QMessageBox.question(
 			self,
@@ -471,4 +464,11 @@ class ImageList(QListView):
 		if button != QMessageBox.StandardButton.Yes:
 			return
 
-		trash_items(paths)
+		try:
+			trash_items(paths, self.window().db)
+		except OSError as exc:
+			QMessageBox.critical(
+				self,
+				self.tr("Trash error"),
+				self.tr("Cannot send items to trash: %s") % exc,
+			)
@@ -1,10 +1,261 @@
 # SPDX-License-Identifier: WTFPL
 
-from PyQt6.QtCore import Qt, pyqtSignal as Signal, pyqtSlot as Slot, QSortFilterProxyModel
-from PyQt6.QtGui import QStandardItem, QStandardItemModel, QAction
+from array import array
+from bisect import bisect_left
+
+from PyQt6.QtCore import (
+	Qt, pyqtSignal as Signal, pyqtSlot as Slot, QAbstractListModel, QModelIndex,
+)
+from PyQt6.QtGui import QAction, QFont
 from PyQt6.QtWidgets import QInputDialog, QVBoxLayout, QDialog, QListView, QLineEdit
 
 
+def _ranges(indexes):
+	# group sorted indexes in consecutive (start, end) ranges
+	start = end = None
+	for idx in indexes:
+		if idx == end:
+			end += 1
+			continue
+		if start is not None:
+			yield start, end
+		start, end = idx, idx + 1
+	if start is not None:
+		yield start, end
+
+
+class TagListModel(QAbstractListModel):
+	"""Model of sorted tags, each having a check state and a count
+
+	Tags are stored in flat arrays instead of one item object per tag, so
+	huge tag lists are cheap to hold and to update. Filtering is done by the
+	model itself, rows are then mapped to the matching subset of tags.
+	"""
+
+	checkStateChanged = Signal(str, Qt.CheckState)
+
+	def __init__(self, parent=None):
+		super().__init__(parent)
+
+		self.tags = []
+		self.counts = array('l')
+		self.states = bytearray()
+
+		self.filter = ''
+		# indexes in self.tags of displayed rows, None when not filtering
+		self.visible = None
+
+		self.showCounts = False
+		self.highlighted = frozenset()
+
+	def _tagIndex(self, row):
+		if self.visible is None:
+			return row
+		return self.visible[row]
+
+	def _row(self, idx):
+		if self.visible is None:
+			return idx
+
+		row = bisect_left(self.visible, idx)
+		if row < len(self.visible) and self.visible[row] == idx:
+			return row
+		return None
+
+	def _matches(self, tag):
+		return self.filter in tag
+
+	def rowCount(self, parent=QModelIndex()):
+		if parent.isValid():
+			return 0
+		if self.visible is None:
+			return len(self.tags)
+		return len(self.visible)
+
+	def data(self, qidx, role=Qt.ItemDataRole.DisplayRole):
+		if not qidx.isValid():
+			return None
+
+		idx = self._tagIndex(qidx.row())
+		if role == Qt.ItemDataRole.DisplayRole and self.showCounts:
+			return f"{self.tags[idx]} ({self.counts[idx]})"
+		elif role in (Qt.ItemDataRole.DisplayRole, Qt.ItemDataRole.UserRole):
+			return self.tags[idx]
+		elif role == Qt.ItemDataRole.CheckStateRole:
+			return Qt.CheckState(self.states[idx])
+		elif role == Qt.ItemDataRole.FontRole and self.tags[idx] in self.highlighted:
+			font = QFont()
+			font.setBold(True)
+			return font
+		return None
+
+	def setData(self, qidx, value, role=Qt.ItemDataRole.EditRole):
+		if not qidx.isValid() or role != Qt.ItemDataRole.CheckStateRole:
+			return False
+
+		state = Qt.CheckState(value)
+		idx = self._tagIndex(qidx.row())
+		self.states[idx] = state.value
+		self.dataChanged.emit(qidx, qidx, [Qt.ItemDataRole.CheckStateRole])
+		self.checkStateChanged.emit(self.tags[idx], state)
+		return True
+
+	def flags(self, qidx):
+		flags = super().flags(qidx)
+		if qidx.isValid():
+			flags |= (
+				Qt.ItemFlag.ItemIsSelectable
+				| Qt.ItemFlag.ItemIsUserCheckable
+				| Qt.ItemFlag.ItemIsEnabled
+				| Qt.ItemFlag.ItemNeverHasChildren
+			)
+		return flags
+
+	def setTags(self, tags):
+		# set tags to use, preserving state of those who existed before and are still here
+		tags = sorted(set(tags))
+		if tags == self.tags:
+			return
+
+		new_tags = set(tags)
+		old_tags = set(self.tags)
+
+		removed = [idx for idx, tag in enumerate(self.tags) if tag not in new_tags]
+		for start, end in reversed(list(_ranges(removed))):
+			self._removeRange(start, end)
+
+		# group added tags by insert position, and insert from the end so
+		# positions computed for preceding groups stay valid
+		groups = []
+		for tag in tags:
+			if tag in old_tags:
+				continue
+
+			pos = bisect_left(self.tags, tag)
+			if groups and groups[-1][0] == pos:
+				groups[-1][1].append(tag)
+			else:
+				groups.append((pos, [tag]))
+
+		for pos, group in reversed(groups):
+			self._insertRange(pos, group)
+
+	def insertTag(self, tag):
+		pos = bisect_left(self.tags, tag)
+		if pos < len(self.tags) and self.tags[pos] == tag:
+			return
+		self._insertRange(pos, [tag])
+
+	def removeTag(self, tag):
+		pos = bisect_left(self.tags, tag)
+		if pos < len(self.tags) and self.tags[pos] == tag:
+			self._removeRange(pos, pos + 1)
+
+	def _removeRange(self, start, end):
+		if self.visible is None:
+			first, last = start, end
+		else:
+			first = bisect_left(self.visible, start)
+			last = bisect_left(self.visible, end)
+
+		if first < last:
+			self.beginRemoveRows(QModelIndex(), first, last - 1)
+
+		del self.tags[start:end]
+		del self.counts[start:end]
+		del self.states[start:end]
+		if self.visible is not None:
+			shift = end - start
+			self.visible[first:] = array('l', (idx - shift for idx in self.visible[last:]))
+
+		if first < last:
+			self.endRemoveRows()
+
+	def _insertRange(self, pos, tags):
+		if self.visible is None:
+			first = pos
+			nrows = len(tags)
+		else:
+			first = bisect_left(self.visible, pos)
+			matching = array('l', (pos + n for n, tag in enumerate(tags) if self._matches(tag)))
+			nrows = len(matching)
+
+		if nrows:
+			self.beginInsertRows(QModelIndex(), first, first + nrows - 1)
+
+		self.tags[pos:pos] = tags
+		self.counts[pos:pos] = array('l', bytes(len(tags) * self.counts.itemsize))
+		self.states[pos:pos] = bytes(len(tags))
+		if self.visible is not None:
+			shift = len(tags)
+			self.visible[first:] = matching + array('l', (idx + shift for idx in self.visible[first:]))
+
+		if nrows:
+			self.endInsertRows()
+
+	def _emitChanged(self, indexes, roles):
+		rows = [row for row in map(self._row, indexes) if row is not None]
+		if rows:
+			self.dataChanged.emit(self.index(min(rows)), self.index(max(rows)), roles)
+
+	def setCheckStates(self, states, default=Qt.CheckState.Unchecked):
+		# states is a dict of tag -> Qt.CheckState, missing tags get default
+		# unlike checking from the view, checkStateChanged is not emitted
+		changed = []
+		for idx, tag in enumerate(self.tags):
+			state = states.get(tag, default).value
+			if self.states[idx] != state:
+				self.states[idx] = state
+				changed.append(idx)
+
+		self._emitChanged(changed, [Qt.ItemDataRole.CheckStateRole])
+
+	def checkedTags(self):
+		checked = Qt.CheckState.Checked.value
+		return [tag for tag, state in zip(self.tags, self.states) if state == checked]
+
+	def setHighlighted(self, tags):
+		# tags to display in bold, like suggestions
+		tags = frozenset(tags)
+		changed = tags ^ self.highlighted
+		self.highlighted = tags
+
+		indexes = []
+		for tag in changed:
+			pos = bisect_left(self.tags, tag)
+			if pos < len(self.tags) and self.tags[pos] == tag:
+				indexes.append(pos)
+		self._emitChanged(indexes, [Qt.ItemDataRole.FontRole])
+
+	def setShowCounts(self, show):
+		self.showCounts = show
+		if self.rowCount():
+			self.dataChanged.emit(self.index(0), self.index(self.rowCount() - 1), [Qt.ItemDataRole.DisplayRole])
+
+	def setCounts(self, counts):
+		# counts is a dict of tag -> int, missing tags get 0
+		changed = []
+		for idx, tag in enumerate(self.tags):
+			count = counts.get(tag, 0)
+			if self.counts[idx] != count:
+				self.counts[idx] = count
+				changed.append(idx)
+
+		self._emitChanged(changed, [Qt.ItemDataRole.DisplayRole])
+
+	def setFilterFixedString(self, text):
+		if text == self.filter:
+			return
+
+		self.beginResetModel()
+		self.filter = text
+		if text:
+			self.visible = array('l', (idx for idx, tag in enumerate(self.tags) if text in tag))
+		else:
+			self.visible = None
+		self.endResetModel()
+
+
 class TagFilter(QLineEdit):
 	def __init__(self, *args, **kwargs):
 		super().__init__(*args, **kwargs)
@@ -19,7 +270,11 @@ class TagFilter(QLineEdit):
 		if not self.widget:
 			return
 
-		self.widget.proxy.setFilterFixedString(self.text())
+		self.widget.data.setFilterFixedString(self.text())
+
+
+# number of suggested tags highlighted in TagEditor
+SUGGESTIONS = 5
 
 
 class TagEditor(QListView):
@@ -31,10 +286,9 @@ class TagEditor(QListView):
 		self.db = None
 		self.paths = []
 
-		self.data = QStandardItemModel(self)
-		self.proxy = QSortFilterProxyModel(self)
-		self.proxy.setSourceModel(self.data)
-		self.setModel(self.proxy)
+		self.data = TagListModel(self)
+		self.setModel(self.data)
+		self.setUniformItemSizes(True)
 
 		self.setContextMenuPolicy(Qt.ContextMenuPolicy.ActionsContextMenu)
 		act = QAction('&Create tag', self)
@@ -45,7 +299,7 @@ class TagEditor(QListView):
 		act.triggered.connect(self._renameTag)
 		self.addAction(act)
 
-		self.data.itemChanged.connect(self._tagStateChanged)
+		self.data.checkStateChanged.connect(self._tagStateChanged)
 
 	def setDb(self, db):
 		self.db = db
@@ -55,15 +309,15 @@ class TagEditor(QListView):
 		tag, ok = QInputDialog.getText(self, 'Enter a tag name', 'New tag')
 		if not ok:
 			return
-		self.data.appendRow(self._createItem(tag))
+		self.data.insertTag(tag)
 		self.changedTags.emit()
 
 	@Slot()
 	def _renameTag(self):
-		item = self.currentItem()
-		if not item:
+		qidx = self.currentIndex()
+		if not qidx.isValid():
 			return
-		old_tag = item.text()
+		old_tag = qidx.data(Qt.ItemDataRole.UserRole)
 
 		new_tag, ok = QInputDialog.getText(self, 'Enter a tag name', 'New tag')
 		if not ok:
@@ -76,56 +330,39 @@ class TagEditor(QListView):
 	def setFile(self, path):
 		return self.setFiles([path])
 
-	def _createItem(self, name):
-		item = QStandardItem(name)
-		item.setFlags(Qt.ItemFlag.ItemIsSelectable | Qt.ItemFlag.ItemIsUserCheckable | Qt.ItemFlag.ItemIsEnabled)
-		item.setCheckState(Qt.CheckState.Unchecked)
-		return item
-
 	def setFiles(self, paths):
-		self.data.clear()
 		self.paths = paths
 
-		tags_per_file = {path: self.db.find_tags_by_file(path) for path in paths}
-		for tag in sorted(self.db.list_tags()):
-			item = self._createItem(tag)
-			item.setCheckState(self._state(tag, tags_per_file))
-			self.data.appendRow(item)
+		# only states that really changed are touched, it keeps scroll and filter intact
+		self.data.setTags(self.db.list_tags())
 
-	def _state(self, tag, tags_per_file):
-		if not tags_per_file:
-			return Qt.CheckState.Unchecked
+		total = len(paths)
+		counts = self.db.count_tags_by_files(paths)
+		self.data.setCheckStates({
+			tag: self._state(count, total) for tag, count in counts.items()
+		})
 
-		has_tag = any(tag in tags for tags in tags_per_file.values())
-		has_untag = any(tag not in tags for tags in tags_per_file.values())
-		if has_tag and has_untag:
-			return Qt.CheckState.PartiallyChecked
-		elif has_tag:
-			return Qt.CheckState.Checked
-		elif has_untag:
-			return Qt.CheckState.Unchecked
-		assert False
-
-		it = iter(tags_per_file.values())
-		first = (tag in it.next())
-		for tags in it:
-			current = (tag in tags)
-			if first != current:
-				return Qt.CheckState.PartiallyChecked
-		if first:
-			return Qt.CheckState.Checked
-		else:
+		suggested = []
+		if paths:
+			suggested = self.db.get_cooccurrence().suggest(counts.keys(), limit=SUGGESTIONS)
+		self.data.setHighlighted(suggested)
+
+	def _state(self, count, total):
+		if not count:
 			return Qt.CheckState.Unchecked
+		elif count < total:
+			return Qt.CheckState.PartiallyChecked
+		return Qt.CheckState.Checked
 
-	@Slot('QStandardItem*')
-	def _tagStateChanged(self, item):
+	@Slot(str, Qt.CheckState)
+	def _tagStateChanged(self, tag, state):
 		with self.db:
-			if item.checkState() == Qt.CheckState.Unchecked:
+			if state == Qt.CheckState.Unchecked:
 				for path in self.paths:
-					self.db.untag_file(path, [item.text()])
+					self.db.untag_file(path, [tag])
 			else:
 				for path in self.paths:
-					self.db.tag_file(path, [item.text()])
+					self.db.tag_file(path, [tag])
 
 	@Slot()
 	def refreshTags(self):
@@ -135,18 +372,17 @@ class TagEditor(QListView):
 class TagChooser(QListView):
 	changed = Signal()
 
-	def __init__(self, *args, **kwargs):
+	def __init__(self, *args, faceted=False, **kwargs):
 		super().__init__(*args, **kwargs)
 		self.db = None
+		self.faceted = False
 
-		self.filter = ''
-
-		self.data = QStandardItemModel(self)
-		self.proxy = QSortFilterProxyModel(self)
-		self.proxy.setSourceModel(self.data)
-		self.setModel(self.proxy)
+		self.data = TagListModel(self)
+		self.setFaceted(faceted)
+		self.setModel(self.data)
+		self.setUniformItemSizes(True)
 
-		self.data.itemChanged.connect(self.changed)
+		self.data.checkStateChanged.connect(self._checkStateChanged)
 
 		self.setContextMenuPolicy(Qt.ContextMenuPolicy.ActionsContextMenu)
 		act = QAction('&Refresh tags', self)
@@ -155,28 +391,26 @@ class TagChooser(QListView):
 
 	def setDb(self, db):
 		self.db = db
+		self.refreshTags()
 
-		for t in sorted(self.db.list_tags()):
-			item = QStandardItem(t)
-			item.setFlags(Qt.ItemFlag.ItemIsSelectable | Qt.ItemFlag.ItemIsUserCheckable | Qt.ItemFlag.ItemIsEnabled)
-			item.setCheckState(Qt.CheckState.Unchecked)
-			self.data.appendRow(item)
+	def setFaceted(self, faceted):
+		# for browsing, picking tags for something else needs them all
+		self.faceted = faceted
+		self.data.setShowCounts(faceted)
+		if self.db:
+			self.refreshTags()
 
 	def setTags(self, tags):
-		for i in range(self.data.rowCount()):
-			item = self.data.item(i)
-			if item.text() in tags:
-				item.setCheckState(Qt.CheckState.Checked)
-			else:
-				item.setCheckState(Qt.CheckState.Unchecked)
+		self.data.setCheckStates({tag: Qt.CheckState.Checked for tag in tags})
+		self.refreshTags()
 
 	def selectedTags(self):
-		tags = []
-		for i in range(self.data.rowCount()):
-			item = self.data.item(i)
-			if item.checkState() == Qt.CheckState.Checked:
-				tags.append(item.text())
-		return tags
+		return self.data.checkedTags()
+
+	@Slot(str, Qt.CheckState)
+	def _checkStateChanged(self, tag, state):
+		self.refreshTags()
+		self.changed.emit()
 
 	def matchingFiles(self):
 		tags = self.selectedTags()
@@ -189,9 +423,18 @@ class TagChooser(QListView):
 
 	@Slot()
 	def refreshTags(self):
+		if not self.faceted:
+			self.data.setTags(self.db.list_tags())
+			return
+
+		# only show tags co-occurring with the checked ones, with the number of
+		# files that would match if they were checked too, so dead ends are hidden
 		selected = self.selectedTags()
-		self.setDb(self.db)
-		self.setTags(selected)
+		counts = self.db.facet_tags(selected)
+
+		# check states of tags still existing are kept by the model
+		self.data.setTags(counts.keys() | set(selected))
+		self.data.setCounts(counts)
 
 
 class TagChooserDialog(QDialog):
@@ -199,7 +442,8 @@ class TagChooserDialog(QDialog):
 		super().__init__(*args, **kwargs)
 		self.db = db
 
-		self.chooser = TagChooser(db, parent=self)
+		self.chooser = TagChooser(parent=self)
+		self.chooser.setDb(db)
 		self.setLayout(QVBoxLayout())
 		self.layout().addWidget(self.chooser)
 
@@ -12,6 +12,12 @@ from PyQt6.QtMultimedia import (
 from .tagwidgets import TagChooserDialog
 
 
+def _formatTime(ms):
+	if ms is None:
+		return ''
+	return '%d' % (ms / 1000)
+
+
 class SeekSlider(QSlider):
 	def __init__(self, mp):
 		super().__init__(Qt.Orientation.Horizontal)
@@ -283,8 +289,13 @@ class VideoTagEditor(QWidget):
 
 	@Slot()
 	def delRow(self):
-		self.table.removeRow(self.table.currentRow())
-		self.saveTags()
+		row = self.table.currentRow()
+		shared = self._otherRowsIds(row)
+		to_remove = [id for id in self._rowSegments(row).values() if id not in shared]
+		if to_remove:
+			with self.db:
+				self.db.update_file_segments(self.path, remove=to_remove)
+		self.table.removeRow(row)
 
 	@Slot()
 	def addRow(self):
@@ -293,38 +304,92 @@ class VideoTagEditor(QWidget):
 		for col in range(self.table.columnCount()):
 			self.table.setItem(n, col, QTableWidgetItem())
 
+	def _rowSegments(self, row):
+		# {(tag, start, end): tags_files id} saved for a row, kept in its first cell
+		item = self.table.item(row, 0)
+		if item is None:
+			return {}
+		return item.data(Qt.ItemDataRole.UserRole) or {}
+
+	def _otherRowsIds(self, row):
+		# rows with the same (tag, start, end) share a tags_files id
+		ids = set()
+		for other in range(self.table.rowCount()):
+			if other != row:
+				ids.update(self._rowSegments(other).values())
+		return ids
+
+	def _setRowSegments(self, row, segments):
+		blocking = self.table.blockSignals(True)
+		try:
+			self.table.item(row, 0).setData(Qt.ItemDataRole.UserRole, segments)
+		finally:
+			self.table.blockSignals(blocking)
+
+	def _cellTime(self, row, col, saved, default):
+		text = self.table.item(row, col).text()
+		if not text:
+			return default
+		if text == _formatTime(saved):
+			# displayed time is truncated, don't lose the saved precision
+			return saved
+		return int(text) * 1000
+
 	def loadTags(self):
-		blocking = self.table.signalsBlocked()
+		blocking = self.table.blockSignals(True)
 		try:
-			self.table.blockSignals(True)
-			tags = self.db.find_tags_by_file(self.path)
-			for t in tags:
-				for start, end in self.db.get_extras_for_file(self.path, t):
-					n = self.table.rowCount()
-					self.table.insertRow(n)
-					self.table.setItem(n, 0, QTableWidgetItem(t))
-					self.table.setItem(n, 1, QTableWidgetItem('%d' % (start / 1000)))
-					self.table.setItem(n, 2, QTableWidgetItem('%d' % (end / 1000)))
+			self.table.setRowCount(0)
+			for id, tag, start, end in self.db.get_file_segments(self.path):
+				n = self.table.rowCount()
+				self.table.insertRow(n)
+				item = QTableWidgetItem(tag)
+				item.setData(Qt.ItemDataRole.UserRole, {(tag, start, end): id})
+				self.table.setItem(n, 0, item)
+				self.table.setItem(n, 1, QTableWidgetItem(_formatTime(start)))
+				self.table.setItem(n, 2, QTableWidgetItem(_formatTime(end)))
 		finally:
 			self.table.blockSignals(blocking)
 
-	def saveTags(self):
-		duration = self.video.duration() / 1000
+	def saveRow(self, row):
+		current = self._rowSegments(row)
+
+		tags = [t for t in self.table.item(row, 0).text().split(' ') if t]
+		# all tags of a row share the same time range
+		saved_start = saved_end = None
+		for _, saved_start, saved_end in current:
+			break
+
+		if current and saved_start is None and saved_end is None:
+			# untimed tags stay untimed unless times are entered
+			default_start = default_end = None
+		else:
+			default_start = 0
+			default_end = int(self.video.duration() / 1000) * 1000
+		start = self._cellTime(row, 1, saved_start, default_start)
+		end = self._cellTime(row, 2, saved_end, default_end)
+		wanted = {(tag, start, end) for tag in tags}
+
+		removed = [id for key, id in current.items() if key not in wanted]
+		to_add = [key for key in wanted if key not in current]
+		if not removed and not to_add:
+			return
+
+		shared = self._otherRowsIds(row)
+		to_remove = [id for id in removed if id not in shared]
 
 		with self.db:
-			self.db.remove_file(self.path)
-			for i in range(self.table.rowCount()):
-				tags = self.table.item(i, 0).text().split(' ')
-				tags = [t for t in tags if t]
-				if not tags:
-					continue
-				start = int(self.table.item(i, 1).text() or 0) * 1000
-				end = int(self.table.item(i, 2).text() or duration) * 1000
-				for tag in tags:
-					self.db.tag_file(self.path, tag, start, end)
+			ids = self.db.update_file_segments(self.path, remove=to_remove, add=to_add)
+
+		segments = {key: id for key, id in current.items() if key in wanted}
+		segments.update(zip(to_add, ids))
+		self._setRowSegments(row, segments)
+
+	def saveTags(self):
+		for row in range(self.table.rowCount()):
+			self.saveRow(row)
 
 	def _itemChanged(self, qitem):
-		self.saveTags()
+		self.saveRow(qitem.row())
 
 	def _itemDClicked(self, item):
 		if item.column() != 0:
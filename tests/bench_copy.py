@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: WTFPL
+
+"""Compare the parallel copy scheduler to a serial copy
+
+Usage: python tests/bench_copy.py [DIR [FILES [SIZE]]]
+
+Creates FILES files of SIZE bytes in DIR (default: a temporary directory),
+then copies them with fsops.Transfer, with 1 worker and the default number.
+Page cache is dropped between runs when possible (needs root), else the
+copies are from cache and measure the per-file overhead only.
+"""
+
+from pathlib import Path
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from sittagger import fsops
+
+
+def drop_caches():
+	try:
+		subprocess.run(['sync'], check=True)
+		with open('/proc/sys/vm/drop_caches', 'w') as fd:
+			fd.write('3\n')
+	except OSError:
+		return False
+	return True
+
+
+def main():
+	base = Path(sys.argv[1] if len(sys.argv) > 1 else tempfile.mkdtemp())
+	count = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+	size = int(sys.argv[3]) if len(sys.argv) > 3 else 16 * 1024
+
+	src = base / 'bench-src'
+	src.mkdir(parents=True)
+	data = os.urandom(size)
+	for n in range(count):
+		subdir = src / str(n % 50)
+		subdir.mkdir(exist_ok=True)
+		(subdir / ('%d.bin' % n)).write_bytes(data)
+
+	try:
+		for workers in (1, fsops.COPY_WORKERS):
+			dest = base / ('bench-dest-%d' % workers)
+			dest.mkdir()
+			cold = drop_caches()
+
+			start = time.perf_counter()
+			fsops.Transfer(dest, [src], 'copy', None, workers=workers).run()
+			elapsed = time.perf_counter() - start
+
+			print('%d workers: %d files of %d bytes in %.2fs (%s cache)' % (
+				workers, count, size, elapsed, 'cold' if cold else 'warm',
+			))
+			shutil.rmtree(dest)
+	finally:
+		shutil.rmtree(src)
+
+
+if __name__ == '__main__':
+	main()
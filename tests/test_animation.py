@@ -0,0 +1,123 @@
+# SPDX-License-Identifier: WTFPL
+
+import struct
+
+import pytest
+
+pytest.importorskip("PyQt6")
+
+from PyQt6.QtGui import QColor  # noqa: E402
+
+from sittagger.animation import AnimationPlayer, FrameDecoder  # noqa: E402
+from sittagger.imageloader import decode  # noqa: E402
+
+
+PALETTE = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (0, 0, 0)]
+
+
+def write_gif(path, frames, size=8, delay=5):
+	# frames are palette indexes filling the whole image, Qt can't write GIFs
+	out = [b"GIF89a", struct.pack("<HHBBB", size, size, 0xF1, 0, 0)]
+	out.extend(bytes(color) for color in PALETTE)
+	out.append(b"\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00")
+	for index in frames:
+		out.append(struct.pack("<BBBBHBB", 0x21, 0xF9, 4, 0, delay, 0, 0))
+		out.append(struct.pack("<BHHHHB", 0x2C, 0, 0, size, size, 0))
+
+		# 3 bits LZW codes, with a clear code every 2 pixels so the code size
+		# never grows: clear is 4, end is 5
+		codes = []
+		for _ in range(0, size * size, 2):
+			codes.extend((4, index, index))
+		codes.append(5)
+		bits = sum(code << (3 * n) for n, code in enumerate(codes))
+		data = bits.to_bytes((3 * len(codes) + 7) // 8, "little")
+
+		out.append(b"\x02")
+		for n in range(0, len(data), 255):
+			out.append(bytes([len(data[n:n + 255])]) + data[n:n + 255])
+		out.append(b"\x00")
+	out.append(b"\x3b")
+	path.write_bytes(b"".join(out))
+	return str(path)
+
+
+def color_index(image):
+	return PALETTE.index(QColor(image.pixel(0, 0)).getRgb()[:3])
+
+
+def test_decode_animated(tmp_path):
+	path = write_gif(tmp_path / "anim.gif", [0, 1, 2])
+	image, full, animated = decode(path)
+	assert animated
+	assert color_index(image) == 0
+	assert (full.width(), full.height()) == (8, 8)
+
+	_, _, animated = decode(write_gif(tmp_path / "still.gif", [1]))
+	assert not animated
+
+
+def take_all(decoder, count, qtbot):
+	# (index, color index, delay) of frames, as they are decoded
+	result = []
+	for index in range(count):
+		frame = None
+
+		def taken():
+			nonlocal frame
+			frame = decoder.take(index)
+			return frame is not None
+
+		qtbot.waitUntil(taken, timeout=2000)
+		result.append((frame[0], color_index(frame[1]), frame[2]))
+	return result
+
+
+def test_decoder_fits(qtbot, tmp_path):
+	path = write_gif(tmp_path / "anim.gif", [0, 1, 2])
+	decoder = FrameDecoder(path, maxFrames=2)
+	decoder.start()
+
+	frames = take_all(decoder, 7, qtbot)
+	assert [frame[:2] for frame in frames] == [(n % 3, n % 3) for n in range(7)]
+	assert {frame[2] for frame in frames} == {50}
+
+	# decoded once, replayed from memory
+	assert decoder.wait(2000)
+	assert len(decoder.allFrames) == 3
+	decoder.stop()
+
+
+def test_decoder_budget(qtbot, tmp_path):
+	path = write_gif(tmp_path / "anim.gif", [0, 1, 2, 3] * 5)
+	# 256 bytes per frame
+	decoder = FrameDecoder(path, budget=1000)
+	decoder.start()
+
+	qtbot.waitUntil(lambda: len(decoder.frames) == 3)
+	qtbot.wait(50)
+	assert len(decoder.frames) == 3
+	assert decoder.size <= 1000
+
+	frames = take_all(decoder, 45, qtbot)
+	assert [frame[1] for frame in frames] == [n % 4 for n in range(45)]
+	# decoded again for each loop
+	assert decoder.allFrames is None
+	assert decoder.isRunning()
+	decoder.stop()
+	assert decoder.isFinished()
+
+
+def test_player(qtbot, tmp_path):
+	path = write_gif(tmp_path / "anim.gif", [0, 1, 2], delay=1)
+	player = AnimationPlayer(path)
+	shown = []
+	player.frameChanged.connect(lambda image: shown.append(color_index(image)))
+	player.start()
+
+	qtbot.waitUntil(lambda: len(shown) >= 4, timeout=2000)
+	assert shown[:4] == [0, 1, 2, 0]
+	player.stop()
+	count = len(shown)
+	qtbot.wait(150)
+	assert len(shown) == count
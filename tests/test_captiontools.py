@@ -98,3 +98,11 @@ def test_clean_spaces(input, expected):
 )
 def test_rename_tag_in_caption(input_caption, old_tag, new_tag, expected):
 	assert captiontools.rename_tag_in_caption(input_caption, old_tag, new_tag) == expected
+
+
+def test_aliases():
+	aliases = {"kitty": "cat", "cats": "cat"}
+	caption = "my #kitty and #[cats] and a #dog"
+	assert captiontools.extract_tags_from_caption(caption, aliases) == ["cat", "cat", "dog"]
+	assert captiontools.tags_to_caption(["cat", "dog"], caption, aliases) == caption
+	assert captiontools.tags_to_caption(["dog"], caption, aliases) == "my and and a #dog"
@@ -0,0 +1,76 @@
+# SPDX-License-Identifier: WTFPL
+
+import pytest
+
+from sittagger import dbtag
+
+
+@pytest.fixture
+def db():
+	result = dbtag.Db()
+	result.open(":memory:")
+	result.do_migrations()
+	yield result
+	result.close()
+
+
+@pytest.fixture
+def a_few_tags(db):
+	db.tag_file("/cat1", ["cat", "animal", "cute"])
+	db.tag_file("/cat2", ["cat", "animal"])
+	db.tag_file("/dog", ["dog", "animal"])
+	db.tag_file("/car", ["car", "red"])
+	db.tag_file("/apple", ["apple", "red"])
+
+
+def matrix_state(matrix):
+	return {
+		(tag_a, tag_b): matrix.count(tag_a, tag_b)
+		for tag_a in matrix.names
+		for tag_b in matrix.names
+		if matrix.count(tag_a, tag_b)
+	}
+
+
+def test_count(db, a_few_tags):
+	matrix = db.get_cooccurrence()
+	assert matrix.count("cat", "animal") == 2
+	assert matrix.count("animal", "cat") == 2
+	assert matrix.count("cat", "dog") == 0
+	assert matrix.count("cat", "nonexistent") == 0
+	assert matrix.total == 5
+
+
+def test_incremental(db, a_few_tags):
+	matrix = db.get_cooccurrence()
+	matrix.count("cat", "animal")
+
+	db.tag_file("/dog", ["cute"])
+	db.untag_file("/cat1", ["animal"])
+	db.tag_file("/new", ["cat", "red"])
+	db.remove_file("/car")
+	incremental = (matrix_state(matrix), matrix.total)
+
+	matrix.rebuild()
+	assert incremental == (matrix_state(matrix), matrix.total)
+	assert matrix.count("cat", "animal") == 1
+	assert matrix.count("dog", "cute") == 1
+
+
+def test_invalidate(db, a_few_tags):
+	matrix = db.get_cooccurrence()
+	assert matrix.count("cat", "animal") == 2
+
+	db.rename_tag("animal", "beast")
+	assert matrix.count("cat", "animal") == 0
+	assert matrix.count("cat", "beast") == 2
+
+
+def test_suggest(db, a_few_tags):
+	matrix = db.get_cooccurrence()
+	assert matrix.suggest(["cat"], limit=2) == ["animal", "cute"]
+	assert matrix.suggest(["red"], limit=5) == ["apple", "car"]
+	assert "animal" not in matrix.suggest(["cat"], exclude=["animal"])
+
+	# no context: most used tags
+	assert matrix.suggest([], limit=2) == ["animal", "cat"]
@@ -0,0 +1,86 @@
+# SPDX-License-Identifier: WTFPL
+
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from sittagger import cli, daemon, dbtag
+
+
+@pytest.fixture
+def tagged_db(db_path):
+	db = dbtag.Db()
+	db.open(db_path)
+	with db:
+		db.do_migrations()
+		db.tag_file("/foo", ["tag1"])
+		db.tag_file("/bar", ["tag1", "tag2"])
+	db.close()
+	return str(db_path)
+
+
+@pytest.fixture
+def runtime_dir(tmp_path, monkeypatch):
+	monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+	return tmp_path
+
+
+@pytest.fixture
+def server(tagged_db, runtime_dir):
+	path = daemon.socket_path(tagged_db)
+	proc = subprocess.Popen([sys.executable, "-m", "sittagger.cli", "-d", tagged_db, "serve"])
+	try:
+		deadline = time.monotonic() + 10
+		while not daemon.call_status(path):
+			assert proc.poll() is None and time.monotonic() < deadline
+			time.sleep(.05)
+		yield path
+	finally:
+		proc.terminate()
+		proc.wait()
+	assert not os.path.exists(path)
+
+
+def test_serve_round_trip(tagged_db, server):
+	stdout = io.StringIO()
+	stderr = io.StringIO()
+	status = daemon.call(server, ["-d", tagged_db, "query", "tag1"], os.getcwd(), stdout, stderr)
+	assert status == 0
+	assert sorted(stdout.getvalue().splitlines()) == ["/bar", "/foo"]
+
+	# argparse errors exit with status 2
+	stdout = io.StringIO()
+	status = daemon.call(server, ["-d", tagged_db, "nonexistent"], os.getcwd(), stdout, stderr)
+	assert status == 2
+	assert stdout.getvalue() == ""
+	assert "invalid choice" in stderr.getvalue()
+
+
+def test_run_request_exit(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+
+	def run(argv):
+		print("output")
+		sys.exit(argv[0])
+
+	def request(argv):
+		wfile = io.BytesIO()
+		daemon._run_request(run, {"argv": argv, "cwd": str(tmp_path)}, wfile)
+		return [json.loads(line) for line in wfile.getvalue().splitlines()]
+
+	assert request([None]) == [{"stdout": "output\n"}, {"status": 0}]
+	assert request([3]) == [{"stdout": "output\n"}, {"status": 3}]
+	assert request(["message"]) == [{"stdout": "output\n"}, {"stderr": "message\n"}, {"status": 1}]
+
+
+def test_cli_without_daemon(tagged_db, runtime_dir, monkeypatch, capsys):
+	assert not daemon.call_status(daemon.socket_path(tagged_db))
+
+	monkeypatch.setattr(sys, "argv", ["sit-tagger-cli", "-d", tagged_db, "query", "tag2"])
+	assert cli.main() == 0
+	assert capsys.readouterr().out == "/bar\n"
@@ -52,6 +52,24 @@ def test_find_files_by_tags(db, a_few_tags):
 	assert set(db.find_files_by_tags(["tag2"])) == {"/bar"}
 	assert set(db.find_files_by_tags(["tag3"])) == {"/foo", "/bar"}
 	assert set(db.find_files_by_tags(["tag3", "tag1"])) == {"/foo"}
+	assert list(db.find_files_by_tags([])) == []
+
+
+def test_count_tags_by_files(db, a_few_tags):
+	assert db.count_tags_by_files(["/foo"]) == {"tag1": 1, "tag3": 1}
+	assert db.count_tags_by_files(["/foo", "/bar"]) == {"tag1": 1, "tag2": 1, "tag3": 2}
+	assert db.count_tags_by_files(["/nonexistent"]) == {}
+	assert db.count_tags_by_files([]) == {}
+
+
+def test_facet_tags(db, a_few_tags):
+	assert db.facet_tags([]) == {"tag1": 1, "tag2": 1, "tag3": 2}
+	assert db.facet_tags(["tag3"]) == {"tag1": 1, "tag2": 1, "tag3": 2}
+	assert db.facet_tags(["tag1"]) == {"tag1": 1, "tag3": 1}
+	assert db.facet_tags(["tag1", "tag2"]) == {}
+
+	db.tag_file("/bar", ["tag1"])
+	assert db.facet_tags(["tag1"]) == {"tag1": 2, "tag2": 1, "tag3": 2}
 
 
 def test_remove_file(db, a_few_tags):
@@ -124,3 +142,249 @@ def test_caption_rename_tag(db, a_few_tags):
 	db.rename_file("/foo", "/bar")
 
 	assert db.get_caption("/bar") == "#tag1 test #tag4"
+
+
+def test_hierarchy(db):
+	db.tag_file("/cat", ["animal/cat"])
+	db.tag_file("/kitten", ["animal/cat/kitten"])
+	db.tag_file("/dog", ["animal/dog"])
+
+	assert set(db.find_files_by_tags(["animal"])) == {"/cat", "/kitten", "/dog"}
+	assert set(db.find_files_by_tags(["animal/cat"])) == {"/cat", "/kitten"}
+	assert set(db.find_files_by_tags(["animal/cat/kitten"])) == {"/kitten"}
+	assert set(db.find_implied_tags("animal/cat/kitten")) == {"animal/cat", "animal"}
+
+
+def test_implication(db, a_few_tags):
+	db.add_tag_implication("tag1", "tag5")
+	assert set(db.find_files_by_tags(["tag5"])) == {"/foo"}
+
+	db.add_tag_implication("tag5", "tag6")
+	db.add_tag_implication("tag2", "tag1")
+	assert set(db.find_files_by_tags(["tag6"])) == {"/foo", "/bar"}
+	assert set(db.find_files_by_tags(["tag6", "tag2"])) == {"/bar"}
+	assert set(db.find_implied_tags("tag2")) == {"tag1", "tag5", "tag6"}
+	assert set(db.list_tag_implications()) == {("tag1", "tag5"), ("tag5", "tag6"), ("tag2", "tag1")}
+
+	db.remove_tag_implication("tag1", "tag5")
+	assert set(db.find_files_by_tags(["tag6"])) == set()
+	assert set(db.find_implied_tags("tag2")) == {"tag1"}
+
+	# tags themselves are not changed
+	assert set(db.find_tags_by_file("/bar")) == {"tag2", "tag3"}
+
+
+def test_rename_tag_implication(db):
+	db.tag_file("/cat", ["animal/cat"])
+	db.tag_file("/kitten", ["kitten"])
+	db.add_tag_implication("kitten", "animal/cat")
+	db.add_tag_implication("animal/cat", "pet")
+
+	db.rename_tag("animal/cat", "feline/cat")
+	assert set(db.list_tag_implications()) == {("kitten", "feline/cat"), ("feline/cat", "pet"), ("feline/cat", "feline")}
+	assert set(db.find_implied_tags("kitten")) == {"feline/cat", "feline", "pet"}
+	assert set(db.find_files_by_tags(["animal"])) == set()
+	assert set(db.find_files_by_tags(["animal/cat"])) == set()
+	assert set(db.find_files_by_tags(["feline"])) == {"/cat", "/kitten"}
+	assert set(db.find_files_by_tags(["pet"])) == {"/cat", "/kitten"}
+
+
+def test_facet_tags_implication(db, a_few_tags):
+	db.add_tag_implication("tag1", "tag0")
+	db.add_tag_implication("tag2", "tag0")
+	assert db.facet_tags(["tag0"]) == {"tag0": 2, "tag1": 1, "tag2": 1, "tag3": 2}
+	assert db.facet_tags(["tag1"]) == {"tag0": 1, "tag1": 1, "tag3": 1}
+
+
+def test_migration_hierarchy(db_path):
+	db = dbtag.Db()
+	db.open(db_path)
+	saved = dbtag.UPGRADES
+	try:
+		dbtag.UPGRADES = {ver: stmts for ver, stmts in saved.items() if ver < 3}
+		db.do_migrations()
+	finally:
+		dbtag.UPGRADES = saved
+
+	db.db.execute("INSERT INTO tags_files (file, tag) VALUES ('/a', 'x/y/z'), ('/b', 'x/w')")
+	db.do_migrations()
+
+	assert set(db.list_tag_implications()) == {("x/y/z", "x/y"), ("x/y", "x"), ("x/w", "x")}
+	assert set(db.find_files_by_tags(["x"])) == {"/a", "/b"}
+	assert set(db.find_files_by_tags(["x/y"])) == {"/a"}
+	db.close()
+
+
+def test_aliases(db, a_few_tags):
+	db.tag_file("/baz", ["tag1", "alias1"])
+	db.set_caption("/qux", "#alias2 text")
+	db.add_tag_aliases("tag1", ["alias1", "alias2"])
+
+	assert set(db.list_tags()) == {"tag1", "tag2", "tag3"}
+	assert set(db.find_tags_by_file("/baz")) == {"tag1"}
+	assert db.count_tags_by_files(["/baz"]) == {"tag1": 1}
+	assert set(db.find_files_by_tags(["alias1"])) == {"/foo", "/baz", "/qux"}
+	assert set(db.list_tag_aliases()) == {("alias1", "tag1"), ("alias2", "tag1")}
+
+	db.tag_file("/bar", ["alias2"])
+	assert set(db.find_tags_by_file("/bar")) == {"tag1", "tag2", "tag3"}
+
+	# the caption keeps the alias
+	db.tag_file("/qux", ["tag2"])
+	assert db.get_caption("/qux") == "#alias2 text #tag2"
+
+	db.set_caption("/new", "#alias1 and #tag3")
+	assert set(db.find_tags_by_file("/new")) == {"tag1", "tag3"}
+
+	db.untag_file("/new", ["alias1"])
+	assert set(db.find_tags_by_file("/new")) == {"tag3"}
+
+
+def test_aliases_captions(db):
+	db.set_caption("/file", "my #kitty")
+	db.add_tag_aliases("cat", ["kitty"])
+
+	# captions are not rewritten
+	assert db.get_caption("/file") == "my #kitty"
+	assert db.find_tags_by_file("/file") == ["cat"]
+
+	# and keep matching tags when saved again
+	db.set_caption("/file", "my #kitty again")
+	assert db.find_tags_by_file("/file") == ["cat"]
+	db.tag_file("/file", ["cat"])
+	assert db.get_caption("/file") == "my #kitty again"
+
+
+def test_aliases_segments(db):
+	db.update_file_segments("/video", add=[("tag1", 1000, 2000), ("alias1", 1000, 2000), ("alias1", 3000, 4000)])
+	db.add_tag_aliases("tag1", ["alias1"])
+
+	assert sorted(db.get_extras_for_file("/video", "tag1")) == [(1000, 2000), (3000, 4000)]
+	assert db.get_extras_for_file("/video", "alias1") == []
+
+
+def test_aliases_chain(db, a_few_tags):
+	db.add_tag_implication("tag2", "tag5")
+	db.add_tag_aliases("tag5", ["tag6"])
+	db.add_tag_aliases("tag4", ["tag5"])
+	assert dict(db.list_tag_aliases()) == {"tag5": "tag4", "tag6": "tag4"}
+	assert set(db.list_tag_implications()) == {("tag2", "tag4")}
+	assert set(db.find_files_by_tags(["tag6"])) == {"/bar"}
+
+	db.remove_tag_aliases(["tag6"])
+	assert dict(db.list_tag_aliases()) == {"tag5": "tag4"}
+	assert set(db.find_files_by_tags(["tag6"])) == set()
+
+
+def test_find_segments(db):
+	db.tag_file("/video1", ["goal"], 700_000, 730_000)
+	db.tag_file("/video1", ["goal"], 10_000, 15_000)
+	db.tag_file("/video2", ["goal"], 715_000, 800_000)
+	db.tag_file("/video2", ["foul"], 720_000, 721_000)
+	db.tag_file("/image", ["goal"])
+
+	assert db.find_segments("goal", at=720_000) == [
+		("/video1", "goal", 700_000, 730_000),
+		("/video2", "goal", 715_000, 800_000),
+	]
+	assert db.find_segments(at=720_000) == [
+		("/video1", "goal", 700_000, 730_000),
+		("/video2", "goal", 715_000, 800_000),
+		("/video2", "foul", 720_000, 721_000),
+	]
+	assert db.find_segments("goal", overlapping=(0, 12_000)) == [("/video1", "goal", 10_000, 15_000)]
+	assert db.find_segments("goal", min_duration=30_000) == [
+		("/video1", "goal", 700_000, 730_000),
+		("/video2", "goal", 715_000, 800_000),
+	]
+	assert db.find_segments("goal", at=20_000) == []
+
+	db.untag_file("/video1", ["goal"])
+	db.rename_file("/video2", "/video3")
+	assert db.find_segments("goal") == [("/video3", "goal", 715_000, 800_000)]
+
+	db.db.execute("UPDATE tags_files SET start = 0 WHERE file = '/video3' AND tag = 'goal'")
+	assert db.find_segments("goal", at=10) == [("/video3", "goal", 0, 800_000)]
+
+
+def test_retag_segment(db):
+	db.tag_file("/video", ["goal"], 1000, 2000)
+	db.tag_file("/video", ["goal"], 1000, 2000)
+
+	ids = [row[0] for row in db.db.execute("SELECT id FROM tags_files")]
+	assert [row[0] for row in db.db.execute("SELECT id FROM segments")] == ids
+	assert db.find_segments("goal") == [("/video", "goal", 1000, 2000)]
+
+
+def test_migration_segments(db_path):
+	db = dbtag.Db()
+	db.open(db_path)
+	saved = dbtag.UPGRADES
+	try:
+		dbtag.UPGRADES = {ver: stmts for ver, stmts in saved.items() if ver < 5}
+		db.do_migrations()
+	finally:
+		dbtag.UPGRADES = saved
+
+	db.tag_file("/video", ["goal"], 1000, 2000)
+	db.tag_file("/image", ["goal"])
+	db.do_migrations()
+
+	assert db.find_segments("goal", at=1500) == [("/video", "goal", 1000, 2000)]
+	assert set(db.find_files_by_tags(["goal"])) == {"/video", "/image"}
+	db.close()
+
+
+def test_update_file_segments(db):
+	db.tag_file("/video", ["plain"])
+	db.set_caption("/video", "a #plain video")
+
+	id1, id2 = db.update_file_segments("/video", add=[("goal", 1000, 2000), ("foul", 500, 600)])
+	assert db.get_file_segments("/video") == [
+		(db.get_file_segments("/video")[0][0], "plain", None, None),
+		(id2, "foul", 500, 600),
+		(id1, "goal", 1000, 2000),
+	]
+	assert db.get_caption("/video") in ("a #plain video #foul #goal", "a #plain video #goal #foul")
+
+	(id3,) = db.update_file_segments("/video", remove=[id1], add=[("goal", 1000, 3000)])
+	assert db.find_segments("goal") == [("/video", "goal", 1000, 3000)]
+	assert set(db.find_tags_by_file("/video")) == {"plain", "foul", "goal"}
+
+	db.update_file_segments("/video", remove=[id2, id3])
+	assert db.find_segments() == []
+	assert db.get_caption("/video") == "a #plain video"
+
+
+def test_bulk_tag_files(db, a_few_tags):
+	db.set_caption("/foo", "some #tag1 #tag3 text")
+	db.tag_files([("/foo", "tag2"), ("/foo", "tag1"), ("/baz", "tag2"), ("/baz", "a/b")])
+	assert set(db.find_tags_by_file("/foo")) == {"tag1", "tag2", "tag3"}
+	assert set(db.find_tags_by_file("/baz")) == {"tag2", "a/b"}
+	assert set(db.find_files_by_tags(["tag2"])) == {"/foo", "/bar", "/baz"}
+	assert set(db.find_files_by_tags(["a"])) == {"/baz"}
+	assert "#tag2" in db.get_caption("/foo")
+
+	# already set tags are not duplicated
+	assert db.db.execute("SELECT COUNT(*) FROM tags_files WHERE file = '/foo'").fetchone()[0] == 3
+
+	db.untag_files([("/foo", "tag2"), ("/baz", "tag2"), ("/bar", "nonexistent")])
+	assert set(db.find_tags_by_file("/foo")) == {"tag1", "tag3"}
+	assert set(db.find_tags_by_file("/baz")) == {"a/b"}
+	assert "#tag2" not in db.get_caption("/foo")
+
+
+def test_bulk_rename_untrack_files(db, a_few_tags):
+	db.set_caption("/foo", "#tag1")
+	db.rename_files([("/foo", "/foo2"), ("/foo2", "/foo3"), ("/nonexistent", "/x")])
+	assert set(db.list_files()) == {"/foo3", "/bar"}
+	assert db.get_caption("/foo3") == "#tag1"
+
+	db.untrack_files(["/foo3", "/bar"])
+	assert set(db.list_files()) == set()
+	assert db.get_caption("/foo3") is None
+
+
+def test_find_tags_by_files(db, a_few_tags):
+	result = [(path, set(tags)) for path, tags in db.find_tags_by_files(["/bar", "/nonexistent", "/foo"])]
+	assert result == [("/bar", {"tag2", "tag3"}), ("/nonexistent", set()), ("/foo", {"tag1", "tag3"})]
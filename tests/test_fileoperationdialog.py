@@ -0,0 +1,25 @@
+# SPDX-License-Identifier: WTFPL
+
+import pytest
+
+pytest.importorskip("PyQt6")
+
+from sittagger import dbtag  # noqa: E402
+from sittagger.fileoperationdialog import FileOperation  # noqa: E402
+
+
+def test_operation_failed(qtbot, db_path, tmp_path):
+	db = dbtag.Db(multithread=True)
+	db.open(db_path)
+	db.do_migrations()
+	(tmp_path / "src").mkdir()
+	(tmp_path / "src/file.txt").write_text("file")
+	(tmp_path / "dest").mkdir()
+	(tmp_path / "dest/file.txt").write_text("existing")
+
+	op = FileOperation(tmp_path / "dest", [tmp_path / "src/file.txt"], "cut", db)
+	with qtbot.waitSignal(op.failed) as blocker, qtbot.waitSignal(op.finished):
+		op.start()
+	assert "already exists" in blocker.args[0]
+	assert (tmp_path / "dest/file.txt").read_text() == "existing"
+	db.close()
@@ -0,0 +1,351 @@
+# SPDX-License-Identifier: WTFPL
+
+import collections
+import errno
+import os
+import struct
+import threading
+import time
+import zlib
+
+import pytest
+
+from sittagger import dbtag, fsops
+
+
+@pytest.fixture
+def db(db_path):
+	result = dbtag.Db()
+	result.open(db_path)
+	result.do_migrations()
+	yield result
+	result.close()
+
+
+@pytest.fixture
+def tree(tmp_path):
+	(tmp_path / "src/dir/sub").mkdir(parents=True)
+	(tmp_path / "src/file.txt").write_text("file")
+	(tmp_path / "src/dir/sub/inner.txt").write_text("inner")
+	(tmp_path / "dest").mkdir()
+	return tmp_path
+
+
+def test_transfer_cut(db, tree):
+	db.tag_file(str(tree / "src/file.txt"), ["foo"])
+	db.tag_file(str(tree / "src/dir/sub/inner.txt"), ["bar"])
+
+	sources = [tree / "src/file.txt", tree / "src/dir"]
+	fsops.Transfer(tree / "dest", sources, "cut", db).run()
+
+	assert (tree / "dest/file.txt").read_text() == "file"
+	assert (tree / "dest/dir/sub/inner.txt").read_text() == "inner"
+	assert not (tree / "src/dir").exists()
+	assert list(db.find_files_by_tags(["foo"])) == [str(tree / "dest/file.txt")]
+	assert list(db.find_files_by_tags(["bar"])) == [str(tree / "dest/dir/sub/inner.txt")]
+
+
+def test_transfer_copy(db, tree):
+	progress = []
+	sources = [tree / "src/file.txt", tree / "src/dir"]
+	fsops.Transfer(tree / "dest", sources, "copy", db, progress=lambda *args: progress.append(args)).run()
+
+	assert (tree / "dest/file.txt").read_text() == "file"
+	assert (tree / "dest/dir/sub/inner.txt").read_text() == "inner"
+	assert (tree / "src/dir/sub/inner.txt").exists()
+	# 2 files of 4 and 5 bytes, the last report is always sent
+	assert progress[-1] == (str(tree / "dest"), 9, 9, 2, 2)
+
+
+def test_transfer_to_new_name(db, tree):
+	db.tag_file(str(tree / "src/file.txt"), ["foo"])
+	fsops.Transfer(tree / "dest/renamed.txt", [tree / "src/file.txt"], "cut", db).run()
+
+	assert (tree / "dest/renamed.txt").read_text() == "file"
+	assert list(db.find_files_by_tags(["foo"])) == [str(tree / "dest/renamed.txt")]
+
+
+def test_transfer_cut_existing_file(db, tree):
+	db.tag_file(str(tree / "src/file.txt"), ["foo"])
+	(tree / "dest/file.txt").write_text("existing")
+
+	with pytest.raises(FileExistsError):
+		fsops.Transfer(tree / "dest", [tree / "src/file.txt"], "cut", db).run()
+
+	assert (tree / "src/file.txt").read_text() == "file"
+	assert (tree / "dest/file.txt").read_text() == "existing"
+	assert list(db.find_files_by_tags(["foo"])) == [str(tree / "src/file.txt")]
+
+
+def test_transfer_cut_existing_dir(db, tree):
+	db.tag_file(str(tree / "src/dir/sub/inner.txt"), ["bar"])
+	(tree / "dest/dir").mkdir()
+
+	with pytest.raises(FileExistsError):
+		fsops.Transfer(tree / "dest", [tree / "src/dir"], "cut", db).run()
+
+	assert (tree / "src/dir/sub/inner.txt").read_text() == "inner"
+	assert os.listdir(tree / "dest/dir") == []
+	assert list(db.find_files_by_tags(["bar"])) == [str(tree / "src/dir/sub/inner.txt")]
+
+
+@pytest.fixture
+def other_device(monkeypatch, tree):
+	# pretend dest is a mount point
+	def get_dev(path):
+		return 2 if str(path).startswith(str(tree / "dest")) else 1
+
+	monkeypatch.setattr(fsops, "_get_dev", get_dev)
+
+
+def test_transfer_cut_cross_device(db, tree, other_device):
+	db.tag_file(str(tree / "src/file.txt"), ["foo"])
+	db.tag_file(str(tree / "src/dir/sub/inner.txt"), ["bar"])
+	os.symlink("sub", tree / "src/dir/link")
+
+	progress = []
+	sources = [tree / "src/file.txt", tree / "src/dir"]
+	fsops.Transfer(tree / "dest", sources, "cut", db, progress=lambda *args: progress.append(args)).run()
+
+	assert (tree / "dest/file.txt").read_text() == "file"
+	assert (tree / "dest/dir/sub/inner.txt").read_text() == "inner"
+	assert os.readlink(tree / "dest/dir/link") == "sub"
+	assert os.listdir(tree / "src") == []
+	assert list(db.find_files_by_tags(["foo"])) == [str(tree / "dest/file.txt")]
+	assert list(db.find_files_by_tags(["bar"])) == [str(tree / "dest/dir/sub/inner.txt")]
+	# symlinks count as files of the size of their target path
+	assert progress[-1] == (str(tree / "dest"), 12, 12, 3, 3)
+
+
+def test_transfer_cut_checksum_error(db, tree, other_device, monkeypatch):
+	db.tag_file(str(tree / "src/dir/sub/inner.txt"), ["bar"])
+	monkeypatch.setattr(fsops, "_file_digest", lambda path: b"corrupted")
+
+	with pytest.raises(fsops.ChecksumError):
+		fsops.Transfer(tree / "dest", [tree / "src/dir"], "cut", db).run()
+
+	assert (tree / "src/dir/sub/inner.txt").read_text() == "inner"
+	assert not (tree / "dest/dir").exists()
+	assert list(db.find_files_by_tags(["bar"])) == [str(tree / "src/dir/sub/inner.txt")]
+
+
+def test_transfer_cut_cross_device_existing(db, tree, other_device, monkeypatch):
+	(tree / "dest/file.txt").write_text("existing")
+	(tree / "dest/dir").mkdir()
+	# appeared after the destination was checked
+	monkeypatch.setattr(os.path, "lexists", lambda path: False)
+
+	for name in ("file.txt", "dir"):
+		with pytest.raises(FileExistsError):
+			fsops.Transfer(tree / "dest", [tree / "src" / name], "cut", db).run()
+
+	monkeypatch.undo()
+	assert (tree / "dest/file.txt").read_text() == "existing"
+	assert os.listdir(tree / "dest/dir") == []
+	assert (tree / "src/file.txt").read_text() == "file"
+	assert (tree / "src/dir/sub/inner.txt").read_text() == "inner"
+
+
+def test_rename_file_cross_device(db, tree, other_device):
+	db.tag_file(str(tree / "src/file.txt"), ["foo"])
+	fsops.rename_file(tree / "src/file.txt", tree / "dest/renamed.txt", db)
+
+	assert (tree / "dest/renamed.txt").read_text() == "file"
+	assert not (tree / "src/file.txt").exists()
+	assert list(db.find_files_by_tags(["foo"])) == [str(tree / "dest/renamed.txt")]
+
+
+def test_move_journal_replay(db, tree):
+	db.tag_file(str(tree / "src/file.txt"), ["foo"])
+	db.tag_file(str(tree / "src/dir/sub/inner.txt"), ["bar"])
+
+	journal = fsops.MoveJournal(db)
+	journal.file_renamed(str(tree / "src/file.txt"), str(tree / "dest/file.txt"))
+	journal.folder_renamed(str(tree / "src/dir"), str(tree / "dest/dir"))
+
+	# still running
+	fsops.replay_journals(db)
+	assert list(db.find_files_by_tags(["foo"])) == [str(tree / "src/file.txt")]
+
+	# process died before commit
+	journal.close()
+	with open(journal.path, "a") as fd:
+		fd.write('["file", "trunc')
+
+	fsops.replay_journals(db)
+	assert list(db.find_files_by_tags(["foo"])) == [str(tree / "dest/file.txt")]
+	assert list(db.find_files_by_tags(["bar"])) == [str(tree / "dest/dir/sub/inner.txt")]
+	assert not os.path.exists(journal.path)
+
+
+def test_move_journal_commit(db, tree):
+	db.tag_file(str(tree / "src/file.txt"), ["foo"])
+
+	journal = fsops.MoveJournal(db)
+	journal.file_renamed(str(tree / "src/file.txt"), str(tree / "dest/file.txt"))
+	journal.file_renamed(str(tree / "dest/file.txt"), str(tree / "dest/other.txt"))
+	path = journal.path
+	# renamed once locked
+	assert fsops.JOURNAL_INFIX in os.path.basename(path)
+	assert not any(fsops.JOURNAL_TMP_INFIX in name for name in os.listdir(tree))
+	journal.commit()
+
+	assert list(db.find_files_by_tags(["foo"])) == [str(tree / "dest/other.txt")]
+	assert not os.path.exists(path)
+
+
+def write_png(path):
+	# 1x1 image
+	data = zlib.compress(b"\0\0\0\0")
+	path.write_bytes(
+		fsops.PNG_SIGNATURE
+		+ fsops._png_chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0))
+		+ fsops._png_chunk(b"IDAT", data)
+		+ fsops._png_chunk(b"IEND", b"")
+	)
+
+
+def test_move_thumbnails(db, tree, monkeypatch):
+	vignette = pytest.importorskip("vignette")
+	monkeypatch.setenv("XDG_CACHE_HOME", str(tree / "cache"))
+	vignette.makedirs()
+
+	for size in fsops.THUMB_SIZES:
+		write_png(tree / "thumb.png")
+		vignette.put_thumbnail(str(tree / "src/dir/sub/inner.txt"), size, str(tree / "thumb.png"))
+	write_png(tree / "thumb.png")
+	vignette.put_thumbnail(str(tree / "src/file.txt"), "normal", str(tree / "thumb.png"))
+
+	fsops.rename_folder(tree / "src/dir", tree / "dest/dir", db)
+	fsops.rename_file(tree / "src/file.txt", tree / "dest/file.txt", db)
+
+	for size in fsops.THUMB_SIZES:
+		assert vignette.try_get_thumbnail(str(tree / "dest/dir/sub/inner.txt"), size)
+		assert not os.path.exists(vignette.build_thumbnail_path(str(tree / "src/dir/sub/inner.txt"), size))
+	assert vignette.try_get_thumbnail(str(tree / "dest/file.txt"), "normal")
+	assert len(os.listdir(tree / "cache/thumbnails/normal")) == 2
+
+
+@pytest.mark.parametrize("unsupported", [[], ["_copy_file_range"], ["_copy_file_range", "_sendfile"]])
+def test_copy_data_fallback(tmp_path, monkeypatch, unsupported):
+	def fail(*args):
+		raise OSError(errno.EXDEV, "cross-device")
+
+	for name in unsupported:
+		monkeypatch.setattr(fsops, name, fail)
+	monkeypatch.setattr(fsops, "KERNEL_COPY_SIZE", 1000)
+
+	data = os.urandom(300000)
+	(tmp_path / "src").write_bytes(data)
+	with open(tmp_path / "src", "rb") as fsrc, open(tmp_path / "dst", "wb") as fdst:
+		progress = list(fsops.copy_data(fsrc, fdst))
+
+	assert (tmp_path / "dst").read_bytes() == data
+	assert progress[-1] == len(data)
+	assert progress == sorted(progress)
+
+
+def test_transfer_progress_rate(db, tree, monkeypatch):
+	for n in range(20):
+		(tree / "src/dir" / str(n)).write_text("x" * n)
+
+	progress = []
+	monkeypatch.setattr(fsops, "PROGRESS_INTERVAL", 3600)
+	fsops.Transfer(tree / "dest", [tree / "src/dir"], "copy", db, progress=lambda *args: progress.append(args)).run()
+
+	# the first and last reports only
+	assert len(progress) == 2
+	assert progress[-1][1:] == (190 + 5, 190 + 5, 21, 21)
+
+
+def test_copy_scheduler_device_limits(monkeypatch):
+	monkeypatch.setattr(fsops, "_is_rotational", lambda dev: dev == "hdd")
+	monkeypatch.setattr(fsops, "DEVICE_CONCURRENCY", 3)
+
+	lock = threading.Lock()
+	running = collections.Counter()
+	peaks = collections.Counter()
+	copied = []
+
+	def copy(src, dst):
+		devices = set(src)
+		with lock:
+			running.update(devices)
+			for dev in devices:
+				peaks[dev] = max(peaks[dev], running[dev])
+		time.sleep(0.01)
+		with lock:
+			running.subtract(devices)
+			copied.append(src)
+
+	jobs = [((dev, "ssd2"), None, (dev, "ssd2")) for dev in ["hdd", "ssd1"] for _ in range(10)]
+	fsops.CopyScheduler(copy, workers=8).run(jobs)
+
+	assert len(copied) == 20
+	assert peaks["hdd"] == 1
+	assert peaks["ssd2"] == 3
+	# ssd2 slots are shared with hdd jobs
+	assert 2 <= peaks["ssd1"] <= 3
+
+
+def test_copy_scheduler_error():
+	def copy(src, dst):
+		if src == 3:
+			raise OSError("failed")
+
+	with pytest.raises(OSError):
+		fsops.CopyScheduler(copy, workers=2).run([(n, None, (1,)) for n in range(10)])
+
+
+def test_trash_restore(db, tree, monkeypatch):
+	monkeypatch.setenv("XDG_DATA_HOME", str(tree / "data"))
+	(tree / "src/dir2").mkdir()
+	db.tag_file(str(tree / "src/file.txt"), ["foo"])
+	db.tag_file(str(tree / "src/dir/sub/inner.txt"), ["bar"])
+	db.tag_file(str(tree / "src/dir2"), ["bar"])
+	db.set_caption(str(tree / "src/dir/sub/inner.txt"), "inner #bar")
+
+	trashed = fsops.trash_items([tree / "src/file.txt", tree / "src/dir"], db)
+
+	trash = tree / "data/Trash"
+	assert trashed == [
+		(str(tree / "src/file.txt"), str(trash / "files/file.txt")),
+		(str(tree / "src/dir"), str(trash / "files/dir")),
+	]
+	info = (trash / "info/dir.trashinfo").read_text()
+	assert info.startswith("[Trash Info]\nPath=%s\nDeletionDate=" % (tree / "src/dir"))
+	assert (trash / "files/dir/sub/inner.txt").exists()
+	assert list(db.find_files_by_tags(["foo"])) == []
+	assert list(db.find_files_by_tags(["bar"])) == [str(tree / "src/dir2")]
+
+	# same name, other item
+	(tree / "src/file.txt").write_text("other")
+	assert fsops.trash_items([tree / "src/file.txt"], db)[0][1] == str(trash / "files/file.txt.2")
+
+	# orphan item without info file
+	(trash / "files/file.txt.3").write_text("orphan")
+	(tree / "src/file.txt").write_text("third")
+	assert fsops.trash_items([tree / "src/file.txt"], db)[0][1] == str(trash / "files/file.txt.4")
+	assert (trash / "files/file.txt.3").read_text() == "orphan"
+	assert not (trash / "info/file.txt.3.trashinfo").exists()
+
+	fsops.restore_items([db.find_trashed(tree / "src/dir")], db)
+	assert (tree / "src/dir/sub/inner.txt").read_text() == "inner"
+	assert not (trash / "info/dir.trashinfo").exists()
+	assert sorted(db.find_files_by_tags(["bar"])) == [str(tree / "src/dir/sub/inner.txt"), str(tree / "src/dir2")]
+	assert db.get_caption(str(tree / "src/dir/sub/inner.txt")) == "inner #bar"
+
+
+def test_sync_trash(db, tree, monkeypatch):
+	monkeypatch.setenv("XDG_DATA_HOME", str(tree / "data"))
+	db.tag_file(str(tree / "src/file.txt"), ["foo"])
+	db.tag_file(str(tree / "src/dir/sub/inner.txt"), ["bar"])
+	fsops.trash_items([tree / "src/file.txt", tree / "src/dir"], db)
+
+	# restored and emptied by another program
+	os.rename(tree / "data/Trash/files/file.txt", tree / "src/file.txt")
+	fsops._remove(tree / "data/Trash/files/dir")
+	fsops.sync_trash(db)
+
+	assert list(db.find_files_by_tags(["foo"])) == [str(tree / "src/file.txt")]
+	assert list(db.list_trashed()) == []
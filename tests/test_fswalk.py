@@ -0,0 +1,58 @@
+# SPDX-License-Identifier: WTFPL
+
+from sittagger import fswalk
+
+
+def make_tree(root, paths):
+	for path in paths:
+		path = root / path
+		path.parent.mkdir(parents=True, exist_ok=True)
+		path.touch()
+
+
+def walk(*args, **kwargs):
+	return sorted(fswalk.walk_files(*args, **kwargs))
+
+
+def test_walk_filters(tmp_path):
+	make_tree(tmp_path, ["a.jpg", "b.txt", "sub/c.png", "sub/deeper/d.JPG", "sub/e.mp4"])
+
+	assert walk([str(tmp_path)]) == [
+		str(tmp_path / name)
+		for name in ["a.jpg", "b.txt", "sub/c.png", "sub/deeper/d.JPG", "sub/e.mp4"]
+	]
+	assert walk([str(tmp_path)], globs=["*.jpg", "*.png"]) == [
+		str(tmp_path / "a.jpg"), str(tmp_path / "sub/c.png"),
+	]
+	assert walk([str(tmp_path)], mimes=["image/*"]) == [
+		str(tmp_path / name) for name in ["a.jpg", "sub/c.png", "sub/deeper/d.JPG"]
+	]
+	assert walk([str(tmp_path / "sub")], globs=["*.mp4", "*.png"], mimes=["video/*"]) == [
+		str(tmp_path / "sub/e.mp4"),
+	]
+
+
+def test_walk_ignore_file(tmp_path):
+	make_tree(tmp_path, [
+		"keep.jpg", "skip.tmp", "cache/a.jpg", "sub/cache", "sub/keep.jpg",
+		"sub/only/here.jpg", "other/only/here.jpg",
+	])
+	(tmp_path / ".sittaggerignore").write_text("# comment\n\n*.tmp\ncache/\n")
+	(tmp_path / "sub" / ".sittaggerignore").write_text("only/here.jpg\n")
+
+	assert walk([str(tmp_path)]) == [
+		str(tmp_path / name)
+		for name in ["keep.jpg", "other/only/here.jpg", "sub/cache", "sub/keep.jpg"]
+	]
+
+
+def test_walk_ignore_file_paths(tmp_path):
+	root = tmp_path / "photos[2019]"
+	make_tree(root, [
+		"only/a.jpg", "only/a.png", "only/deeper/b.jpg", "x/deep/c.jpg", "x/deep/c.png", "deep/d.jpg",
+	])
+	(root / ".sittaggerignore").write_text("only/*.jpg\n**/deep/*.jpg\n")
+
+	assert walk([str(root)]) == [
+		str(root / name) for name in ["only/a.png", "only/deeper/b.jpg", "x/deep/c.png"]
+	]
@@ -0,0 +1,204 @@
+# SPDX-License-Identifier: WTFPL
+
+import pytest
+
+pytest.importorskip("PyQt6")
+
+from PyQt6.QtCore import QRect, QSize  # noqa: E402
+from PyQt6.QtGui import QColor, QImage, QImageIOHandler, QImageWriter, QPainter  # noqa: E402
+
+from sittagger.imageloader import (  # noqa: E402
+	ImageCache, ImageLoader, TILE_SIZE, _DecodeTask, decode, decode_tiles, render_scaled,
+)
+
+
+def image(width, height=1):
+	result = QImage(width, height, QImage.Format.Format_RGB32)
+	result.fill(QColor("red"))
+	return result
+
+
+def test_cache_budget():
+	# 400 bytes per image
+	cache = ImageCache(budget=1000)
+	cache.put("a", image(100))
+	cache.put("b", image(100))
+	assert cache.get("a") is not None
+	cache.put("c", image(100))
+
+	# least recently used
+	assert "b" not in cache
+	assert "a" in cache and "c" in cache
+	assert cache.size == 800
+
+
+def test_cache_priorities():
+	cache = ImageCache(budget=1000)
+	cache.setPriorities(["a", "b"])
+	cache.put("a", image(100))
+	cache.put("b", image(100))
+	cache.put("c", image(100))
+	assert "c" not in cache
+
+	cache.setPriorities(["c", "b"])
+	cache.put("c", image(100))
+	assert "a" not in cache
+	assert "b" in cache and "c" in cache
+
+
+def test_loader(qtbot, tmp_path):
+	paths = []
+	for n in range(3):
+		path = str(tmp_path / ("%d.png" % n))
+		image(10 + n, 10).save(path)
+		paths.append(path)
+
+	loader = ImageLoader()
+	loaded = {}
+	loader.loaded.connect(lambda path, spec, img: loaded.__setitem__(path, img.width()))
+
+	with qtbot.waitSignal(loader.loaded):
+		loader.request(paths[0])
+	assert loaded == {paths[0]: 10}
+
+	loader.prefetch((path, None) for path in paths)
+	qtbot.waitUntil(lambda: len(loaded) == 3)
+	assert loaded == {paths[0]: 10, paths[1]: 11, paths[2]: 12}
+	assert all((path, None) in loader.cache for path in paths)
+	assert loader.fullSizes[paths[2]].width() == 12
+	assert not loader.pending
+	loader.stop()
+
+
+def test_loader_requested_while_skipped(qtbot, tmp_path):
+	path = str(tmp_path / "image.png")
+	image(10, 10).save(path)
+	key = (path, None)
+
+	loader = ImageLoader()
+	# prefetched, then the task ran after navigation went elsewhere
+	loader.pending[key] = _DecodeTask(loader, key, 0)
+	loader.request(path)
+	with qtbot.waitSignal(loader.loaded):
+		# its result was still queued
+		loader.decoded.emit(key, QImage(), QSize(), False, False)
+	assert key in loader.cache
+	assert not loader.pending
+	loader.stop()
+
+
+@pytest.mark.parametrize("fmt", ["jpg", "png"])
+def test_decode_scaled(tmp_path, fmt):
+	path = str(tmp_path / ("image." + fmt))
+	image(800, 600).save(path)
+
+	img, full, animated = decode(path, (100, 100, False))
+	assert (img.width(), img.height()) == (100, 75)
+	assert (full.width(), full.height()) == (800, 600)
+	assert not animated
+
+	img, _, _ = decode(path, (100, 100, True))
+	assert (img.width(), img.height()) == (133, 100)
+
+	# never upscaled
+	img, _, _ = decode(path, (1000, 1000, False))
+	assert (img.width(), img.height()) == (800, 600)
+
+
+def quadrants(width, height):
+	# red, green / blue, white
+	result = QImage(width, height, QImage.Format.Format_RGB32)
+	result.fill(QColor("white"))
+	with QPainter(result) as painter:
+		painter.fillRect(0, 0, width // 2, height // 2, QColor("red"))
+		painter.fillRect(width // 2, 0, width - width // 2, height // 2, QColor("green"))
+		painter.fillRect(0, height // 2, width // 2, height - height // 2, QColor("blue"))
+	return result
+
+
+def color(img, x, y):
+	# name of the nearest pure color, JPEG is lossy
+	rgb = QColor(img.pixel(x, y))
+	values = tuple(round(c / 255) for c in (rgb.red(), rgb.green(), rgb.blue()))
+	return {(1, 0, 0): "red", (0, 1, 0): "green", (0, 0, 1): "blue", (1, 1, 1): "white"}[values]
+
+
+@pytest.mark.parametrize("fmt", ["jpg", "png"])
+def test_decode_tiles(tmp_path, fmt):
+	path = str(tmp_path / ("image." + fmt))
+	quadrants(2 * TILE_SIZE, 2 * TILE_SIZE).save(path)
+
+	# bottom row at level 0
+	tiles = decode_tiles(path, 0, QRect(0, TILE_SIZE, 2 * TILE_SIZE, TILE_SIZE))
+	tiles = {(col, row): img for col, row, img in tiles}
+	if fmt == "png":
+		# no region decoding, whole level
+		assert set(tiles) == {(0, 0), (1, 0), (0, 1), (1, 1)}
+	else:
+		assert set(tiles) == {(0, 1), (1, 1)}
+	assert color(tiles[0, 1], 10, 10) == "blue"
+	assert color(tiles[1, 1], 10, 10) == "white"
+	assert tiles[1, 1].size() == QSize(TILE_SIZE, TILE_SIZE)
+
+	# single tile at level 1
+	[(col, row, img)] = decode_tiles(path, 1, QRect(0, 0, TILE_SIZE, TILE_SIZE))
+	assert (col, row) == (0, 0)
+	assert img.size() == QSize(TILE_SIZE, TILE_SIZE)
+	assert color(img, 10, 10) == "red"
+	assert color(img, TILE_SIZE - 10, TILE_SIZE - 10) == "white"
+
+
+def test_decode_tiles_transformed(tmp_path):
+	path = str(tmp_path / "image.jpg")
+	writer = QImageWriter(path)
+	writer.setTransformation(QImageIOHandler.Transformation.TransformationRotate90)
+	assert writer.write(quadrants(4 * TILE_SIZE, 2 * TILE_SIZE))
+
+	_, full, _ = decode(path)
+	assert full == QSize(2 * TILE_SIZE, 4 * TILE_SIZE)
+
+	# rotated clockwise: blue, red / white, green
+	tiles = decode_tiles(path, 0, QRect(TILE_SIZE, 0, TILE_SIZE, 4 * TILE_SIZE))
+	tiles = {(col, row): img for col, row, img in tiles}
+	assert set(tiles) == {(1, 0), (1, 1), (1, 2), (1, 3)}
+	assert [color(tiles[1, row], 10, 10) for row in range(4)] == ["red", "red", "green", "green"]
+
+
+def test_loader_tiles(qtbot, tmp_path):
+	path = str(tmp_path / "image.jpg")
+	quadrants(4 * TILE_SIZE, 4 * TILE_SIZE).save(path)
+
+	loader = ImageLoader()
+	with qtbot.waitSignal(loader.loaded):
+		loader.request(path, (100, 100, False))
+
+	with qtbot.waitSignal(loader.tileLoaded) as blocker:
+		loader.requestTiles(path, 1, [(0, 0), (1, 0)])
+	assert blocker.args == [path, 1]
+	assert {key for key in loader.tiles.images} == {(path, 1, 0, 0), (path, 1, 1, 0)}
+	assert not loader.pendingTiles
+	loader.stop()
+
+
+def test_render_scaled():
+	base = quadrants(40, 40)
+	tile = image(10, 10)
+	result = render_scaled(QSize(100, 50), [
+		# right half of base to the left half of result
+		(base, QRect(20, 0, 20, 40), QRect(0, 0, 50, 50)),
+		(tile, tile.rect(), QRect(50, 0, 50, 50)),
+	])
+	assert result.size() == QSize(100, 50)
+	assert color(result, 10, 10) == "green"
+	assert color(result, 10, 40) == "white"
+	assert color(result, 90, 40) == "red"
+
+
+def test_loader_render(qtbot):
+	loader = ImageLoader()
+	with qtbot.waitSignal(loader.rendered) as blocker:
+		loader.render("key", QSize(20, 20), [(image(10, 10), QRect(0, 0, 10, 10), QRect(0, 0, 20, 20))])
+	key, result = blocker.args
+	assert key == "key"
+	assert color(result, 15, 15) == "red"
+	loader.stop()
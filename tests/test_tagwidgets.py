@@ -0,0 +1,118 @@
+# SPDX-License-Identifier: WTFPL
+
+import pytest
+
+pytest.importorskip("PyQt6")
+
+from PyQt6.QtCore import Qt  # noqa: E402
+
+from sittagger import dbtag  # noqa: E402
+from sittagger.tagwidgets import TagChooser, TagListModel  # noqa: E402
+
+
+def rows(model):
+	return [model.index(row).data() for row in range(model.rowCount())]
+
+
+def checked(model):
+	return [
+		model.index(row).data()
+		for row in range(model.rowCount())
+		if model.index(row).data(Qt.ItemDataRole.CheckStateRole) == Qt.CheckState.Checked
+	]
+
+
+@pytest.fixture
+def model(qapp):
+	result = TagListModel()
+	result.setTags(["foo", "bar", "baz", "qux"])
+	return result
+
+
+def test_set_tags_sorted(model):
+	assert rows(model) == ["bar", "baz", "foo", "qux"]
+
+
+def test_set_tags_keeps_states(model):
+	model.setCheckStates({"foo": Qt.CheckState.Checked, "qux": Qt.CheckState.Checked})
+	model.setTags(["aaa", "foo", "quux", "qux", "zzz"])
+	assert rows(model) == ["aaa", "foo", "quux", "qux", "zzz"]
+	assert checked(model) == ["foo", "qux"]
+	assert model.checkedTags() == ["foo", "qux"]
+
+
+def test_insert_remove(model):
+	model.insertTag("bat")
+	model.insertTag("bat")
+	model.removeTag("foo")
+	model.removeTag("nonexistent")
+	assert rows(model) == ["bar", "bat", "baz", "qux"]
+
+
+def test_filter(model):
+	model.setCheckStates({"baz": Qt.CheckState.Checked})
+	model.setFilterFixedString("ba")
+	assert rows(model) == ["bar", "baz"]
+
+	model.insertTag("bat")
+	model.insertTag("zzz")
+	model.removeTag("bar")
+	assert rows(model) == ["bat", "baz"]
+	assert checked(model) == ["baz"]
+
+	model.setTags(["abab", "baz", "foo"])
+	assert rows(model) == ["abab", "baz"]
+
+	model.setFilterFixedString("")
+	assert rows(model) == ["abab", "baz", "foo"]
+	assert model.checkedTags() == ["baz"]
+
+
+def test_check_from_view(model):
+	received = []
+	model.checkStateChanged.connect(lambda tag, state: received.append((tag, state)))
+
+	model.setData(model.index(2), Qt.CheckState.Checked.value, Qt.ItemDataRole.CheckStateRole)
+	assert received == [("foo", Qt.CheckState.Checked)]
+	assert model.checkedTags() == ["foo"]
+
+	# programmatic changes are not notified
+	model.setCheckStates({})
+	assert received == [("foo", Qt.CheckState.Checked)]
+	assert model.checkedTags() == []
+
+
+def test_show_counts(model):
+	model.setCounts({"foo": 3})
+	assert model.index(2).data() == "foo"
+
+	model.setShowCounts(True)
+	assert model.index(2).data() == "foo (3)"
+	assert model.index(0).data() == "bar (0)"
+	assert model.index(2).data(Qt.ItemDataRole.UserRole) == "foo"
+
+
+def test_highlighted(model):
+	model.setHighlighted(["foo", "nonexistent"])
+	assert model.index(2).data(Qt.ItemDataRole.FontRole).bold()
+	assert model.index(0).data(Qt.ItemDataRole.FontRole) is None
+
+
+@pytest.mark.parametrize("faceted", [False, True])
+def test_chooser_faceted(qapp, db_path, faceted):
+	db = dbtag.Db()
+	db.open(db_path)
+	db.do_migrations()
+	db.tag_file("/foo", ["tag1", "tag2"])
+	db.tag_file("/bar", ["tag3"])
+
+	chooser = TagChooser(faceted=faceted)
+	chooser.setDb(db)
+	chooser.setTags(["tag1"])
+	if faceted:
+		# tag3 is a dead end
+		assert rows(chooser.data) == ["tag1 (1)", "tag2 (1)"]
+	else:
+		assert rows(chooser.data) == ["tag1", "tag2", "tag3"]
+	assert chooser.selectedTags() == ["tag1"]
+	db.close()